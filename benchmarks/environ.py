@@ -0,0 +1,128 @@
+"""
+    benchmarks.environ
+    ~~~~~~~~~~~~~~~~~~
+
+    Measures the time taken by :meth:`WSGIRequestHandler.make_environ` to
+    build the environ for a typical browser request, compared to the original
+    implementation which parsed the url and translated every header name on
+    every request.
+
+    Run with ``python benchmarks/environ.py``.
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import io
+import ssl
+import sys
+import timeit
+import urllib.parse
+
+from verktyg_server import (
+    WSGIRequestHandler, BaseWSGIServer, make_inet_socket,
+)
+from verktyg_server.parser import parse_headers
+
+
+_REQUEST_HEAD = (
+    b"Host: example.com\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Gecko/20100101\r\n"
+    b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9\r\n"
+    b"Accept-Language: en-GB,en;q=0.5\r\n"
+    b"Accept-Encoding: gzip, deflate, br\r\n"
+    b"Cookie: session=d9f8a7b6c5d4e3f2a1b0; csrftoken=0a1b2c3d4e5f\r\n"
+    b"Connection: keep-alive\r\n"
+    b"Upgrade-Insecure-Requests: 1\r\n"
+    b"\r\n"
+)
+
+
+def _legacy_make_environ(self):
+    request_url = urllib.parse.urlparse(self.path)
+
+    if request_url.scheme:
+        url_scheme = request_url.scheme
+    elif isinstance(self.server.socket, ssl.SSLSocket):
+        url_scheme = 'https'
+    else:
+        url_scheme = 'http'
+
+    path = urllib.parse.unquote_to_bytes(
+        request_url.path
+    ).decode('iso-8859-1')
+
+    environ = {
+        'wsgi.version':         (1, 0),
+        'wsgi.url_scheme':      url_scheme,
+        'wsgi.input':           self.rfile,
+        'wsgi.errors':          sys.stderr,
+        'wsgi.multithread':     self.server.multithread,
+        'wsgi.multiprocess':    self.server.multiprocess,
+        'wsgi.run_once':        False,
+        'verktyg.server.shutdown': self.server.shutdown,
+        'SERVER_SOFTWARE':      self.server_version,
+        'REQUEST_METHOD':       self.command,
+        'SCRIPT_NAME':          '',
+        'PATH_INFO':            path,
+        'QUERY_STRING':         request_url.query,
+        'CONTENT_TYPE':         self.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH':       self.headers.get('Content-Length', ''),
+        'REMOTE_ADDR':          self.client_address[0],
+        'REMOTE_PORT':          self.client_address[1],
+        'SERVER_NAME':          self.server.server_address[0],
+        'SERVER_PORT':          str(self.server.server_address[1]),
+        'SERVER_PROTOCOL':      self.request_version
+    }
+
+    for key, value in self.headers.items():
+        key = 'HTTP_' + key.upper().replace('-', '_')
+        if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            environ[key] = value
+
+    if request_url.netloc:
+        environ['HTTP_HOST'] = request_url.netloc
+
+    if hasattr(self.request, 'getpeercert'):
+        environ['REMOTE_CERT'] = self.request.getpeercert(binary_form=True)
+
+    return environ
+
+
+def _make_handler(server):
+    handler = WSGIRequestHandler.__new__(WSGIRequestHandler)
+    handler.server = server
+    handler.request = None
+    handler.client_address = ('127.0.0.1', 54321)
+    handler.rfile = io.BytesIO()
+    handler.command = 'GET'
+    handler.path = '/static/css/site.css?v=20180101'
+    handler.request_version = 'HTTP/1.1'
+    handler.headers = parse_headers(_REQUEST_HEAD)
+    return handler
+
+
+def main():
+    number = 100000
+
+    server = BaseWSGIServer(make_inet_socket('localhost'), None)
+    try:
+        handler = _make_handler(server)
+
+        for name, function in [
+                    ('legacy', _legacy_make_environ),
+                    ('current', WSGIRequestHandler.make_environ),
+                ]:
+            best = min(timeit.repeat(
+                lambda: function(handler), number=number, repeat=5,
+            ))
+            print('{name:>8}: {usec:.2f}us per request'.format(
+                name=name, usec=best / number * 1e6,
+            ))
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
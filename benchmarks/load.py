@@ -0,0 +1,351 @@
+"""
+    benchmarks.load
+    ~~~~~~~~~~~~~~~
+
+    Starts each kind of server with :class:`verktyg_server.testing.TestServer`
+    on each transport, drives it with a local load generator, and prints one
+    line of JSON per run giving throughput and latency percentiles, so that
+    results can be collected and compared between revisions.
+
+    The load generator runs in separate processes, so that it doesn't compete
+    with the server for the GIL.  Each process opens some of the connections
+    and, on each one, repeatedly sends a batch of pipelined requests and waits
+    for the responses.  Connections are reused for as long as the server keeps
+    them open.  Servers that close the connection after every response are
+    still measured, but will, of course, look much worse.
+
+    Run with ``python benchmarks/load.py``, or ``--help`` for options.
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import os
+import ssl
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+from collections import namedtuple
+
+from verktyg_server.sslutils import make_adhoc_ssl_context
+from verktyg_server.testing import TestServer
+
+
+#: Keyword arguments passed to :class:`TestServer` for each server mode.
+SERVERS = {
+    'base': {},
+    'threaded': {'threaded': True},
+    'forking': {'processes': 32},
+    'pool': {'threads': 16},
+    'prefork': {'workers': 4, 'threads': 16},
+    'event_loop': {'event_loop': True},
+}
+
+TRANSPORTS = ('tcp', 'unix', 'tls')
+
+#: Where the load generator should connect to.  `address` is either a
+#: ``(host, port)`` pair or the path of a unix socket.
+Target = namedtuple('Target', ['family', 'address', 'tls'])
+
+_BODY = b"Hello, World!"
+
+# Seconds to wait for the load generator processes to start.
+_READY_TIMEOUT = 60
+
+
+def application(environ, start_response):
+    start_response('200 OK', [
+        ('Content-Type', 'text/plain'),
+        ('Content-Length', str(len(_BODY))),
+    ])
+    return [_BODY]
+
+
+class _Closed(Exception):
+    pass
+
+
+class _Connection(object):
+    def __init__(self, target, ssl_context):
+        sock = socket.socket(target.family, socket.SOCK_STREAM)
+        try:
+            sock.connect(target.address)
+            if target.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if ssl_context is not None:
+                sock = ssl_context.wrap_socket(sock)
+        except BaseException:
+            sock.close()
+            raise
+        self._sock = sock
+        self._buffer = b''
+
+    def send(self, data):
+        self._sock.sendall(data)
+
+    def _fill(self):
+        data = self._sock.recv(65536)
+        if not data:
+            raise _Closed()
+        self._buffer += data
+
+    def read_response(self):
+        """Reads a single response and returns ``True`` if the server will
+        keep the connection open afterwards.
+        """
+        while True:
+            end = self._buffer.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            self._fill()
+
+        head = self._buffer[:end].split(b"\r\n")
+        self._buffer = self._buffer[end + 4:]
+
+        keep_alive = head[0].startswith(b"HTTP/1.1 ")
+        length = 0
+        for line in head[1:]:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"connection":
+                keep_alive = value.strip().lower() == b"keep-alive"
+
+        while len(self._buffer) < length:
+            self._fill()
+        self._buffer = self._buffer[length:]
+
+        return keep_alive
+
+    def close(self):
+        self._sock.close()
+
+
+def _drive_connection(target, ssl_context, pipeline, deadline, results):
+    request = (
+        b"GET /plaintext HTTP/1.1\r\n"
+        b"Host: localhost\r\n"
+        b"Accept: text/plain\r\n"
+        b"\r\n"
+    )
+    latencies = []
+    errors = 0
+    connection = None
+
+    while time.monotonic() < deadline:
+        try:
+            if connection is None:
+                connection = _Connection(target, ssl_context)
+
+            start = time.perf_counter()
+            connection.send(request * pipeline)
+            for n in range(pipeline):
+                keep_alive = connection.read_response()
+                latencies.append(time.perf_counter() - start)
+                if not keep_alive:
+                    # Any requests still outstanding were never read by the
+                    # server, and will be sent again on the next connection.
+                    connection.close()
+                    connection = None
+                    break
+        except (OSError, _Closed):
+            errors += 1
+            if connection is not None:
+                connection.close()
+                connection = None
+
+    if connection is not None:
+        connection.close()
+
+    results.append((latencies, errors))
+
+
+def _generate_load(target, connections, pipeline, duration, ready):
+    ssl_context = None
+    if target.tls:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    # Wait for the other processes to finish starting up, so that they all
+    # generate load for the whole of the run.
+    ready.wait(_READY_TIMEOUT)
+    deadline = time.monotonic() + duration
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=_drive_connection,
+            args=(target, ssl_context, pipeline, deadline, results),
+        )
+        for n in range(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = []
+    errors = 0
+    for connection_latencies, connection_errors in results:
+        latencies.extend(connection_latencies)
+        errors += connection_errors
+    return latencies, errors
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(len(ordered) * fraction))
+    return ordered[index]
+
+
+def run(
+            target, *, connections=64, pipeline=1, duration=10.0,
+            processes=None
+        ):
+    """Drives the server at `target` for `duration` seconds and returns a
+    dictionary of results.  Latencies are in milliseconds.
+    """
+    if processes is None:
+        processes = min(connections, os.cpu_count() or 1)
+
+    # Threads in the parent are running the server, so forking here would
+    # be unsafe.
+    context = multiprocessing.get_context('spawn')
+
+    start = time.monotonic()
+    with context.Manager() as manager, context.Pool(processes) as pool:
+        # Spawning a process, and importing everything in it, is slow, so
+        # each process only starts its clock once every one of them is
+        # ready.  Each takes up a pool worker until then, so they are all
+        # guaranteed to run at the same time.
+        ready = manager.Barrier(processes + 1)
+        work = [
+            pool.apply_async(_generate_load, (
+                target, connections // processes +
+                (1 if n < connections % processes else 0),
+                pipeline, duration, ready,
+            ))
+            for n in range(processes)
+        ]
+        ready.wait(_READY_TIMEOUT)
+        results = [result.get() for result in work]
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(
+        latency for result_latencies, _ in results
+        for latency in result_latencies
+    )
+    errors = sum(result_errors for _, result_errors in results)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'connections': connections,
+        'pipeline': pipeline,
+        'duration': duration,
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': round(len(latencies) / duration, 1),
+        'latency_ms': {
+            'p50': ms(_percentile(latencies, 0.50)),
+            'p99': ms(_percentile(latencies, 0.99)),
+            'p999': ms(_percentile(latencies, 0.999)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'elapsed': round(elapsed, 3),
+    }
+
+
+def _target(server):
+    if server.socket_path is not None:
+        return Target(socket.AF_UNIX, server.socket_path, False)
+    return Target(
+        socket.AF_INET, ('127.0.0.1', server.port), server.protocol == 'https'
+    )
+
+
+def _comma_separated(choices):
+    def parse(value):
+        values = [item.strip() for item in value.split(',') if item.strip()]
+        for item in values:
+            if item not in choices:
+                raise argparse.ArgumentTypeError(
+                    "invalid choice: %r (choose from %s)" % (
+                        item, ', '.join(choices),
+                    )
+                )
+        return values
+    return parse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=(
+        "Measure the throughput and latency of each server mode."
+    ))
+    parser.add_argument(
+        '--servers', type=_comma_separated(sorted(SERVERS)),
+        default=sorted(SERVERS),
+        help="comma separated list of server modes to run (default: all)",
+    )
+    parser.add_argument(
+        '--transports', type=_comma_separated(TRANSPORTS),
+        default=list(TRANSPORTS),
+        help="comma separated list of transports to run (default: all)",
+    )
+    parser.add_argument(
+        '--connections', type=int, default=64,
+        help="number of concurrent connections (default: 64)",
+    )
+    parser.add_argument(
+        '--pipeline', type=int, default=1,
+        help="requests sent on a connection before reading (default: 1)",
+    )
+    parser.add_argument(
+        '--duration', type=float, default=10.0,
+        help="seconds to run each benchmark for (default: 10)",
+    )
+    parser.add_argument(
+        '--processes', type=int, default=None,
+        help="number of load generator processes (default: one per cpu)",
+    )
+    args = parser.parse_args(argv)
+
+    ssl_context = None
+    if 'tls' in args.transports:
+        ssl_context = make_adhoc_ssl_context(key_type='ec')
+
+    for server_name in args.servers:
+        for transport in args.transports:
+            with TestServer(
+                        application,
+                        unix_socket=(transport == 'unix'),
+                        ssl_context=(
+                            ssl_context if transport == 'tls' else None
+                        ),
+                        **SERVERS[server_name]
+                    ) as server:
+                result = run(
+                    _target(server),
+                    connections=args.connections,
+                    pipeline=args.pipeline,
+                    duration=args.duration,
+                    processes=args.processes,
+                )
+            result = dict(
+                server=server_name, transport=transport,
+                python=sys.version.split()[0], **result
+            )
+            print(json.dumps(result, sort_keys=True), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+    benchmarks.parser
+    ~~~~~~~~~~~~~~~~~
+
+    Measures the time taken to parse the head of a request and turn its
+    headers into environ entries using
+    :meth:`WSGIRequestHandler.parse_request`, compared to
+    :meth:`http.server.BaseHTTPRequestHandler.parse_request`, which builds
+    an :class:`email.message.Message` from each request.
+
+    Run with ``python benchmarks/parser.py``.
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import timeit
+from http.server import BaseHTTPRequestHandler
+
+from verktyg_server import (
+    WSGIRequestHandler, BaseWSGIServer, make_inet_socket,
+)
+from verktyg_server.parser import environ_key
+from verktyg_server.streams import SocketReader
+
+
+_REQUESTS = {
+    'minimal': (
+        b"GET / HTTP/1.1\r\n"
+        b"Host: example.com\r\n"
+        b"\r\n"
+    ),
+    'browser': (
+        b"GET /static/css/site.css?v=20180101 HTTP/1.1\r\n"
+        b"Host: example.com\r\n"
+        b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:60.0) "
+        b"Gecko/20100101 Firefox/60.0\r\n"
+        b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9\r\n"
+        b"Accept-Language: en-GB,en;q=0.5\r\n"
+        b"Accept-Encoding: gzip, deflate, br\r\n"
+        b"Cookie: session=d9f8a7b6c5d4e3f2a1b0; csrftoken=0a1b2c3d4e5f\r\n"
+        b"Connection: keep-alive\r\n"
+        b"Upgrade-Insecure-Requests: 1\r\n"
+        b"\r\n"
+    ),
+    'proxied': (
+        b"POST /api/v1/orders HTTP/1.1\r\n"
+        b"Host: api.example.com\r\n"
+        b"User-Agent: Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_4) "
+        b"AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0 Safari/537.36\r\n"
+        b"Accept: application/json\r\n"
+        b"Accept-Language: en-GB,en-US;q=0.9,en;q=0.8\r\n"
+        b"Accept-Encoding: gzip, deflate, br\r\n"
+        b"Content-Type: application/json\r\n"
+        b"Content-Length: 0\r\n"
+        b"Origin: https://www.example.com\r\n"
+        b"Referer: https://www.example.com/checkout/basket\r\n"
+        b"Cookie: " + b"; ".join(
+            b"cookie%d=%s" % (n, b"x" * 40) for n in range(20)
+        ) + b"\r\n"
+        b"Authorization: Bearer " + b"t" * 400 + b"\r\n"
+        b"X-Forwarded-For: 203.0.113.7, 198.51.100.20, 10.0.0.12\r\n"
+        b"X-Forwarded-Proto: https\r\n"
+        b"X-Forwarded-Host: api.example.com\r\n"
+        b"X-Forwarded-Port: 443\r\n"
+        b"X-Real-IP: 203.0.113.7\r\n"
+        b"Forwarded: for=203.0.113.7;proto=https;by=10.0.0.1\r\n"
+        b"Via: 1.1 cdn-edge-42, 1.1 lb-3\r\n"
+        b"X-Request-Id: 4bf92f3577b34da6a3ce929d0e0e4736\r\n"
+        b"X-Amzn-Trace-Id: Root=1-5b0c5a8e-2d1a3c4b5e6f7a8b9c0d1e2f\r\n"
+        b"Traceparent: 00-4bf92f3577b34da6a3ce929d0e0e4736-"
+        b"00f067aa0ba902b7-01\r\n"
+        b"CDN-Loop: cdn; count=1\r\n"
+        b"CF-Connecting-IP: 203.0.113.7\r\n"
+        b"CF-IPCountry: GB\r\n"
+        b"CF-Ray: 41a6cbcb1c4e7734-LHR\r\n"
+        b"CF-Visitor: {\"scheme\":\"https\"}\r\n"
+        b"Connection: keep-alive\r\n"
+        b"\r\n"
+    ),
+}
+
+
+class _Socket(object):
+    def __init__(self, data):
+        self._data = data
+
+    def recv(self, size):
+        data, self._data = self._data[:size], self._data[size:]
+        return data
+
+
+def _legacy_parse(handler):
+    BaseHTTPRequestHandler.parse_request(handler)
+    environ = {}
+    for key, value in handler.headers.items():
+        environ[environ_key(key)] = value
+    return environ
+
+
+def _current_parse(handler):
+    WSGIRequestHandler.parse_request(handler)
+    environ = {}
+    environ.update(handler.headers.environ)
+    return environ
+
+
+def _make_handler(server, request):
+    handler = WSGIRequestHandler.__new__(WSGIRequestHandler)
+    handler.server = server
+    handler.rfile = SocketReader(_Socket(request))
+    handler.raw_requestline = handler.rfile.readline(65537)
+    return handler
+
+
+def main():
+    number = 20000
+
+    server = BaseWSGIServer(make_inet_socket('localhost'), None)
+    server.multithread = True
+    try:
+        for request_name, request in sorted(_REQUESTS.items()):
+            # Both parsers should agree on the result.
+            assert (
+                _legacy_parse(_make_handler(server, request)) ==
+                _current_parse(_make_handler(server, request))
+            )
+
+            for name, function in [
+                        ('legacy', _legacy_parse),
+                        ('current', _current_parse),
+                    ]:
+                best = min(timeit.repeat(
+                    lambda: function(_make_handler(server, request)),
+                    number=number, repeat=5,
+                ))
+                print('{request:>8} {name:>8}: {usec:.2f}us'.format(
+                    request=request_name, name=name,
+                    usec=best / number * 1e6,
+                ))
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,17 +7,39 @@
     :license:
         BSD, see LICENSE for more details.
 """
+import io
+import os
 import sys
+import mmap
+import stat
+import functools
+import signal
+import select
+import selectors
+import subprocess
+import time
 import urllib.parse
 import ssl
 import socket
 from socket import getfqdn
 import socketserver
+import queue
+import threading
+import collections
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
 import pkg_resources
 
 from verktyg_server.sslutils import load_ssl_context, make_adhoc_ssl_context
+from verktyg_server.streams import (
+    ChunkedInput, LimitedInput, FileWrapper, SocketReader, MalformedBodyError,
+)
+from verktyg_server.metrics import ServerMetrics
+from verktyg_server.accesslog import AccessLogRecord
+from verktyg_server.sockopts import SocketOptions, accept_queue
+from verktyg_server.parser import (
+    RequestHeadError, parse_request_line, parse_headers,
+)
 
 import logging
 log = logging.getLogger('verktyg_server')
@@ -26,57 +48,187 @@ log = logging.getLogger('verktyg_server')
 __version__ = pkg_resources.get_distribution("verktyg-server").version
 
 
+# Maximum number of buffers that can be passed to a single call to `sendmsg`.
+_IOV_MAX = 1024
+
+
+# Registered with the accept loop's selector to mark the socket used to wake
+# it up.
+_WAKE = object()
+
+# Except on Linux, sockets accepted from a non-blocking listening socket are
+# themselves non-blocking.
+_ACCEPT_INHERITS_NONBLOCKING = not sys.platform.startswith('linux')
+
+
+def _shed_response(retry_after):
+    # Built once, when the server is created, so that turning a request away
+    # costs as little as possible.
+    body = b"Service Unavailable\n"
+    return (
+        b"HTTP/1.1 503 Service Unavailable\r\n"
+        b"Content-Type: text/plain\r\n"
+        b"Content-Length: %d\r\n"
+        b"Retry-After: %d\r\n"
+        b"Connection: close\r\n"
+        b"\r\n" % (len(body), retry_after)
+    ) + body
+
+
+def _client_address(address):
+    # Clients connecting over a unix socket are usually unbound, and so have
+    # an empty string, rather than a host and port pair, as their address.
+    if not isinstance(address, tuple):
+        return ('', 0)
+    return address
+
+
 class WSGIRequestHandler(BaseHTTPRequestHandler, object):
     """A request handler that implements WSGI dispatching."""
 
-    @property
-    def server_version(self):
-        return 'verktyg-server/' + __version__
+    #: Chunks of a response body that are already in memory when the
+    #: application returns are held back and sent together until at least
+    #: this many bytes are waiting.
+    response_buffer_size = 65536
 
-    def make_environ(self):
-        request_url = urllib.parse.urlparse(self.path)
+    #: Number of seconds to wait for the client to send more of a request
+    #: before giving up on the connection.  ``None`` to wait forever.
+    timeout = None
 
-        if request_url.scheme:
-            url_scheme = request_url.scheme
-        elif isinstance(self.server.socket, ssl.SSLSocket):
-            url_scheme = 'https'
-        else:
-            url_scheme = 'http'
+    #: Number of seconds to wait for the client to accept more of a response
+    #: before giving up on the connection.  ``None`` to wait forever.
+    write_timeout = None
 
-        path = urllib.parse.unquote_to_bytes(
-            request_url.path
-        ).decode('iso-8859-1')
+    #: Number of seconds to wait for the next request on a keep-alive
+    #: connection before closing it.
+    keep_alive_timeout = 5
+
+    #: Maximum number of requests to handle on a single keep-alive
+    #: connection before asking the client to open a new one.  ``None`` for
+    #: no limit.
+    max_keep_alive_requests = 1000
+
+    #: Maximum number of bytes to receive from the client at once.
+    request_buffer_size = 65536
+
+    #: Maximum size in bytes of the headers of a request, not including the
+    #: request line.
+    max_head_size = 65536
 
-        environ = {
+    #: Maximum number of headers in a single request.
+    max_headers = 100
+
+    #: If more than this many bytes of a request body are left unread by the
+    #: application, the connection will be closed instead of reading them.
+    max_discard_size = 262144
+
+    #: Number of seconds to allow a client to complete the TLS handshake.
+    handshake_timeout = 10
+
+    # Cleared by the event loop server, which owns the socket.  Its handlers
+    # must only write to the connection through `wfile`, and must not change
+    # the socket's timeout.
+    _owns_socket = True
+
+    # Set by servers that queue connections for a pool of worker threads to
+    # when the connection was queued, so that the time spent waiting for a
+    # worker is included in the timings of the request that follows.
+    _queued = None
+
+    @property
+    def server_version(self):
+        return 'verktyg-server/' + __version__
+
+    @property
+    def protocol_version(self):
+        # Keeping a connection open ties up whatever is handling it, which
+        # is only acceptable if there is something else to handle requests
+        # from other clients in the meantime.
+        if self.server.multithread:
+            return 'HTTP/1.1'
+        return 'HTTP/1.0'
+
+    def _url_scheme(self):
+        # A server can listen on several sockets, not all of which need be
+        # encrypted.
+        if isinstance(self.request, (ssl.SSLSocket, ssl.SSLObject)):
+            return 'https'
+        return 'http'
+
+    def _make_environ_template(self, url_scheme):
+        return {
             'wsgi.version':         (1, 0),
             'wsgi.url_scheme':      url_scheme,
-            'wsgi.input':           self.rfile,
             'wsgi.errors':          sys.stderr,
             'wsgi.multithread':     self.server.multithread,
             'wsgi.multiprocess':    self.server.multiprocess,
             'wsgi.run_once':        False,
+            'wsgi.file_wrapper':    FileWrapper,
             'verktyg.server.shutdown': self.server.shutdown,
+            'verktyg.server.drain': self.server.start_drain,
             'SERVER_SOFTWARE':      self.server_version,
-            'REQUEST_METHOD':       self.command,
             'SCRIPT_NAME':          '',
-            'PATH_INFO':            path,
-            'QUERY_STRING':         request_url.query,
-            'CONTENT_TYPE':         self.headers.get('Content-Type', ''),
-            'CONTENT_LENGTH':       self.headers.get('Content-Length', ''),
-            'REMOTE_ADDR':          self.client_address[0],
-            'REMOTE_PORT':          self.client_address[1],
+            'CONTENT_TYPE':         '',
+            'CONTENT_LENGTH':       '',
             'SERVER_NAME':          self.server.server_address[0],
             'SERVER_PORT':          str(self.server.server_address[1]),
-            'SERVER_PROTOCOL':      self.request_version
         }
 
-        for key, value in self.headers.items():
-            key = 'HTTP_' + key.upper().replace('-', '_')
-            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
-                environ[key] = value
+    def make_input(self):
+        """Returns a file-like object from which the body of the current
+        request can be read, and which will not read past the end of it.
+        """
+        if 'Transfer-Encoding' in self.headers:
+            # `parse_request` has already checked that chunked is the final
+            # coding.
+            return ChunkedInput(self.rfile)
+
+        # `parse_headers` has already checked that the length is a plain
+        # decimal number.
+        length = int(self.headers.get('Content-Length') or 0)
+        return LimitedInput(self.rfile, length)
 
-        if request_url.netloc:
-            environ['HTTP_HOST'] = request_url.netloc
+    def make_environ(self):
+        # Entries that are the same for every request are only calculated
+        # once per server and url scheme.
+        url_scheme = self._url_scheme()
+        template = self.server._environ_templates.get(url_scheme)
+        if template is None:
+            template = self._make_environ_template(url_scheme)
+            self.server._environ_templates[url_scheme] = template
+        environ = template.copy()
+
+        path = self.path
+        netloc = None
+        if path[:1] == '/':
+            # Origin form.  By far the most common case, and simple enough
+            # that we don't need to do a full parse.
+            path, _, query = path.partition('?')
+        else:
+            request_url = urllib.parse.urlsplit(path)
+            if request_url.scheme:
+                environ['wsgi.url_scheme'] = request_url.scheme
+            netloc = request_url.netloc
+            path = request_url.path
+            query = request_url.query
+
+        if '%' in path:
+            path = urllib.parse.unquote(path, 'iso-8859-1')
+
+        environ['wsgi.input'] = self._request_body = self.make_input()
+        if isinstance(self._request_body, ChunkedInput):
+            environ['wsgi.input_terminated'] = True
+        environ['REQUEST_METHOD'] = self.command
+        environ['PATH_INFO'] = path
+        environ['QUERY_STRING'] = query
+        environ['REMOTE_ADDR'] = self.client_address[0]
+        environ['REMOTE_PORT'] = self.client_address[1]
+        environ['SERVER_PROTOCOL'] = self.request_version
+
+        environ.update(self.headers.environ)
+
+        if netloc:
+            environ['HTTP_HOST'] = netloc
 
         if hasattr(self.request, 'getpeercert'):
             environ['REMOTE_CERT'] = self.request.getpeercert(binary_form=True)
@@ -91,7 +243,15 @@ class WSGIRequestHandler(BaseHTTPRequestHandler, object):
         headers_set = []
         headers_sent = []
 
-        def write(data):
+        self._response_buffer = []
+        self._response_buffer_size = 0
+        self._response_started = False
+        self._response_chunked = False
+        self._bytes_sent = 0
+        self._first_byte_time = None
+        self._application_time = 0.0
+
+        def write(data, flush=True):
             assert headers_set, 'write() before start_response'
             if not headers_sent:
                 status, response_headers = headers_sent[:] = headers_set
@@ -99,24 +259,61 @@ class WSGIRequestHandler(BaseHTTPRequestHandler, object):
                     code, msg = status.split(None, 1)
                 except ValueError:
                     code, msg = status, ""
-                self.send_response(int(code), msg)
+                self.send_response_only(int(code), msg)
                 header_keys = set()
                 for key, value in response_headers:
                     self.send_header(key, value)
                     key = key.lower()
                     header_keys.add(key)
-                if 'content-length' not in header_keys:
+                if 'content-length' in header_keys:
+                    pass
+                elif code[:1] == '1' or code in ('204', '304'):
+                    # Responses that never have a body.
+                    pass
+                elif (
+                    self.request_version not in ('HTTP/0.9', 'HTTP/1.0') and
+                    self.protocol_version == 'HTTP/1.1' and
+                    self.command != 'HEAD' and
+                    'transfer-encoding' not in header_keys
+                ):
+                    self._response_chunked = True
+                    self.send_header('Transfer-Encoding', 'chunked')
+                else:
+                    self.close_connection = True
+                    self.send_header('Connection', 'close')
+                if not self.close_connection and (
+                    self.server._closing or self._is_last_request()
+                ):
+                    # Either the server is draining, or this connection has
+                    # handled its share of requests.  Ask the client not to
+                    # send any more requests on it.
                     self.close_connection = True
                     self.send_header('Connection', 'close')
                 if 'server' not in header_keys:
                     self.send_header('Server', self.version_string())
                 if 'date' not in header_keys:
                     self.send_header('Date', self.date_time_string())
-                self.end_headers()
+
+                # The head is sent along with the first chunk of the body.
+                if self.request_version != 'HTTP/0.9':
+                    self._headers_buffer.append(b"\r\n")
+                    self._buffer_response(b"".join(self._headers_buffer))
+                    self._headers_buffer = []
 
             assert isinstance(data, bytes), 'applications must write bytes'
-            self.wfile.write(data)
-            self.wfile.flush()
+            if self.command == 'HEAD':
+                # The client isn't expecting a body, and would take anything
+                # we sent as the start of the next response.
+                pass
+            elif self._response_chunked:
+                if data:
+                    self._buffer_response(
+                        b"%x\r\n" % len(data), data, b"\r\n",
+                    )
+            else:
+                self._buffer_response(data)
+            if flush:
+                self._flush_response()
 
         def start_response(status, response_headers, exc_info=None):
             if exc_info:
@@ -133,21 +330,133 @@ class WSGIRequestHandler(BaseHTTPRequestHandler, object):
             headers_set[:] = [status, response_headers]
             return write
 
+        def send_file(wrapper):
+            """Sends the contents of a regular file without copying it into
+            python.  Returns ``False`` if the file cannot be sent this way.
+            """
+            if not headers_set or headers_sent:
+                return False
+            try:
+                fileno = wrapper.filelike.fileno()
+                offset = wrapper.filelike.tell()
+                file_stat = os.fstat(fileno)
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                return False
+            if not stat.S_ISREG(file_stat.st_mode):
+                return False
+            size = max(file_stat.st_size - offset, 0)
+
+            status, response_headers = headers_set
+            length = None
+            for key, value in response_headers:
+                if key.lower() == 'content-length':
+                    try:
+                        length = int(value)
+                    except ValueError:
+                        return False
+            if length is None:
+                length = size
+                headers_set[1] = list(response_headers) + [
+                    ('Content-Length', str(length)),
+                ]
+
+            write(b'', False)
+            if self.command == 'HEAD':
+                return True
+
+            count = min(length, size)
+            if count < length:
+                # We will not be able to send as much as we promised.
+                self.close_connection = True
+            if not count:
+                return True
+
+            sock = self._plain_socket()
+            if sock is not None:
+                self._flush_response()
+                self._set_write_timeout(self.write_timeout)
+                try:
+                    self._bytes_sent += sock.sendfile(
+                        wrapper.filelike, offset, count
+                    )
+                finally:
+                    self._set_write_timeout(self.timeout)
+                return True
+
+            # SSL sockets need the data to be passed through python to be
+            # encrypted, but we can at least avoid reading it into new bytes
+            # objects.  The mapping is released once the last view of it is
+            # garbage collected.
+            view = memoryview(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+            block_size = self.response_buffer_size
+            for start in range(offset, offset + count, block_size):
+                end = min(start + block_size, offset + count)
+                self._buffer_response(view[start:end])
+            self._flush_response()
+            return True
+
         def execute(app):
-            application_iter = app(environ, start_response)
+            started = time.monotonic()
             try:
-                for data in application_iter:
-                    write(data)
+                application_iter = app(environ, start_response)
+            finally:
+                self._application_time += time.monotonic() - started
+            try:
+                if isinstance(application_iter, FileWrapper):
+                    if send_file(application_iter):
+                        self._flush_response()
+                        return
+
+                # If the application has returned a list then the entire body
+                # is already available, and there is no reason not to hold on
+                # to small chunks until they can be sent together.  Anything
+                # else could be a stream that expects each chunk to be sent
+                # as soon as it is yielded.
+                flush = not isinstance(application_iter, (list, tuple))
+                chunks = iter(application_iter)
+                while True:
+                    # Time spent writing is excluded from the time spent in
+                    # the application.
+                    started = time.monotonic()
+                    try:
+                        data = next(chunks)
+                    except StopIteration:
+                        break
+                    finally:
+                        self._application_time += time.monotonic() - started
+                    write(data, flush)
                 if not headers_sent:
-                    write(b'')
+                    write(b'', False)
+                if self._response_chunked:
+                    self._buffer_response(b"0\r\n\r\n")
+                self._flush_response()
             finally:
                 if hasattr(application_iter, 'close'):
                     application_iter.close()
                 application_iter = None
 
+        app = self.server.app
+        if environ['PATH_INFO'] == self.server.metrics_path:
+            app = self.server.metrics.application
+        else:
+            if self.server.compression is not None:
+                app = functools.partial(self.server.compression.serve, app)
+            if self.server.response_cache is not None:
+                app = functools.partial(self.server.response_cache.serve, app)
+
+        metrics = self.server.metrics
+        metrics.request_started()
         try:
-            execute(self.server.app)
+            execute(app)
+        except MalformedBodyError:
+            # There's no telling where the next request would start.
+            self.close_connection = True
+            if not self._response_started:
+                self._response_buffer = []
+                self._response_buffer_size = 0
+                self.send_error(400, "Bad request body")
         except (socket.error, socket.timeout) as e:
+            self.close_connection = True
             self.connection_dropped(e, environ)
         except Exception as e:
             if self.server.passthrough_errors:
@@ -156,11 +465,122 @@ class WSGIRequestHandler(BaseHTTPRequestHandler, object):
             try:
                 # if we haven't yet sent the headers but they are set
                 # we roll back to be able to set them again.
+                if not self._response_started:
+                    del headers_sent[:]
+                    self._response_buffer = []
+                    self._response_buffer_size = 0
                 if not headers_sent:
                     del headers_set[:]
                 execute(self.render_error)
             except Exception:
+                self.close_connection = True
                 self.logger.exception("error recovering from failed response")
+        finally:
+            self._record_request(metrics, headers_sent)
+
+        if not self.close_connection:
+            # Any part of the request body that the application didn't read
+            # needs to be skipped over before the next request can be read.
+            # If there is a lot left, it is cheaper to close the connection.
+            try:
+                if not self._request_body.discard(self.max_discard_size):
+                    self.close_connection = True
+            except (socket.error, socket.timeout) as e:
+                self.close_connection = True
+                self.connection_dropped(e, environ)
+
+    def _record_request(self, metrics, headers_sent):
+        finished = time.monotonic()
+
+        status = None
+        if headers_sent and self._response_started:
+            status = int(headers_sent[0].split(None, 1)[0])
+
+        first_byte = None
+        if self._first_byte_time is not None:
+            first_byte = self._first_byte_time - self._request_start
+
+        bytes_in = getattr(self._request_body, 'bytes_read', 0)
+
+        metrics.request_finished(
+            status, bytes_in=bytes_in, bytes_out=self._bytes_sent,
+            first_byte=first_byte, application=self._application_time,
+            total=finished - self._request_start,
+        )
+
+        self.log_request(status or '-', self._bytes_sent)
+
+    def _buffer_response(self, *buffers):
+        for data in buffers:
+            if data:
+                self._response_buffer.append(data)
+                self._response_buffer_size += len(data)
+        if self._response_buffer_size >= self.response_buffer_size:
+            self._flush_response()
+
+    def _flush_response(self):
+        if not self._response_buffer:
+            return
+        if not self._response_started:
+            self._response_started = True
+            self._first_byte_time = time.monotonic()
+        buffers = self._response_buffer
+        self._response_buffer = []
+        self._response_buffer_size = 0
+        self._writev(buffers)
+
+    def _writev(self, buffers):
+        """Writes a list of buffers to the client using as few system calls
+        as possible.
+        """
+        for buffer in buffers:
+            self._bytes_sent += len(buffer)
+
+        self._set_write_timeout(self.write_timeout)
+        try:
+            sock = self._plain_socket()
+            if sock is None or not hasattr(sock, 'sendmsg'):
+                # SSL sockets, and anything else that is not a plain socket,
+                # have to be written to through `wfile`.
+                if len(buffers) == 1:
+                    self.wfile.write(buffers[0])
+                else:
+                    self.wfile.write(b"".join(buffers))
+                self.wfile.flush()
+                return
+
+            buffers = [memoryview(buffer) for buffer in buffers]
+            while buffers:
+                sent = sock.sendmsg(buffers[:_IOV_MAX])
+                while sent:
+                    if sent >= len(buffers[0]):
+                        sent -= len(buffers.pop(0))
+                    else:
+                        buffers[0] = buffers[0][sent:]
+                        sent = 0
+        finally:
+            self._set_write_timeout(self.timeout)
+
+    def _plain_socket(self):
+        # Returns the connection's socket if it is safe to write to it
+        # directly, or `None` if everything has to go through `wfile`.
+        sock = self.request
+        if self._owns_socket and type(sock) is socket.socket:
+            return sock
+        return None
+
+    def _set_write_timeout(self, timeout):
+        # Sockets only have a single timeout, so it has to be switched while
+        # writing.  The event loop server doesn't use socket timeouts.
+        if self.write_timeout != self.timeout and self._owns_socket:
+            if isinstance(self.request, socket.socket):
+                self.request.settimeout(timeout)
+
+    def _is_last_request(self):
+        return (
+            self.max_keep_alive_requests is not None and
+            self._request_count >= self.max_keep_alive_requests
+        )
 
     def render_error(self, environ, start_response):
         status = '500 Internal Server Error'
@@ -168,10 +588,25 @@ class WSGIRequestHandler(BaseHTTPRequestHandler, object):
         start_response(status, headers)
         return [b"<h1>Internal Server Error</h1>"]
 
+    def do_handshake(self):
+        """Performs the TLS handshake for a new connection.
+
+        Listening sockets are wrapped so that accepting a connection does not
+        perform the handshake, which would hold up the accept loop for as
+        long as the client took to respond.  Instead it is done here, by
+        whatever is handling the connection.
+        """
+        self.connection.settimeout(self.handshake_timeout)
+        self.connection.do_handshake()
+        self.connection.settimeout(self.timeout)
+
     def handle(self):
         """Handles a request ignoring dropped connections."""
         rv = None
         try:
+            if isinstance(self.connection, ssl.SSLSocket):
+                if not self._resumed:
+                    self.do_handshake()
             rv = BaseHTTPRequestHandler.handle(self)
         except (socket.error, socket.timeout, ssl.SSLError) as e:
             self.connection_dropped(e)
@@ -182,10 +617,185 @@ class WSGIRequestHandler(BaseHTTPRequestHandler, object):
         nothing happens.
         """
 
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+
+        # Unlike the reader returned by `makefile`, this one can tell us if
+        # the next request has already been received.
+        self.rfile.close()
+        self.rfile = SocketReader(self.connection, self.request_buffer_size)
+
+        self._request_count = 0
+        self._parked = False
+        self._resumed = False
+
+        # The first request on a connection is timed from when the
+        # connection was set up, so that it includes the time taken for the
+        # client to send the request.
+        self._request_start = time.monotonic()
+        self.server.metrics.connection_opened()
+        self.server._connection_opened(self.connection)
+
+    def finish(self):
+        if self._parked:
+            # The connection is being handed back to the server to wait for
+            # the next request.
+            return
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        finally:
+            self.server._connection_closed(self.connection)
+            self.server.metrics.connection_closed()
+
+    def resume(self):
+        """Continues handling a keep-alive connection that was handed back
+        to the server while it was idle, once the client has sent the next
+        request.
+        """
+        self._parked = False
+        self._resumed = True
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def _can_park(self):
+        if not self.server._parks_idle_connections:
+            return False
+        # Data that has already been decrypted isn't visible to the server's
+        # selector.
+        if isinstance(self.connection, ssl.SSLSocket):
+            return not self.connection.pending()
+        return True
+
+    def _read_requestline(self):
+        if not self._request_count or self._resumed or self.rfile.buffered:
+            # Either this is the first request, or the client is known to
+            # have sent the next one.  Pipelined requests will already be in
+            # the buffer, and can be read without any extra system calls.
+            self._resumed = False
+            return self.rfile.readline(65537)
+
+        # Waiting for the next request on a keep-alive connection.
+        if not self.server._connection_idle(self.connection):
+            # The server is shutting down.
+            return b''
+
+        if self._can_park():
+            # Rather than tie up a thread waiting for the client, return
+            # the connection to the server, which will hand it to a worker
+            # again once the next request arrives.
+            self._parked = True
+            return b''
+
+        self.connection.settimeout(self.keep_alive_timeout)
+        try:
+            return self.rfile.readline(65537)
+        except socket.timeout:
+            return b''
+        finally:
+            self.server._connection_busy(self.connection)
+            self.connection.settimeout(self.timeout)
+
+    def _read_head(self):
+        limit = self.max_head_size + 1
+        readhead = getattr(self.rfile, 'readhead', None)
+        if readhead is not None:
+            return readhead(limit)
+
+        # Streams other than `SocketReader`, such as the one used by the
+        # asyncio server, have to be read line by line.
+        lines = []
+        size = 0
+        while size < limit:
+            line = self.rfile.readline(limit - size)
+            lines.append(line)
+            size += len(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        return b''.join(lines)
+
+    def parse_request(self):
+        """Parses the request line and headers of the current request.
+
+        Replaces :meth:`BaseHTTPRequestHandler.parse_request`, which decodes
+        each header line separately and then builds an email message from
+        them, with a single pass over the raw header block that also
+        produces the environ entries for the headers.  If the request is
+        malformed, an error is sent and ``False`` returned.
+        """
+        self.command = None
+        self.request_version = self.default_request_version
+        self.close_connection = True
+        self.requestline = self.raw_requestline.rstrip(
+            b'\r\n'
+        ).decode('iso-8859-1')
+
+        try:
+            request = parse_request_line(self.raw_requestline)
+            if request is None:
+                return False
+            self.command, self.path, self.request_version = request
+
+            head = self._read_head()
+            if len(head) > self.max_head_size:
+                raise RequestHeadError(431, "Line too long")
+            self.headers = parse_headers(head, max_headers=self.max_headers)
+
+            transfer_encoding = self.headers.get_all('Transfer-Encoding')
+            if transfer_encoding:
+                # Without chunked as the final coding, the end of the body
+                # can't be found other than by the client closing the
+                # connection, which a proxy in front of us may not agree
+                # with.
+                codings = ','.join(transfer_encoding).split(',')
+                if codings[-1].strip().lower() != 'chunked':
+                    raise RequestHeadError(400, "Bad Transfer-Encoding")
+                # A proxy that prefers the length to the coding would see a
+                # different request boundary to us.
+                if 'Content-Length' in self.headers:
+                    raise RequestHeadError(
+                        400, "Transfer-Encoding with Content-Length",
+                    )
+        except RequestHeadError as e:
+            self.send_error(e.status, e.message)
+            return False
+
+        if (
+                self.request_version not in ('HTTP/0.9', 'HTTP/1.0') and
+                self.protocol_version >= 'HTTP/1.1'
+                ):
+            self.close_connection = False
+
+        connection = self.headers.get('Connection', '').lower()
+        if connection == 'close':
+            self.close_connection = True
+        elif (
+                connection == 'keep-alive' and
+                self.protocol_version >= 'HTTP/1.1'
+                ):
+            self.close_connection = False
+        return True
+
     def handle_one_request(self):
         """Handle a single HTTP request."""
-        self.raw_requestline = self.rfile.readline()
-        if not self.raw_requestline:
+        self.raw_requestline = self._read_requestline()
+        if self._parked:
+            # Handed back to the server to wait for the next request, which
+            # will be counted once the connection is resumed.
+            self.close_connection = True
+            return
+        if self._queued is not None:
+            self._request_start, self._queued = self._queued, None
+        elif self._request_count:
+            self._request_start = time.monotonic()
+        self._request_count += 1
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+        elif not self.raw_requestline:
             self.close_connection = 1
         elif self.parse_request():
             return self.run_wsgi()
@@ -193,11 +803,19 @@ class WSGIRequestHandler(BaseHTTPRequestHandler, object):
     def send_response(self, code, message=None):
         """Send the response header and log the response code."""
         self.log_request(code)
+        self.send_response_only(code, message)
+
+    def send_response_only(self, code, message=None):
+        """Send the response header only.  Responses from the application are
+        logged once they have been sent.
+        """
         if message is None:
             message = code in self.responses and self.responses[code][0] or ''
         if self.request_version != 'HTTP/0.9':
             hdr = "%s %d %s\r\n" % (self.protocol_version, code, message)
-            self.wfile.write(hdr.encode('ascii'))
+            if not hasattr(self, '_headers_buffer'):
+                self._headers_buffer = []
+            self._headers_buffer.append(hdr.encode('ascii'))
 
     def version_string(self):
         return BaseHTTPRequestHandler.version_string(self).strip()
@@ -206,7 +824,23 @@ class WSGIRequestHandler(BaseHTTPRequestHandler, object):
         return self.environ['REMOTE_ADDR']
 
     def log_request(self, code='-', size='-'):
-        self.logger.info('%r %s %s', self.requestline, code, size)
+        access_log = self.server.access_log
+        if access_log is None:
+            self.logger.info('%r %s %s', self.requestline, code, size)
+            return
+
+        # Only the bare minimum of work is done here.  Formatting happens
+        # in the access log's writer thread.
+        access_log.log(AccessLogRecord(
+            time=time.time(),
+            remote_addr=self.client_address[0] or None,
+            method=self.command or None,
+            path=getattr(self, 'path', None),
+            protocol=self.request_version or None,
+            status=None if code == '-' else int(code),
+            size=None if size == '-' else size,
+            duration=time.monotonic() - self._request_start,
+        ))
 
     def log_error(self, *args):
         self.logger.error(format, *args)
@@ -225,9 +859,28 @@ class BaseWSGIServer(HTTPServer, object):
     multiprocess = False
     request_queue_size = 128
 
+    #: Default number of seconds that :meth:`drain` will wait for requests
+    #: in progress to finish before closing their connections.
+    drain_timeout = 30
+
+    #: Default number of seconds that :meth:`reexec` will wait for the new
+    #: process to report that it is ready.
+    reexec_timeout = 30
+
+    #: Maximum number of connections accepted from a listening socket each
+    #: time the accept loop wakes up.
+    accept_batch_size = 64
+
+    # Set by servers that can take idle keep-alive connections back from
+    # their request handlers.
+    _parks_idle_connections = False
+
     def __init__(
                 self, socket, app, *, handler=None,
-                passthrough_errors=False, logger=None
+                passthrough_errors=False, logger=None, metrics_path=None,
+                access_log=None, socket_options=None, response_cache=None,
+                compression=None, max_in_flight=None, max_queue_wait=None,
+                retry_after=1
             ):
         if logger is None:
             logger = 'verktyg-server'
@@ -238,7 +891,20 @@ class BaseWSGIServer(HTTPServer, object):
         if handler is None:
             handler = WSGIRequestHandler
 
-        self.socket = socket
+        if isinstance(socket, (list, tuple)):
+            sockets = list(socket)
+        else:
+            sockets = [socket]
+        if not sockets:
+            raise ValueError("server must listen on at least one socket")
+
+        #: All of the sockets that the server is listening on.  The first
+        #: is also available as :attr:`socket`, and is the one that
+        #: :attr:`server_address` refers to.
+        self.sockets = sockets
+        self._listeners = None
+
+        self.socket = sockets[0]
         server_address = self.socket.getsockname()
         socketserver.BaseServer.__init__(self, server_address, handler)
 
@@ -249,16 +915,514 @@ class BaseWSGIServer(HTTPServer, object):
         self.app = app
         self.passthrough_errors = passthrough_errors
 
+        #: A :class:`~verktyg_server.metrics.ServerMetrics` instance
+        #: collecting statistics about the requests handled by this server.
+        ssl_context = None
+        for sock in sockets:
+            if isinstance(sock, ssl.SSLSocket):
+                ssl_context = sock.context
+                break
+        self.metrics = ServerMetrics(
+            ssl_context=ssl_context, response_cache=response_cache,
+            compression=compression,
+        )
+
+        #: If set, requests for this path will be answered with the current
+        #: metrics in the Prometheus text format instead of being passed to
+        #: the application.
+        self.metrics_path = metrics_path
+
+        #: An optional :class:`~verktyg_server.accesslog.AccessLog` to record
+        #: requests to.  If not set, requests will be logged synchronously to
+        #: `logger`.
+        self.access_log = access_log
+
+        #: An optional :class:`~verktyg_server.cache.ResponseCache` used to
+        #: answer requests without calling the application.
+        self.response_cache = response_cache
+
+        #: An optional
+        #: :class:`~verktyg_server.compression.ResponseCompression` used to
+        #: compress responses.  Applied inside the response cache, so that
+        #: compressed variants are cached as well.
+        self.compression = compression
+
+        #: The :class:`~verktyg_server.sockopts.SocketOptions` applied to
+        #: each accepted connection.
+        if socket_options is None:
+            socket_options = SocketOptions()
+        self.socket_options = socket_options
+
+        #: If set, new requests that arrive while this many are already
+        #: being handled will be answered immediately with a ``503 Service
+        #: Unavailable`` instead of being passed to the application.
+        #: Requests waiting for a worker thread count as being handled, but
+        #: idle keep-alive connections do not.
+        self.max_in_flight = max_in_flight
+
+        #: If set, requests that have waited for longer than this many
+        #: seconds for a worker thread to become free will be answered with a
+        #: ``503 Service Unavailable`` instead.  Only applies to servers that
+        #: queue requests for a pool of worker threads.
+        self.max_queue_wait = max_queue_wait
+
+        #: Number of seconds that clients are asked to wait, using the
+        #: ``Retry-After`` header, before retrying a request that was turned
+        #: away.
+        self.retry_after = retry_after
+        self._shed_response = _shed_response(retry_after)
+
+        self._environ_templates = {}
+
+        self._closing = False
+        self._connections = set()
+        self._idle_connections = set()
+        self._connections_lock = threading.Condition()
+
+        self._drainer = None
+        self._reexecer = None
+
+        self._stopping = False
+        self._stopped = threading.Event()
+        self._waker = None
+        self._overflow_logged = None
+
     def log(self, type, message, *args):
         log.log(type, message, *args)
 
-    def serve_forever(self):
+    def serve_forever(self, poll_interval=0.5):
+        """Handles requests until :meth:`shutdown` is called.
+
+        A single selector waits on every listening socket, along with a
+        socket that :meth:`shutdown` writes to so that the loop stops
+        immediately.  `poll_interval` only controls how often
+        :meth:`service_actions` is called while the server is idle.
+        """
+        self._stopped.clear()
         try:
-            HTTPServer.serve_forever(self)
+            selector = self._selector()
+            while not self._stopping:
+                events = selector.select(poll_interval)
+                if self._stopping:
+                    break
+                self._handle_events(events)
+                self.service_actions()
         except KeyboardInterrupt:
             pass
         finally:
+            self._stopping = False
+            self._stopped.set()
             self.server_close()
+            self._flush_access_log()
+
+    def shutdown(self):
+        """Stops the :meth:`serve_forever` loop and waits for it to exit.
+        Must be called from a different thread.
+        """
+        self._stopping = True
+        self._wake()
+        self._stopped.wait()
+
+    def _wake(self):
+        waker = self._waker
+        if waker is None:
+            return
+        try:
+            waker[1].send(b'\0')
+        except OSError:
+            # Either the loop already has a wake up pending, or it has
+            # already exited and closed the socket.
+            pass
+
+    def _clear_wake(self):
+        try:
+            while self._waker[0].recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def _handle_request_noblock(self):
+        # Called by `handle_request` once there is something to do.
+        self._handle_events(self._selector().select(0))
+
+    def _handle_events(self, events):
+        for key, mask in events:
+            if key.data is None:
+                self._accept_batch(key.fileobj)
+            elif key.data is _WAKE:
+                self._clear_wake()
+            else:
+                self._handle_parked(key.fileobj)
+
+    def _handle_parked(self, connection):
+        # Only servers that park idle connections register anything other
+        # than listening sockets with the selector.
+        raise NotImplementedError()
+
+    def _accept_batch(self, listener):
+        limit = self.accept_batch_size
+        queue = accept_queue(listener)
+        if queue is not None:
+            # Knowing how many connections are waiting saves the accept
+            # call that would otherwise fail once the queue was empty.
+            length, maximum = queue
+            if maximum and length >= maximum:
+                self._accept_queue_overflowed(listener)
+            limit = min(limit, length)
+
+        for n in range(limit):
+            if not self._handle_accept(listener):
+                break
+
+    def _accept_queue_overflowed(self, listener):
+        self.metrics.accept_queue_overflowed()
+        now = time.monotonic()
+        if self._overflow_logged is None or now - self._overflow_logged > 60:
+            self._overflow_logged = now
+            self.logger.warning(
+                "accept queue for %s is full, new connections are being "
+                "dropped", listener.getsockname(),
+            )
+
+    def _handle_accept(self, listener):
+        # Mirrors `BaseServer._handle_request_noblock`.  Returns `False` once
+        # there are no more connections waiting.
+        try:
+            request, client_address = self.get_request(listener)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        if self._overloaded():
+            self._shed(request, 'in_flight')
+            self.shutdown_request(request)
+        elif self.verify_request(request, client_address):
+            try:
+                self.process_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+            except BaseException:
+                self.shutdown_request(request)
+                raise
+        else:
+            self.shutdown_request(request)
+        return True
+
+    def _in_flight(self):
+        # The number of requests that have been accepted but not yet
+        # finished.  Requests are handled one at a time by the accept loop,
+        # so there are never any while it is running.
+        return 0
+
+    def _overloaded(self):
+        return (
+            self.max_in_flight is not None and
+            self._in_flight() >= self.max_in_flight
+        )
+
+    def _waited_too_long(self, queued):
+        return (
+            self.max_queue_wait is not None and
+            time.monotonic() - queued > self.max_queue_wait
+        )
+
+    def _shed(self, connection, reason):
+        """Sends the pre-serialized ``503`` response on a connection that the
+        server is too busy to handle.  The caller is responsible for closing
+        the connection afterwards.
+        """
+        self.metrics.request_shed(reason)
+
+        if isinstance(connection, ssl.SSLSocket):
+            if connection.version() is None:
+                # Responding would mean completing the handshake, which is
+                # the kind of work that shedding is meant to avoid.
+                return
+
+        try:
+            connection.setblocking(False)
+            # Discard whatever part of the request has already arrived, as
+            # closing a socket with unread data resets the connection,
+            # which can lose the response before the client has read it.
+            try:
+                for n in range(16):
+                    if not connection.recv(65536):
+                        break
+            except OSError:
+                pass
+            connection.send(self._shed_response)
+        except OSError:
+            pass
+
+    def _flush_access_log(self):
+        if self.access_log is not None:
+            self.access_log.flush()
+
+    def _connection_opened(self, connection):
+        with self._connections_lock:
+            self._connections.add(connection)
+
+    def _connection_closed(self, connection):
+        with self._connections_lock:
+            self._connections.discard(connection)
+            self._idle_connections.discard(connection)
+            self._connections_lock.notify_all()
+
+    def _connection_idle(self, connection):
+        """Called by request handlers when they start waiting for a new
+        request on a keep-alive connection.  Returns ``False`` if the
+        connection should be closed instead.
+        """
+        with self._connections_lock:
+            if self._closing:
+                return False
+            self._idle_connections.add(connection)
+            return True
+
+    def _connection_busy(self, connection):
+        with self._connections_lock:
+            self._idle_connections.discard(connection)
+
+    def _shutdown_connections(self, connections):
+        for connection in connections:
+            try:
+                # Bypass `SSLSocket.shutdown`, which would pull the SSL
+                # object out from under the handler that is using it.
+                socket.socket.shutdown(connection, socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _close_idle_connections(self):
+        with self._connections_lock:
+            self._closing = True
+            self._shutdown_connections(self._idle_connections)
+
+    def _wait_for_connections(self, deadline):
+        """Waits until every open connection has been closed, or until the
+        `deadline` has passed, in which case any remaining connections will
+        be forcibly shut down.
+        """
+        with self._connections_lock:
+            while self._connections:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                self._connections_lock.wait(remaining)
+
+            if self._connections:
+                self.logger.warning(
+                    "closing %d connections that did not finish in time",
+                    len(self._connections),
+                )
+                self._shutdown_connections(self._connections)
+
+    def _completed_requests(self):
+        return self.metrics.snapshot()['requests']
+
+    def _drain(self, deadline):
+        # Stop the accept loop without waiting for it, as it may be stuck
+        # handling a request that will need to be cut off.
+        stopper = threading.Thread(
+            target=self.shutdown, name='verktyg-server-shutdown',
+        )
+        stopper.start()
+
+        self._close_idle_connections()
+        self._wait_for_connections(deadline)
+        stopper.join()
+
+    def drain(self, timeout=None):
+        """Gracefully stops a running server.
+
+        The server stops accepting new connections and closes any keep-alive
+        connections that are waiting for a new request.  Requests that are
+        in progress are given until `timeout` seconds have passed to finish,
+        after which their connections are closed.
+
+        Like :meth:`shutdown`, this must be called from a different thread
+        to the one running :meth:`serve_forever`.  See :meth:`start_drain`.
+
+        :param timeout:
+            Number of seconds to wait.  Defaults to :attr:`drain_timeout`.
+
+        :returns:
+            The number of requests completed while draining.
+        """
+        if timeout is None:
+            timeout = self.drain_timeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        completed = self._completed_requests()
+        self._drain(deadline)
+        completed = self._completed_requests() - completed
+
+        self.logger.info("drained %d requests", completed)
+        return completed
+
+    def start_drain(self, timeout=None):
+        """Starts draining the server in a background thread, returning
+        immediately.  Safe to call from a request handler or a signal
+        handler.
+        """
+        if self._drainer is None:
+            self._drainer = threading.Thread(
+                target=self.drain, args=(timeout,),
+                name='verktyg-server-drain',
+            )
+            self._drainer.start()
+
+    def reexec(self, args=None, *, timeout=None):
+        """Starts a new copy of the server, handing it the listening socket,
+        and waits for it to report that it is ready to accept connections.
+
+        The new process finds the sockets using :func:`inherited_sockets`, and
+        reports that it is ready by calling :func:`notify_ready`.  Both
+        processes accept from the same socket until this one is drained, so
+        there is no point at which new connections are refused.
+
+        If the listening socket has already been handed to prefork workers
+        using ``SO_REUSEPORT``, the new process is expected to bind its own.
+
+        :param args:
+            The command line to run.  Defaults to re-running the current
+            python interpreter with the same arguments.
+        :param timeout:
+            Number of seconds to wait for the new process.  If it has not
+            reported that it is ready by then, it is killed.  Defaults to
+            :attr:`reexec_timeout`.
+
+        :return:
+            ``True`` if the new process is ready, in which case this one
+            should be drained, otherwise ``False``.
+        """
+        if args is None:
+            args = [sys.executable] + sys.argv
+        if timeout is None:
+            timeout = self.reexec_timeout
+
+        env = dict(os.environ)
+        pass_fds = []
+
+        fds = [sock.fileno() for sock in self.sockets]
+        fds = [fd for fd in fds if fd != -1]
+        if fds:
+            env[LISTEN_FD_ENV] = ','.join(str(fd) for fd in fds)
+            pass_fds.extend(fds)
+
+        ready_r, ready_w = os.pipe()
+        try:
+            env[READY_FD_ENV] = str(ready_w)
+            pass_fds.append(ready_w)
+            try:
+                process = subprocess.Popen(args, env=env, pass_fds=pass_fds)
+            finally:
+                os.close(ready_w)
+
+            # Reads will return an empty string if the new process exits
+            # without reporting that it is ready.
+            readable, _, _ = select.select([ready_r], [], [], timeout)
+            ready = bool(readable) and os.read(ready_r, 1) == b'1'
+        finally:
+            os.close(ready_r)
+
+        if not ready:
+            self.logger.error(
+                "new process %d did not become ready, continuing to serve",
+                process.pid,
+            )
+            process.kill()
+            process.wait()
+            return False
+
+        self.logger.info("new process %d is ready", process.pid)
+        return True
+
+    def _reexec_and_drain(self):
+        try:
+            if self.reexec():
+                self.drain()
+        finally:
+            self._reexecer = None
+
+    def start_reexec(self):
+        """Calls :meth:`reexec` in a background thread and, if the new
+        process becomes ready, drains this one.  Returns immediately.  Safe
+        to call from a signal handler.
+        """
+        if self._reexecer is None and self._drainer is None:
+            self._reexecer = threading.Thread(
+                target=self._reexec_and_drain,
+                name='verktyg-server-reexec',
+            )
+            self._reexecer.start()
+
+    def _on_sigterm(self, signum, frame):
+        self.start_drain()
+
+    def _on_sigusr2(self, signum, frame):
+        self.start_reexec()
+
+    def handle_signals(self):
+        """Installs a handler that will gracefully drain the server when the
+        process receives ``SIGTERM``, and one that will replace it with a new
+        process, using :meth:`start_reexec`, on ``SIGUSR2``.  Must be called
+        from the main thread.
+        """
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+        signal.signal(signal.SIGUSR2, self._on_sigusr2)
+
+    def _selector(self):
+        # Created on first use, so that prefork workers each get their own.
+        if self._listeners is None:
+            listeners = selectors.DefaultSelector()
+            for sock in self.sockets:
+                # Connections are accepted until the queue is empty, which
+                # would block forever on the last call.
+                sock.setblocking(False)
+                listeners.register(sock, selectors.EVENT_READ)
+
+            waker = socket.socketpair()
+            for sock in waker:
+                sock.setblocking(False)
+            listeners.register(waker[0], selectors.EVENT_READ, _WAKE)
+
+            self._waker = waker
+            self._listeners = listeners
+        return self._listeners
+
+    def fileno(self):
+        # Only used by `handle_request`, which waits for a single file
+        # descriptor.  The descriptor of an epoll or kqueue selector becomes
+        # readable whenever any of the sockets registered with it do.
+        selector = self._selector()
+        if not hasattr(selector, 'fileno'):
+            if len(self.sockets) == 1 and not self._parks_idle_connections:
+                return self.socket.fileno()
+            raise ValueError(
+                "handle_request is not supported with multiple sockets on "
+                "this platform"
+            )
+        return selector.fileno()
+
+    def server_close(self):
+        # Stop handlers from returning idle connections to the selector
+        # before closing it.
+        self._close_idle_connections()
+        HTTPServer.server_close(self)
+        for sock in self.sockets[1:]:
+            sock.close()
+        if self._listeners is not None:
+            self._listeners.close()
+            self._listeners = None
+        if self._waker is not None:
+            for sock in self._waker:
+                sock.close()
+            self._waker = None
 
     def handle_error(self, request, client_address):
         if self.passthrough_errors:
@@ -266,57 +1430,699 @@ class BaseWSGIServer(HTTPServer, object):
         else:
             return HTTPServer.handle_error(self, request, client_address)
 
-    def get_request(self):
-        con, info = self.socket.accept()
-        return con, info
+    def get_request(self, listener=None):
+        if listener is None:
+            listener = self.socket
+        connection, client_address = listener.accept()
+        client_address = _client_address(client_address)
+        try:
+            if _ACCEPT_INHERITS_NONBLOCKING:
+                connection.setblocking(True)
+            self.socket_options.configure_connection(connection)
+        except OSError:
+            # The client has most likely already gone away.
+            connection.close()
+            raise
+        return connection, client_address
 
 
 class ThreadedWSGIServer(socketserver.ThreadingMixIn, BaseWSGIServer):
     """A WSGI server that does threading."""
     multithread = True
 
+    _active = 0
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            self._active += 1
+        try:
+            socketserver.ThreadingMixIn.process_request(
+                self, request, client_address,
+            )
+        except BaseException:
+            with self._connections_lock:
+                self._active -= 1
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(
+                self, request, client_address,
+            )
+        finally:
+            with self._connections_lock:
+                self._active -= 1
+
+    def _in_flight(self):
+        # Each thread handles a single connection, which may be idle waiting
+        # for the client to send another request.
+        with self._connections_lock:
+            return self._active - len(self._idle_connections)
+
+
+class ThreadPoolMixIn(object):
+    """Mix-in class to handle each request using one of a fixed pool of
+    worker threads.
+
+    Accepted connections are placed on a bounded queue from which the workers
+    take them.  Once the queue is full the accept loop will block, leaving any
+    further connections waiting in the listen backlog until a worker becomes
+    free.
+
+    Newly accepted connections, and keep-alive connections that are waiting
+    for the client to send another request, are watched by the accept loop,
+    so that idle clients don't tie up worker threads.  Once the next request
+    arrives, the connection is queued for a worker.  Connections that stay
+    idle for longer than the handler's `keep_alive_timeout` are closed.
+
+    Requests queued for a worker, and requests being run by one, count
+    towards the server's `max_in_flight` limit.  Requests that wait in the
+    queue for longer than `max_queue_wait` are answered with a ``503`` by
+    the worker that eventually takes them, rather than being run.  Note that
+    the queue will still fill up and block the accept loop if
+    `max_in_flight` is greater than `threads` plus `queue_size`.
+    """
+    threads = 16
+    queue_size = None
+
+    _workers = None
+    _active = 0
+
+    _parks_idle_connections = True
+    _parked = None
+
+    def _start_workers(self):
+        queue_size = self.queue_size
+        if queue_size is None:
+            queue_size = self.threads
+
+        self._requests = queue.Queue(queue_size)
+        self._workers = []
+        for n in range(self.threads):
+            worker = threading.Thread(
+                target=self._worker,
+                name='verktyg-server-worker-%d' % n,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            queued, task, shed = item
+            if self._waited_too_long(queued):
+                shed()
+            else:
+                task(queued)
+
+    def _enqueue(self, task, shed):
+        # `task` is called with the time at which it was queued, or `shed`
+        # instead if the request waits in the queue for too long.  Either
+        # way, `_request_done` must be called once the worker has finished
+        # with the request.
+        if self._workers is None:
+            self._start_workers()
+        with self._connections_lock:
+            self._active += 1
+        self._requests.put((time.monotonic(), task, shed))
+
+    def _request_done(self):
+        with self._connections_lock:
+            self._active -= 1
+
+    def _in_flight(self):
+        with self._connections_lock:
+            return self._active
+
+    def finish_request(self, request, client_address, queued=None):
+        handler_class = self.RequestHandlerClass
+        handler = handler_class.__new__(handler_class)
+        handler._queued = queued
+        handler.__init__(request, client_address, self)
+        return handler
+
+    def _finish_handler(self, handler, request):
+        self._request_done()
+        if getattr(handler, '_parked', False):
+            self._park(handler)
+        else:
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address, queued=None):
+        """Same as in BaseServer but as a thread."""
+        handler = None
+        try:
+            handler = self.finish_request(request, client_address, queued)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self._finish_handler(handler, request)
+
+    def _resume(self, handler, queued):
+        handler._queued = queued
+        try:
+            handler.resume()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            self._finish_handler(handler, handler.request)
+
+    def process_request(self, request, client_address):
+        """Queue the request to be handled by the next free worker once the
+        client has started sending it.
+        """
+        # Until then the connection is parked like an idle keep-alive one,
+        # so that clients that connect without sending anything can't hold
+        # up every worker.
+        timeout = self.RequestHandlerClass.keep_alive_timeout
+        if not self._watch(request, (request, client_address), timeout):
+            self.shutdown_request(request)
+
+    def _process_parked_request(self, request, client_address):
+        if self._overloaded():
+            self._shed(request, 'in_flight')
+            self.shutdown_request(request)
+            return
+        self._enqueue(
+            functools.partial(
+                self.process_request_thread, request, client_address,
+            ),
+            functools.partial(self._shed_request, request),
+        )
+
+    def _shed_request(self, request):
+        self._shed(request, 'queue_wait')
+        self._finish_handler(None, request)
+
+    def _shed_parked(self, handler, reason):
+        self._shed(handler.connection, reason)
+        self._close_parked(handler)
+
+    def _shed_resumed(self, handler):
+        self._request_done()
+        self._shed_parked(handler, 'queue_wait')
+
+    def _park(self, handler):
+        # Only called once the handler has returned, so that it can't be
+        # resumed by another worker while this one is still using it.
+        if not self._watch(
+                    handler.connection, handler, handler.keep_alive_timeout,
+                ):
+            self._close_parked(handler)
+
+    def _watch(self, connection, parked, timeout):
+        # Registers `connection` with the selector until it becomes readable
+        # or `timeout` expires.  `parked` is either the handler of a
+        # keep-alive connection, or the `(request, client_address)` pair of
+        # a connection that has not been handled yet.  Returns `False` if
+        # the server is closing, in which case the caller must close the
+        # connection itself.
+        deadline = time.monotonic() + timeout
+        with self._connections_lock:
+            if self._parked is None:
+                self._parked = {}
+                self._park_deadlines = collections.deque()
+            if self._closing:
+                return False
+            self._parked[connection] = (parked, deadline)
+            self._park_deadlines.append((deadline, connection))
+            self._selector().register(
+                connection, selectors.EVENT_READ, parked,
+            )
+        return True
+
+    def _unpark(self, connection):
+        with self._connections_lock:
+            entry = self._parked.pop(connection, None)
+        if entry is None:
+            # Already closed by another thread.
+            return None
+        parked, deadline = entry
+        try:
+            self._selector().unregister(connection)
+        except (KeyError, ValueError):
+            pass
+        return parked
+
+    def _close_parked(self, handler):
+        if isinstance(handler, tuple):
+            # Never handed to a handler.
+            self.shutdown_request(handler[0])
+            return
+        handler._parked = False
+        try:
+            handler.finish()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            self.shutdown_request(handler.request)
+
+    def _handle_parked(self, connection):
+        handler = self._unpark(connection)
+        if handler is None:
+            return
+        if isinstance(handler, tuple):
+            self._process_parked_request(*handler)
+            return
+        if self._overloaded():
+            self._shed_parked(handler, 'in_flight')
+            return
+        self._connection_busy(handler.connection)
+        self._enqueue(
+            functools.partial(self._resume, handler),
+            functools.partial(self._shed_resumed, handler),
+        )
+
+    def _expire_parked(self):
+        if not self._parked:
+            return
+        now = time.monotonic()
+        expired = []
+        with self._connections_lock:
+            deadlines = self._park_deadlines
+            while deadlines and deadlines[0][0] <= now:
+                deadline, connection = deadlines.popleft()
+                entry = self._parked.get(connection)
+                # The connection may have been resumed and parked again
+                # since this deadline was set.
+                if entry is not None and entry[1] == deadline:
+                    del self._parked[connection]
+                    expired.append((connection, entry[0]))
+        for connection, handler in expired:
+            try:
+                self._selector().unregister(connection)
+            except (KeyError, ValueError):
+                pass
+            self._close_parked(handler)
+
+    def service_actions(self):
+        super(ThreadPoolMixIn, self).service_actions()
+        self._expire_parked()
+
+    def _close_idle_connections(self):
+        super(ThreadPoolMixIn, self)._close_idle_connections()
+
+        # Nothing will be waiting for parked connections to become readable
+        # once the accept loop stops.
+        with self._connections_lock:
+            parked = list(self._parked or ())
+        for connection in parked:
+            handler = self._unpark(connection)
+            if handler is not None:
+                self._close_parked(handler)
+
+    def server_close(self):
+        super(ThreadPoolMixIn, self).server_close()
+
+        if self._workers is None:
+            return
+
+        for worker in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, BaseWSGIServer):
+    """A WSGI server that handles requests using a fixed pool of threads."""
+    multithread = True
+
+    def __init__(
+                self, socket, app, *, threads=16, queue_size=None, **kwargs
+            ):
+        BaseWSGIServer.__init__(self, socket, app, **kwargs)
+        self.threads = threads
+        self.queue_size = queue_size
+
 
 class ForkingWSGIServer(socketserver.ForkingMixIn, BaseWSGIServer):
     """A WSGI server that does forking."""
     multiprocess = True
 
+    def __init__(self, socket, app, *, processes=40, **kwargs):
+        BaseWSGIServer.__init__(self, socket, app, **kwargs)
+        self.max_children = processes
+
+    _children_finished = 0
+
+    def collect_children(self, **kwargs):
+        # `blocking` is only passed, by `server_close`, on Python 3.7 and
+        # later, which is also the first version to accept it.
+        active = len(self.active_children or ())
+        if self.max_in_flight is None or kwargs.get('blocking'):
+            # Blocks until a child exits if there are already
+            # `max_children` running.
+            socketserver.ForkingMixIn.collect_children(self, **kwargs)
+        else:
+            # New connections are shed once `max_in_flight` is reached, so
+            # there is no need to wait for children to exit.
+            for pid in list(self.active_children or ()):
+                try:
+                    pid, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    pass
+                except OSError:
+                    continue
+                else:
+                    if not pid:
+                        continue
+                self.active_children.discard(pid)
+        self._children_finished += active - len(self.active_children or ())
+
+    def _in_flight(self):
+        # Each child handles a single connection.
+        self.collect_children()
+        return len(self.active_children or ())
+
+    def _completed_requests(self):
+        # Requests are counted by the child processes, which exit as soon as
+        # they have finished with their connection.
+        return self._children_finished
+
+    def _wait_for_connections(self, deadline):
+        while self.active_children:
+            if deadline is not None and time.monotonic() >= deadline:
+                self.logger.warning(
+                    "killing %d processes that did not finish in time",
+                    len(self.active_children),
+                )
+                for pid in list(self.active_children):
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                break
+            self.collect_children()
+            time.sleep(0.01)
+
+    def finish_request(self, request, client_address):
+        # Called in the child process, which exits immediately afterwards.
+        try:
+            BaseWSGIServer.finish_request(self, request, client_address)
+        finally:
+            self._flush_access_log()
+
+
+class PreforkMixIn(object):
+    """Mix-in class that forks a fixed number of long lived worker processes,
+    each of which runs its own accept loop on the listening socket.
+
+    The parent process does not handle any requests itself.  It simply
+    watches over the workers, replacing any that exit, until the server is
+    shut down.
+
+    If the listening socket was created with ``SO_REUSEPORT`` set, each worker
+    is given its own socket bound to the same address so that the kernel can
+    balance connections between them.  Otherwise all workers will accept from
+    the socket inherited from the parent.
+
+    Note that with ``SO_REUSEPORT``, connections still waiting in the backlog
+    of a worker that exits are reset.
+    """
+    workers = 4
+
+    _is_worker = False
+    _worker_pids = None
+    _stop_timeout = None
+
+    def _reuses_port(self):
+        if len(self.sockets) > 1:
+            return False
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            return False
+        if self.socket.family not in (socket.AF_INET, socket.AF_INET6):
+            return False
+        return bool(self.socket.getsockopt(
+            socket.SOL_SOCKET, socket.SO_REUSEPORT
+        ))
+
+    def _make_worker_socket(self):
+        sock = socket.socket(self.socket.family, self.socket.type)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket_options.configure_listener(sock)
+        sock.setblocking(True)
+
+        sock.bind(self.server_address)
+        sock.listen(self.request_queue_size)
+
+        if isinstance(self.socket, ssl.SSLSocket):
+            sock = _wrap_ssl(sock, self.socket.context)
+
+        return sock
+
+    def _spawn_worker(self, reuse_port):
+        worker_socket = None
+        if reuse_port and self.socket.fileno() == -1:
+            worker_socket = self._make_worker_socket()
+
+        pid = os.fork()
+        if pid:
+            if worker_socket is not None:
+                worker_socket.close()
+            elif reuse_port:
+                # The original socket now belongs to the first worker.  If
+                # the parent kept a copy, connections routed to it would
+                # never be accepted once that worker exited.
+                self.socket.close()
+            self._worker_pids.add(pid)
+            return
+
+        status = 1
+        try:
+            # The parent will send SIGTERM when it wants the worker to stop.
+            signal.signal(signal.SIGTERM, self._on_sigterm)
+            # Only the parent should start a replacement server.
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            self._is_worker = True
+            self._worker_pids = None
+            self._drainer = None
+            if worker_socket is not None:
+                self.socket.close()
+                self.socket = worker_socket
+                self.sockets = [worker_socket]
+            super(PreforkMixIn, self).serve_forever()
+            if self._drainer is not None:
+                self._drainer.join()
+            status = 0
+        except BaseException:
+            self.logger.exception("worker %d crashed", os.getpid())
+        finally:
+            os._exit(status)
+
+    def _reap_workers(self):
+        for pid in list(self._worker_pids):
+            try:
+                reaped, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                self._worker_pids.discard(pid)
+                continue
+            if reaped:
+                self._worker_pids.discard(pid)
+                if not self._prefork_shutdown.is_set():
+                    self.logger.warning(
+                        "worker %d exited with status %d, respawning",
+                        pid, status,
+                    )
+
+    def _stop_workers(self, timeout=None):
+        """Asks the workers to drain, and waits for them to exit.  Workers
+        that are still running after `timeout` seconds are killed.
+        """
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        while self._worker_pids:
+            for pid in list(self._worker_pids):
+                try:
+                    reaped, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    reaped = pid
+                if reaped:
+                    self._worker_pids.discard(pid)
+
+            if not self._worker_pids:
+                break
+
+            if deadline is not None and time.monotonic() >= deadline:
+                self.logger.warning(
+                    "killing %d workers that did not exit in time",
+                    len(self._worker_pids),
+                )
+                for pid in self._worker_pids:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                        os.waitpid(pid, 0)
+                    except (ProcessLookupError, ChildProcessError):
+                        pass
+                break
+
+            time.sleep(0.01)
+
+        self._worker_pids = set()
+
+    @property
+    def worker_pids(self):
+        """The process ids of the currently running workers."""
+        return frozenset(self._worker_pids or ())
+
+    def serve_forever(self, poll_interval=0.5):
+        """Fork the workers and then keep them running until
+        :meth:`shutdown` is called.
+        """
+        self._prefork_shutdown = threading.Event()
+        self._prefork_stopped = threading.Event()
+        self._worker_pids = set()
+
+        reuse_port = self._reuses_port()
+        try:
+            while not self._prefork_shutdown.is_set():
+                self._reap_workers()
+                while len(self._worker_pids) < self.workers:
+                    self._spawn_worker(reuse_port)
+                self._prefork_shutdown.wait(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop_workers(self._stop_timeout)
+            self.server_close()
+            self._prefork_stopped.set()
+
+    def shutdown(self):
+        """Stops the workers and waits for them to exit."""
+        if self._is_worker or self._worker_pids is None:
+            return super(PreforkMixIn, self).shutdown()
+        self._prefork_shutdown.set()
+        self._prefork_stopped.wait()
+
+    def drain(self, timeout=None):
+        """Gracefully stops the workers.
+
+        In the parent process, each worker is sent ``SIGTERM``, which causes
+        it to drain itself and exit.  Any workers that are still running
+        after `timeout` seconds are killed.  Each worker logs the number of
+        requests that it drained, but the parent has no way of knowing the
+        total, and so returns ``None``.
+        """
+        if self._is_worker or self._worker_pids is None:
+            return super(PreforkMixIn, self).drain(timeout)
+        if timeout is None:
+            timeout = self.drain_timeout
+        self._stop_timeout = timeout
+        self.shutdown()
+
+
+class PreforkWSGIServer(PreforkMixIn, BaseWSGIServer):
+    """A WSGI server that forks a fixed number of single-threaded worker
+    processes up front.
+    """
+    multiprocess = True
+
+    def __init__(self, socket, app, *, workers=4, **kwargs):
+        BaseWSGIServer.__init__(self, socket, app, **kwargs)
+        self.workers = workers
+
+
+class PreforkThreadPoolWSGIServer(
+            PreforkMixIn, ThreadPoolMixIn, BaseWSGIServer
+        ):
+    """A WSGI server that forks a fixed number of worker processes up front,
+    each of which handles requests using its own pool of threads.
+    """
+    multithread = True
+    multiprocess = True
+
     def __init__(
-                self, socket, app, *, processes=40, handler=None,
-                passthrough_errors=False
+                self, socket, app, *, workers=4, threads=16, queue_size=None,
+                **kwargs
             ):
-        BaseWSGIServer.__init__(
-            self, socket, app, handler=handler,
-            passthrough_errors=passthrough_errors
-        )
-        self.max_children = processes
+        BaseWSGIServer.__init__(self, socket, app, **kwargs)
+        self.workers = workers
+        self.threads = threads
+        self.queue_size = queue_size
 
 
 def make_server(
-            socket, app=None, *, threaded=False, processes=1,
-            request_handler=None, passthrough_errors=False
+            socket, app=None, *, threaded=False, threads=None, processes=1,
+            workers=None, event_loop=False, request_handler=None,
+            passthrough_errors=False, **kwargs
         ):
     """Create a new server instance listening on the given socket that is
     either threaded, or forks or just processes one request after another.
+
+    `socket` can also be a list of sockets, for example a unix socket for a
+    reverse proxy and a TCP port for health checks, in which case all of them
+    will be served by the same server.
+
+    If `threads` is passed, requests will be handled by a fixed size pool of
+    that many worker threads rather than by a new thread for each request.
+
+    If `workers` is passed, that many worker processes will be forked once
+    when the server starts and will be kept running until it is shut down.
+    Can be combined with `threads` to give each worker its own thread pool.
+
+    If `event_loop` is set, connections will be managed by an :mod:`asyncio`
+    event loop, with only requests that are ready to be run being passed to
+    a pool of `threads` worker threads.
+
+    Any other keyword arguments, for example `metrics_path`, are passed on to
+    the server's constructor.
     """
-    if threaded and processes > 1:
+    if (threaded or threads or workers or event_loop) and processes > 1:
         raise TypeError(
             "cannot have a multithreaded and multi process server."
         )
+    elif event_loop and workers:
+        raise TypeError(
+            "cannot combine an event loop server with worker processes."
+        )
+    elif event_loop:
+        from verktyg_server.asyncio import AsyncWSGIServer
+        return AsyncWSGIServer(
+            socket, app, threads=threads or 16, handler=request_handler,
+            passthrough_errors=passthrough_errors, **kwargs
+        )
+    elif workers and threads:
+        return PreforkThreadPoolWSGIServer(
+            socket, app, workers=workers, threads=threads,
+            handler=request_handler, passthrough_errors=passthrough_errors,
+            **kwargs
+        )
+    elif workers:
+        return PreforkWSGIServer(
+            socket, app, workers=workers, handler=request_handler,
+            passthrough_errors=passthrough_errors, **kwargs
+        )
+    elif threads:
+        return ThreadPoolWSGIServer(
+            socket, app, threads=threads, handler=request_handler,
+            passthrough_errors=passthrough_errors, **kwargs
+        )
     elif threaded:
         return ThreadedWSGIServer(
             socket, app, handler=request_handler,
-            passthough_errors=passthrough_errors,
+            passthrough_errors=passthrough_errors, **kwargs
         )
     elif processes > 1:
         return ForkingWSGIServer(
             socket, app,  handler=request_handler,
             passthrough_errors=passthrough_errors,
-            processes=processes
+            processes=processes, **kwargs
         )
     else:
         return BaseWSGIServer(
             socket, app, handler=request_handler,
-            passthrough_errors=passthrough_errors
+            passthrough_errors=passthrough_errors, **kwargs
         )
 
 
@@ -330,10 +2136,17 @@ def _wrap_ssl(sock, ssl_context):
         ssl_context = load_ssl_context(*ssl_context)
     if ssl_context == 'adhoc':
         ssl_context = make_adhoc_ssl_context()
-    return ssl_context.wrap_socket(sock, server_side=True)
+    # The handshake for accepted connections is performed by the request
+    # handler.  See `WSGIRequestHandler.do_handshake`.
+    return ssl_context.wrap_socket(
+        sock, server_side=True, do_handshake_on_connect=False,
+    )
 
 
-def make_inet_socket(interface, port=0, *, backlog=2048, ssl_context=None):
+def make_inet_socket(
+            interface, port=0, *, backlog=2048, ssl_context=None,
+            reuse_port=False, socket_options=None
+        ):
     if _is_ipv6_address(interface):
         family = socket.AF_INET6
     else:
@@ -343,6 +2156,10 @@ def make_inet_socket(interface, port=0, *, backlog=2048, ssl_context=None):
 
     sock = socket.socket(family, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if socket_options is not None:
+        socket_options.configure_listener(sock)
     sock.setblocking(True)
 
     sock.bind(address)
@@ -354,9 +2171,17 @@ def make_inet_socket(interface, port=0, *, backlog=2048, ssl_context=None):
     return sock
 
 
-def make_fd_socket(fd, *, family=socket.AF_UNIX, ssl_context=None):
-    sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+def make_fd_socket(
+            fd, *, family=None, ssl_context=None, socket_options=None
+        ):
+    if family is None:
+        # Let python ask the kernel what sort of socket this is.
+        sock = socket.socket(fileno=os.dup(fd))
+    else:
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if socket_options is not None:
+        socket_options.configure_listener(sock)
     sock.setblocking(True)
 
     if ssl_context is not None:
@@ -365,9 +2190,129 @@ def make_fd_socket(fd, *, family=socket.AF_UNIX, ssl_context=None):
     return sock
 
 
-def make_unix_socket(filename, *, backlog=2048, ssl_context=None):
+#: Environment variable used by :meth:`BaseWSGIServer.reexec` to tell the new
+#: process which file descriptors it has inherited listening sockets on.
+LISTEN_FD_ENV = 'VERKTYG_SERVER_LISTEN_FD'
+
+#: Environment variable used by :meth:`BaseWSGIServer.reexec` to tell the new
+#: process where to write to once it is ready to accept connections.
+READY_FD_ENV = 'VERKTYG_SERVER_READY_FD'
+
+
+def inherited_sockets(*, ssl_context=None, socket_options=None):
+    """Returns the listening sockets handed over by :meth:`~BaseWSGIServer.
+    reexec` in the process that started this one, or an empty list if this
+    process was not started that way.
+    """
+    fds = os.environ.pop(LISTEN_FD_ENV, None)
+    if not fds:
+        return []
+
+    sockets = []
+    for fd in fds.split(','):
+        fd = int(fd)
+        try:
+            sockets.append(make_fd_socket(
+                fd, ssl_context=ssl_context, socket_options=socket_options,
+            ))
+        finally:
+            os.close(fd)
+    return sockets
+
+
+#: The first file descriptor passed by systemd socket activation.
+SD_LISTEN_FDS_START = 3
+
+
+def systemd_sockets(*, names=None, ssl_context=None, socket_options=None):
+    """Returns the sockets passed to this process by systemd socket
+    activation, as described by the ``LISTEN_FDS``, ``LISTEN_PID`` and
+    ``LISTEN_FDNAMES`` environment variables.  The family of each socket is
+    read from the socket itself, so a single unit can pass any mix of unix
+    and inet sockets.
+
+    The environment variables are removed so that they will not be inherited
+    by child processes.
+
+    :param names:
+        If given, only sockets with a ``FileDescriptorName`` in `names` are
+        returned.  The rest are closed.
+    :param ssl_context:
+        An optional :class:`ssl.SSLContext` to wrap every returned socket
+        with.
+    :param socket_options:
+        Optional :class:`~verktyg_server.sockopts.SocketOptions` to apply to
+        every returned socket.
+
+    :return:
+        A list of ``(name, socket)`` pairs, in the order that systemd passed
+        them.  `name` is ``None`` if systemd did not provide one.  The list
+        will be empty if no sockets were passed to this process.
+    """
+    listen_pid = os.environ.pop('LISTEN_PID', None)
+    listen_fds = os.environ.pop('LISTEN_FDS', None)
+    listen_fdnames = os.environ.pop('LISTEN_FDNAMES', None)
+
+    if listen_pid is None or listen_fds is None:
+        return []
+    if int(listen_pid) != os.getpid():
+        # Intended for a different process.
+        return []
+
+    fdnames = listen_fdnames.split(':') if listen_fdnames else []
+
+    sockets = []
+    for index in range(int(listen_fds)):
+        fd = SD_LISTEN_FDS_START + index
+        name = fdnames[index] if index < len(fdnames) else None
+
+        # systemd passes the descriptors without `FD_CLOEXEC` set.
+        os.set_inheritable(fd, False)
+        sock = socket.socket(fileno=fd)
+
+        if names is not None and name not in names:
+            sock.close()
+            continue
+
+        if sock.type != socket.SOCK_STREAM:
+            raise ValueError((
+                "socket {name!r} passed by systemd is not a stream socket"
+            ).format(name=name or fd))
+        if socket_options is not None:
+            socket_options.configure_listener(sock)
+        sock.setblocking(True)
+
+        if ssl_context is not None:
+            sock = _wrap_ssl(sock, ssl_context)
+
+        sockets.append((name or None, sock))
+
+    return sockets
+
+
+def notify_ready():
+    """Tells the process that started this one using :meth:`~BaseWSGIServer.
+    reexec` that the new server is ready to accept connections, and that it
+    can start draining.  Does nothing if this process was not started that
+    way.
+    """
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    fd = int(fd)
+    try:
+        os.write(fd, b'1')
+    finally:
+        os.close(fd)
+
+
+def make_unix_socket(
+            filename, *, backlog=2048, ssl_context=None, socket_options=None
+        ):
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if socket_options is not None:
+        socket_options.configure_listener(sock)
     sock.setblocking(True)
 
     sock.bind(filename)
@@ -379,7 +2324,7 @@ def make_unix_socket(filename, *, backlog=2048, ssl_context=None):
     return sock
 
 
-def make_socket(address, ssl_context=None):
+def make_socket(address, ssl_context=None, *, socket_options=None):
     """Creates a new listening socket bound to the interface, socket or file
     descriptor indicated by the address parameter.
 
@@ -421,6 +2366,10 @@ def make_socket(address, ssl_context=None):
         An optional :class:`ssl.SSLContext` to use for encrypting traffic sent
         over the socket.
 
+    :param socket_options:
+        An optional :class:`~verktyg_server.sockopts.SocketOptions` instance
+        to configure the socket with.
+
     :return socket.socket:
         A socket suitable for running an http server on.
     """
@@ -437,11 +2386,20 @@ def make_socket(address, ssl_context=None):
                 'https': 443,
             }[components.scheme]
 
-        return make_inet_socket(host, port, ssl_context=ssl_context)
+        return make_inet_socket(
+            host, port, ssl_context=ssl_context,
+            socket_options=socket_options,
+        )
     elif components.scheme == 'fd':
-        return make_fd_socket(int(components.netloc), ssl_context=ssl_context)
+        return make_fd_socket(
+            int(components.netloc), ssl_context=ssl_context,
+            socket_options=socket_options,
+        )
     elif components.scheme == 'unix':
-        return make_unix_socket(components.path, ssl_context=ssl_context)
+        return make_unix_socket(
+            components.path, ssl_context=ssl_context,
+            socket_options=socket_options,
+        )
     else:
         raise ValueError((
             "address {address!r} has unsupported scheme {scheme!r}"
@@ -472,4 +2430,6 @@ def main():
     application = factory()
 
     server = verktyg_server.argparse.make_server(args, application)
+    server.handle_signals()
+    notify_ready()
     server.serve_forever()
@@ -0,0 +1,175 @@
+"""
+    verktyg_server.accesslog
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import os
+import json
+import time
+import queue
+import weakref
+import threading
+from collections import namedtuple
+
+import logging
+log = logging.getLogger('verktyg_server')
+
+
+#: A single entry in the access log.  `time` is a unix timestamp giving when
+#: the response finished, and `duration` is the number of seconds since the
+#: request started.
+AccessLogRecord = namedtuple('AccessLogRecord', [
+    'time', 'remote_addr', 'method', 'path', 'protocol', 'status', 'size',
+    'duration',
+])
+
+
+def _or_dash(value):
+    return '-' if value is None else value
+
+
+def format_common(record):
+    """Formats a record as a line in the Common Log Format, with the request
+    duration in seconds appended.
+    """
+    return '%s - - [%s] "%s %s %s" %s %s %.6f\n' % (
+        _or_dash(record.remote_addr),
+        time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(record.time)),
+        _or_dash(record.method), _or_dash(record.path),
+        _or_dash(record.protocol), _or_dash(record.status),
+        _or_dash(record.size), record.duration,
+    )
+
+
+def format_json(record):
+    """Formats a record as a single line JSON object."""
+    return json.dumps(record._asdict(), separators=(',', ':')) + '\n'
+
+
+FORMATS = {
+    'common': format_common,
+    'json': format_json,
+}
+
+
+def _after_fork(reference):
+    access_log = reference()
+    if access_log is not None:
+        access_log._reset()
+
+
+class AccessLog(object):
+    """Writes access log records to a stream from a background thread, so
+    that request threads never wait on a slow disk or log server.
+
+    Records are placed on a bounded queue.  If the queue is full, because the
+    writer can't keep up, records are dropped rather than holding up the
+    response, and counted in :attr:`dropped`.  The writer takes as many
+    records as are waiting, up to `batch_size`, and writes them all at once.
+
+    The writer thread is started when the first record is logged, so an
+    access log created before forking will start a separate writer in each
+    child process.
+
+    :param output:
+        A text stream to write formatted records to.
+    :param format:
+        Either the name of one of the builtin :data:`FORMATS`, or a function
+        that takes an :class:`AccessLogRecord` and returns a line of text.
+    :param queue_size:
+        Maximum number of records waiting to be written.
+    :param batch_size:
+        Maximum number of records to write with a single call to
+        ``output.write``.
+    """
+    def __init__(
+                self, output, *, format='common', queue_size=8192,
+                batch_size=256
+            ):
+        if isinstance(format, str):
+            format = FORMATS[format]
+
+        self.output = output
+        self.format = format
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+
+        #: The number of records that have been discarded because the queue
+        #: was full.
+        self.dropped = 0
+
+        self._reset()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(
+                after_in_child=lambda ref=weakref.ref(self): _after_fork(ref)
+            )
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._writer, name='verktyg-server-access-log',
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def _writer(self):
+        records = self._queue
+        while True:
+            batch = [records.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(records.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = None in batch
+            try:
+                lines = [
+                    self.format(record)
+                    for record in batch if record is not None
+                ]
+                if lines:
+                    self.output.write(''.join(lines))
+                    self.output.flush()
+            except Exception:
+                log.exception("error writing access log")
+            finally:
+                for record in batch:
+                    records.task_done()
+
+            if stop:
+                return
+
+    def log(self, record):
+        """Queues a record to be written.  Never blocks."""
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def flush(self):
+        """Waits until every record queued so far has been written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """Writes any remaining records and stops the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
@@ -11,8 +11,14 @@ import re
 from collections import namedtuple
 from argparse import ArgumentTypeError
 
+import sys
+
 import verktyg_server
 import verktyg_server.sslutils
+import verktyg_server.accesslog
+import verktyg_server.sockopts
+import verktyg_server.cache
+import verktyg_server.compression
 
 
 _address_re = re.compile(r'''
@@ -62,6 +68,22 @@ class _AddressType(object):
         return _Address(scheme, hostname, port)
 
 
+_SNICertificate = namedtuple(
+    'SNICertificate', ['hostname', 'certificate', 'private_key'],
+)
+
+
+class _SNICertificateType(object):
+    def __call__(self, string):
+        hostname, _, files = string.partition(':')
+        certificate, _, private_key = files.partition(':')
+        if not hostname or not certificate:
+            raise ArgumentTypeError(
+                "Expected HOSTNAME:CERTIFICATE[:PRIVATE_KEY]"
+            )
+        return _SNICertificate(hostname, certificate, private_key or None)
+
+
 def add_ssl_arguments(parser):
     """Takes an ``argparse`` parser and populates it with the arguments
     required by :func:`make_ssl_context`
@@ -79,12 +101,49 @@ def add_ssl_arguments(parser):
             "Path to private key file"
         )
     )
+    group.add_argument(
+        '--sni-certificate', type=_SNICertificateType(), action='append',
+        default=[], metavar='HOSTNAME:CERTIFICATE[:PRIVATE_KEY]',
+        help=(
+            "Certificate to use for clients that request a particular "
+            "hostname.  Can be given more than once.  --certificate is used "
+            "for clients that request any other hostname"
+        )
+    )
+    group.add_argument(
+        '--reload-certificates', action='store_true', default=False,
+        help=(
+            "Watch certificate and private key files for changes, and use "
+            "the new certificate for new connections"
+        )
+    )
     group.add_argument(
         '--adhoc-ssl', type=bool, default=False,
         help=(
             "Create an ssl context with a new self-signed certificate"
         )
     )
+    group.add_argument(
+        '--adhoc-ssl-cache', type=str, default=None, metavar='DIR',
+        help=(
+            "Directory in which to keep the self-signed certificate created "
+            "by --adhoc-ssl, so that it can be reused until it expires"
+        )
+    )
+    group.add_argument(
+        '--no-session-tickets', action='store_false', dest='session_tickets',
+        default=True,
+        help=(
+            "Don't issue TLS session tickets.  Clients will only be able to "
+            "resume sessions cached by the process that they connect to"
+        )
+    )
+    group.add_argument(
+        '--num-tickets', type=int, default=None,
+        help=(
+            "Number of TLS 1.3 session tickets to issue to each client"
+        )
+    )
 
 
 def add_socket_arguments(parser):
@@ -107,11 +166,194 @@ def add_socket_arguments(parser):
         )
     )
     addr_group.add_argument(
-        '--fd', type=str,
+        '--fd', type=int,
         help=(
             "File descriptor to listen on"
         )
     )
+    addr_group.add_argument(
+        '--systemd', metavar='NAME', nargs='*',
+        help=(
+            "Listen on the sockets passed by systemd socket activation.  If "
+            "names are given, only sockets with a matching "
+            "FileDescriptorName will be used"
+        )
+    )
+    group.add_argument(
+        '--reuse-port', action='store_true', default=False,
+        help=(
+            "Set SO_REUSEPORT on the listening socket.  When combined with "
+            "--workers, each worker will get its own listening socket"
+        )
+    )
+
+    group = parser.add_argument_group("Socket Tuning Options")
+    group.add_argument(
+        '--no-tcp-nodelay', dest='tcp_nodelay', action='store_false',
+        default=True,
+        help=(
+            "Don't set TCP_NODELAY on accepted connections, allowing the "
+            "kernel to delay small writes to combine them into larger packets"
+        )
+    )
+    group.add_argument(
+        '--tcp-defer-accept', type=int, default=None, metavar='SECONDS',
+        help=(
+            "Don't wake the server for a new connection until the client has "
+            "sent data, or this many seconds have passed (Linux only)"
+        )
+    )
+    group.add_argument(
+        '--tcp-fastopen', type=int, default=None, metavar='QUEUE',
+        help=(
+            "Enable TCP fast open with a queue of this many pending "
+            "connections"
+        )
+    )
+    group.add_argument(
+        '--recv-buffer', type=int, default=None, metavar='BYTES',
+        help=(
+            "Size of the kernel receive buffer for each connection"
+        )
+    )
+    group.add_argument(
+        '--send-buffer', type=int, default=None, metavar='BYTES',
+        help=(
+            "Size of the kernel send buffer for each connection"
+        )
+    )
+    group.add_argument(
+        '--tcp-keepalive', action='store_true', default=False,
+        help=(
+            "Send TCP keepalive probes on idle connections"
+        )
+    )
+    group.add_argument(
+        '--tcp-keepalive-idle', type=int, default=None, metavar='SECONDS',
+        help=(
+            "Seconds a connection must be idle before the first keepalive "
+            "probe is sent"
+        )
+    )
+    group.add_argument(
+        '--tcp-keepalive-interval', type=int, default=None,
+        metavar='SECONDS',
+        help=(
+            "Seconds between keepalive probes"
+        )
+    )
+    group.add_argument(
+        '--tcp-keepalive-count', type=int, default=None, metavar='COUNT',
+        help=(
+            "Number of unanswered keepalive probes after which a connection "
+            "is closed"
+        )
+    )
+
+
+def add_server_arguments(parser):
+    """Takes an ``argparse`` parser and populates it with the arguments
+    controlling how :func:`make_server` dispatches requests
+    """
+    group = parser.add_argument_group("Server Options")
+    group.add_argument(
+        '--threads', type=int, default=None,
+        help=(
+            "Number of worker threads to use to handle requests.  If not "
+            "given, requests will be handled one at a time"
+        )
+    )
+    group.add_argument(
+        '--event-loop', action='store_true', default=False,
+        help=(
+            "Manage connections using an asyncio event loop, only handing "
+            "them to one of --threads worker threads to run the application"
+        )
+    )
+    group.add_argument(
+        '--workers', type=int, default=None,
+        help=(
+            "Number of worker processes to fork on startup.  Workers that "
+            "exit will be replaced"
+        )
+    )
+    group.add_argument(
+        '--max-in-flight', type=int, default=None, metavar='REQUESTS',
+        help=(
+            "Answer new requests with a 503 while this many are already "
+            "being handled, or are waiting for a worker thread"
+        )
+    )
+    group.add_argument(
+        '--max-queue-wait', type=float, default=None, metavar='SECONDS',
+        help=(
+            "Answer requests with a 503 if they have waited for longer than "
+            "this for a worker thread"
+        )
+    )
+    group.add_argument(
+        '--retry-after', type=int, default=1, metavar='SECONDS',
+        help=(
+            "Value of the Retry-After header sent with 503 responses to "
+            "requests that were turned away.  Defaults to 1"
+        )
+    )
+    group.add_argument(
+        '--metrics-path', type=str, default=None, metavar='PATH',
+        help=(
+            "Serve request metrics in the Prometheus text format from this "
+            "path instead of passing requests for it to the application"
+        )
+    )
+    group.add_argument(
+        '--response-cache-size', type=int, default=None, metavar='BYTES',
+        help=(
+            "Store responses that the application marks as cacheable in "
+            "memory, using up to this many bytes in each process"
+        )
+    )
+    group.add_argument(
+        '--compress', action='store_true', default=False,
+        help=(
+            "Compress text responses using gzip, deflate or, if installed, "
+            "brotli for clients that accept it"
+        )
+    )
+    group.add_argument(
+        '--compress-min-size', type=int, default=1024, metavar='BYTES',
+        help=(
+            "Send responses smaller than this uncompressed.  Defaults to "
+            "1024"
+        )
+    )
+
+
+def add_access_log_arguments(parser):
+    """Takes an ``argparse`` parser and populates it with the arguments
+    required by :func:`make_access_log`
+    """
+    group = parser.add_argument_group("Access Log Options")
+    group.add_argument(
+        '--access-log', type=str, default=None, metavar='PATH',
+        help=(
+            "File to append access log records to, or '-' for stdout.  "
+            "Records are written from a background thread"
+        )
+    )
+    group.add_argument(
+        '--access-log-format', type=str, default='common',
+        choices=sorted(verktyg_server.accesslog.FORMATS),
+        help=(
+            "Format of access log records (default: common)"
+        )
+    )
+    group.add_argument(
+        '--access-log-queue-size', type=int, default=8192, metavar='SIZE',
+        help=(
+            "Maximum number of records waiting to be written before new "
+            "records are dropped (default: 8192)"
+        )
+    )
 
 
 def add_arguments(parser):
@@ -120,6 +362,8 @@ def add_arguments(parser):
     """
     add_socket_arguments(parser)
     add_ssl_arguments(parser)
+    add_server_arguments(parser)
+    add_access_log_arguments(parser)
 
 
 def make_ssl_context(args):
@@ -138,12 +382,32 @@ def make_ssl_context(args):
             raise ValueError(
                 "adhoc ssl context requested with details for explicit context"
             )
-        ssl_context = verktyg_server.sslutils.make_adhoc_ssl_context()
+        ssl_context = verktyg_server.sslutils.make_adhoc_ssl_context(
+            cache_dir=args.adhoc_ssl_cache,
+        )
         return ssl_context
 
+    if args.sni_certificate and not args.certificate:
+        raise ValueError(
+            "SNI certificates provided but no default certificate"
+        )
+
+    if args.certificate and (args.sni_certificate or args.reload_certificates):
+        store = verktyg_server.sslutils.CertificateStore(
+            check_interval=1.0 if args.reload_certificates else None,
+            session_tickets=args.session_tickets,
+            num_tickets=args.num_tickets,
+        )
+        store.add(args.certificate, args.private_key)
+        for hostname, certificate, private_key in args.sni_certificate:
+            store.add(certificate, private_key, hostnames=[hostname])
+        return store.make_context()
+
     if args.certificate:
         ssl_context = verktyg_server.sslutils.load_ssl_context(
-            args.certificate, args.private_key
+            args.certificate, args.private_key,
+            session_tickets=args.session_tickets,
+            num_tickets=args.num_tickets,
         )
         return ssl_context
 
@@ -153,7 +417,39 @@ def make_ssl_context(args):
     return None
 
 
-def make_socket(args, ssl_context=None):
+def make_socket_options(args):
+    """Create a :class:`~verktyg_server.sockopts.SocketOptions` instance
+    using settings from the command line
+
+    :param args:
+        An :module:`argparse` namespace populated with the arguments from
+        :func:`add_socket_arguments`
+    """
+    return verktyg_server.sockopts.SocketOptions(
+        nodelay=args.tcp_nodelay,
+        defer_accept=args.tcp_defer_accept,
+        fastopen=args.tcp_fastopen,
+        reuse_port=args.reuse_port,
+        recv_buffer=args.recv_buffer,
+        send_buffer=args.send_buffer,
+        keepalive=args.tcp_keepalive,
+        keepalive_idle=args.tcp_keepalive_idle,
+        keepalive_interval=args.tcp_keepalive_interval,
+        keepalive_count=args.tcp_keepalive_count,
+    )
+
+
+def _systemd_sockets(args, ssl_context, socket_options):
+    sockets = verktyg_server.systemd_sockets(
+        names=args.systemd or None, ssl_context=ssl_context,
+        socket_options=socket_options,
+    )
+    if not sockets:
+        raise ValueError("no sockets were passed by systemd")
+    return [sock for name, sock in sockets]
+
+
+def make_socket(args, ssl_context=None, socket_options=None):
     """Create a new socket using settings from command line
 
     :param args:
@@ -161,13 +457,36 @@ def make_socket(args, ssl_context=None):
         :func:`add_socket_arguments`
     :param ssl_context:
         An :class:`ssl.SSLContext` instance or ``None.
+    :param socket_options:
+        A :class:`~verktyg_server.sockopts.SocketOptions` instance.  Created
+        from `args` if not given.
 
     :returns:
         A new stream :class:`socket.Socket` instance.
+
+    :raises ValueError:
+        If systemd socket activation is requested and systemd did not pass
+        exactly one socket.  Use :func:`make_sockets` to listen on all of
+        them.
     """
-    if args.socket is not None:
+    if socket_options is None:
+        socket_options = make_socket_options(args)
+
+    if args.systemd is not None:
+        sockets = _systemd_sockets(args, ssl_context, socket_options)
+        if len(sockets) > 1:
+            for sock in sockets:
+                sock.close()
+            raise ValueError(
+                "systemd passed %d sockets, use make_sockets to listen on "
+                "all of them" % len(sockets)
+            )
+        socket = sockets[0]
+
+    elif args.socket is not None:
         socket = verktyg_server.make_unix_socket(
-            args.socket, ssl_context=ssl_context
+            args.socket, ssl_context=ssl_context,
+            socket_options=socket_options,
         )
 
     elif args.address is not None:
@@ -196,15 +515,81 @@ def make_socket(args, ssl_context=None):
             }[scheme]
 
         socket = verktyg_server.make_inet_socket(
-            address, port, ssl_context=ssl_context
+            address, port, ssl_context=ssl_context,
+            socket_options=socket_options,
         )
 
     elif args.fd is not None:
-        socket = verktyg_server.make_fd_socket(args.fd)
+        socket = verktyg_server.make_fd_socket(
+            args.fd, ssl_context=ssl_context, socket_options=socket_options,
+        )
+
+    else:
+        raise ValueError("no socket to listen on was given")
 
     return socket
 
 
+def make_sockets(args, ssl_context=None, socket_options=None):
+    """Create the list of sockets to listen on using settings from the
+    command line.  Unlike :func:`make_socket`, this supports systemd socket
+    activation passing more than one socket, and will take over the
+    sockets of the server being replaced if the process was started by
+    :meth:`verktyg_server.BaseWSGIServer.reexec`.
+
+    :param args:
+        An :module:`argparse` namespace populated with the arguments from
+        :func:`add_socket_arguments`
+    :param ssl_context:
+        An :class:`ssl.SSLContext` instance or ``None``.  Used for every
+        socket.
+    :param socket_options:
+        A :class:`~verktyg_server.sockopts.SocketOptions` instance.  Created
+        from `args` if not given.
+
+    :returns:
+        A non-empty list of :class:`socket.Socket` instances.
+    """
+    if socket_options is None:
+        socket_options = make_socket_options(args)
+
+    sockets = verktyg_server.inherited_sockets(
+        ssl_context=ssl_context, socket_options=socket_options,
+    )
+    if sockets:
+        return sockets
+
+    if args.systemd is not None:
+        return _systemd_sockets(args, ssl_context, socket_options)
+
+    return [make_socket(args, ssl_context, socket_options)]
+
+
+def make_access_log(args):
+    """Create a new access log using settings from the command line
+
+    :param args:
+        An :module:`argparse` namespace populated with the arguments from
+        :func:`add_access_log_arguments`
+
+    :returns:
+        An :class:`verktyg_server.accesslog.AccessLog` instance, or ``None``
+        if no access log was requested.
+    """
+    if args.access_log is None:
+        return None
+
+    if args.access_log == '-':
+        output = sys.stdout
+    else:
+        output = open(args.access_log, 'a', encoding='utf-8')
+
+    return verktyg_server.accesslog.AccessLog(
+        output, format=args.access_log_format,
+        queue_size=args.access_log_queue_size,
+    )
+
+
 def make_server(args, application):
     """Create a new http server using settings from the command line
 
@@ -218,7 +603,30 @@ def make_server(args, application):
     """
     ssl_context = make_ssl_context(args)
 
-    socket = make_socket(args, ssl_context)
+    socket_options = make_socket_options(args)
+
+    sockets = make_sockets(args, ssl_context, socket_options)
+
+    access_log = make_access_log(args)
 
-    server = verktyg_server.make_server(socket, application)
+    response_cache = None
+    if args.response_cache_size is not None:
+        response_cache = verktyg_server.cache.ResponseCache(
+            max_size=args.response_cache_size,
+        )
+
+    compression = None
+    if args.compress:
+        compression = verktyg_server.compression.ResponseCompression(
+            min_size=args.compress_min_size,
+        )
+
+    server = verktyg_server.make_server(
+        sockets, application, threads=args.threads, workers=args.workers,
+        event_loop=args.event_loop, metrics_path=args.metrics_path,
+        access_log=access_log, socket_options=socket_options,
+        response_cache=response_cache, compression=compression,
+        max_in_flight=args.max_in_flight, max_queue_wait=args.max_queue_wait,
+        retry_after=args.retry_after,
+    )
     return server
@@ -0,0 +1,479 @@
+"""
+    verktyg_server.asyncio
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import io
+import ssl
+import sys
+import time
+import socket
+import asyncio
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+from verktyg_server import BaseWSGIServer, _client_address
+
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:  # Python 3.6
+    _current_task = asyncio.Task.current_task
+
+# Python 3.6 event loops don't accept a handshake timeout.
+_HAS_SSL_HANDSHAKE_TIMEOUT = sys.version_info >= (3, 7)
+
+
+def _call(loop, coro, timeout):
+    # Runs `coro` on the event loop and waits for the result.  If the loop
+    # doesn't get to it in time, most likely because it is shutting down,
+    # the worker gives up on the connection rather than blocking forever.
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise socket.timeout("timed out waiting for the event loop")
+
+
+class _ThreadsafeReader(object):
+    """Read only file-like object that allows a handler running in a worker
+    thread to read the request body from a stream owned by the event loop.
+    """
+    def __init__(self, reader, loop, timeout=None):
+        self._reader = reader
+        self._loop = loop
+        self._timeout = timeout
+
+        # Data that has been read from the stream but not yet returned.
+        self._pending = b''
+
+    async def _read(self, size):
+        if size < 0:
+            return await self._reader.read()
+        try:
+            return await self._reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    async def _readline(self, size):
+        # `StreamReader.readline` gives up on lines longer than the stream's
+        # limit, which is sized for request heads rather than bodies, and
+        # throws away what it has read.  Lines are instead read in pieces of
+        # up to the limit, stopping at either the end of the line or `size`
+        # bytes, so that nothing is read past the end of the line.
+        chunks = []
+        while size:
+            try:
+                chunks.append(await self._reader.readuntil(b'\n'))
+                break
+            except asyncio.IncompleteReadError as e:
+                chunks.append(e.partial)
+                break
+            except asyncio.LimitOverrunError as e:
+                count = e.consumed if size < 0 else min(e.consumed, size)
+                chunks.append(await self._reader.readexactly(count))
+                if size > 0:
+                    size -= count
+        return b''.join(chunks)
+
+    def _call(self, coro):
+        return _call(self._loop, coro, self._timeout)
+
+    def _take(self, data, size):
+        if 0 <= size < len(data):
+            data, self._pending = data[:size], data[size:]
+        return data
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+
+        data, self._pending = self._pending, b''
+        if size < 0:
+            data += self._call(self._read(-1))
+        elif len(data) < size:
+            data += self._call(self._read(size - len(data)))
+        return self._take(data, size)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+
+        data, self._pending = self._pending, b''
+        end = data.find(b'\n')
+        if end < 0 and (size < 0 or len(data) < size):
+            data += self._call(self._readline(
+                size - len(data) if size >= 0 else -1
+            ))
+            end = data.find(b'\n')
+
+        if end >= 0 and (size < 0 or end < size):
+            size = end + 1
+        return self._take(data, size)
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def close(self):
+        pass
+
+
+class _ThreadsafeWriter(object):
+    """Write only file-like object that allows a handler running in a worker
+    thread to write the response to a stream owned by the event loop.
+    """
+    def __init__(self, writer, loop, timeout=None):
+        self._writer = writer
+        self._loop = loop
+        self._timeout = timeout
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def write(self, data):
+        _call(self._loop, self._write(bytes(data)), self._timeout)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class AsyncWSGIServer(BaseWSGIServer):
+    """A WSGI server that manages connections using an :mod:`asyncio` event
+    loop.
+
+    The event loop is responsible for accepting connections, reading and
+    parsing request headers, and for waiting on idle keep-alive connections.
+    Only once a complete request head has been received is the request passed
+    to a worker thread to run the application.  This means that the number of
+    threads limits the number of requests that can be processed at once, but
+    not the number of connections that can be held open.
+
+    Requests waiting for a worker thread, and requests being run by one,
+    count towards the server's `max_in_flight` limit.  Requests over the
+    limit, and requests that wait for longer than `max_queue_wait` for a
+    thread, are answered with a ``503`` and the connection closed.
+    """
+    multithread = True
+
+    #: The maximum size of a request head, including the request line.
+    max_head_size = 65536
+
+    #: Number of seconds that a worker thread will wait for the event loop
+    #: to read part of a request body or write part of a response before
+    #: giving up on the connection.
+    io_timeout = 60
+
+    def __init__(self, socket, app, *, threads=16, **kwargs):
+        BaseWSGIServer.__init__(self, socket, app, **kwargs)
+        self.threads = threads
+
+        self._loop = None
+        self._executor = None
+        self._shutdown_request = threading.Event()
+        self._is_shut_down = threading.Event()
+        self._drain_deadline = None
+        self._cut_off = False
+
+        # Only updated from the event loop.
+        self._active = 0
+
+    def _make_handler(self, writer):
+        handler_class = self.RequestHandlerClass
+        handler = handler_class.__new__(handler_class)
+
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            handler.request = ssl_object
+        else:
+            handler.request = writer.get_extra_info('socket')
+        handler.client_address = _client_address(
+            writer.get_extra_info('peername')
+        )
+        handler.server = self
+        handler._request_start = time.monotonic()
+
+        # On Python 3.8 and later the socket is wrapped in a
+        # `TransportSocket`, but on older versions it is the loop's own
+        # non-blocking socket, which only the transport may write to.
+        handler._owns_socket = False
+
+        return handler
+
+    async def _read_request(self, reader, writer):
+        """Reads and parses the next request head from the connection.
+
+        Returns a handler ready to run the application, or ``None`` if the
+        connection should be closed.
+        """
+        # Read line by line, rather than up to the first blank line, so that,
+        # as with the other servers, lines can end with a bare LF.
+        lines = []
+        size = 0
+        error = None
+        try:
+            while True:
+                line = await reader.readuntil(b'\n')
+                lines.append(line)
+                if len(lines) == 1:
+                    if line in (b'\r\n', b'\n'):
+                        # Blank line in place of a request line.
+                        break
+                else:
+                    size += len(line)
+                    if size > self.max_head_size:
+                        error = 431
+                        break
+                    if line in (b'\r\n', b'\n'):
+                        break
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            # A single line was longer than the stream's limit.
+            error = 414 if len(lines) == 0 else 431
+
+        handler = self._make_handler(writer)
+        handler.rfile = io.BytesIO(b''.join(lines))
+        handler.wfile = io.BytesIO()
+        handler.close_connection = True
+
+        if error is None:
+            handler.raw_requestline = handler.rfile.readline(65537)
+            if len(handler.raw_requestline) > 65536:
+                error = 414
+
+        if error is not None:
+            handler.requestline = ''
+            handler.request_version = ''
+            handler.command = ''
+            handler.send_error(error)
+        elif handler.parse_request():
+            return handler
+
+        writer.write(handler.wfile.getvalue())
+        await writer.drain()
+        return None
+
+    async def _handle_connection(self, reader, writer, idle):
+        loop = asyncio.get_event_loop()
+        task = _current_task()
+
+        handler_class = self.RequestHandlerClass
+
+        self.metrics.connection_opened()
+        accepted = time.monotonic()
+        count = 0
+        try:
+            while not self._shutdown_request.is_set():
+                # Clients get `timeout` to send their first request, and
+                # `keep_alive_timeout` to send each one after that.
+                timeout = handler_class.timeout
+                if count:
+                    timeout = handler_class.keep_alive_timeout
+
+                idle.add(task)
+                try:
+                    handler = await asyncio.wait_for(
+                        self._read_request(reader, writer), timeout,
+                    )
+                except asyncio.TimeoutError:
+                    break
+                finally:
+                    idle.discard(task)
+
+                if handler is None:
+                    break
+
+                count += 1
+                handler._request_count = count
+
+                # As with the threaded servers, the first request on a
+                # connection is timed from when the connection was accepted.
+                if accepted is not None:
+                    handler._request_start, accepted = accepted, None
+                else:
+                    handler._request_start = time.monotonic()
+
+                if self._overloaded():
+                    self._shed_request(writer, 'in_flight')
+                    break
+
+                handler.rfile = _ThreadsafeReader(
+                    reader, loop, self.io_timeout,
+                )
+                handler.wfile = _ThreadsafeWriter(
+                    writer, loop, self.io_timeout,
+                )
+
+                self._active += 1
+                try:
+                    ran = await loop.run_in_executor(
+                        self._executor, self._run_queued,
+                        handler, time.monotonic(),
+                    )
+                finally:
+                    self._active -= 1
+
+                if not ran:
+                    self._shed_request(writer, 'queue_wait')
+                    break
+
+                if handler.close_connection:
+                    break
+                if handler.rfile._pending:
+                    # Part of a line that the application didn't ask for
+                    # was read, and may belong to the next request.
+                    break
+        except asyncio.CancelledError:
+            pass
+        except (socket.error, socket.timeout, ssl.SSLError) as e:
+            handler = self._make_handler(writer)
+            handler.connection_dropped(e)
+        finally:
+            writer.close()
+            self.metrics.connection_closed()
+
+    def _in_flight(self):
+        return self._active
+
+    def _run_queued(self, handler, queued):
+        # Run by a worker thread.  Returns `False`, without running the
+        # application, if the request waited too long for the worker.
+        if self._waited_too_long(queued):
+            return False
+        handler.run_wsgi()
+        return True
+
+    def _shed_request(self, writer, reason):
+        # The request head has already been read, so unlike the threaded
+        # servers the response can simply be written out before closing.
+        self.metrics.request_shed(reason)
+        writer.write(self._shed_response)
+
+    async def _start_server(self, on_connection, listener):
+        ssl_options = {}
+        if isinstance(listener, ssl.SSLSocket):
+            # The handshake is run by the event loop, so a slow client will
+            # not hold up any other connections.
+            ssl_options = {'ssl': listener.context}
+            if _HAS_SSL_HANDSHAKE_TIMEOUT:
+                ssl_options['ssl_handshake_timeout'] = (
+                    self.RequestHandlerClass.handshake_timeout
+                )
+
+        # The event loop takes ownership of the socket that it is passed, so
+        # we give it a duplicate.
+        sock = socket.fromfd(listener.fileno(), listener.family, listener.type)
+        sock.setblocking(False)
+
+        return await asyncio.start_server(
+            on_connection, sock=sock, limit=self.max_head_size,
+            **ssl_options
+        )
+
+    async def _serve(self):
+        loop = asyncio.get_event_loop()
+        wakeup = asyncio.Event()
+        self._wakeup = wakeup.set
+
+        connections = set()
+        idle = set()
+
+        def on_connection(reader, writer):
+            try:
+                self.socket_options.configure_connection(
+                    writer.get_extra_info('socket')
+                )
+            except OSError:
+                # The client has most likely already gone away, which will
+                # be noticed when reading the request.
+                pass
+            task = loop.create_task(
+                self._handle_connection(reader, writer, idle)
+            )
+            connections.add(task)
+            task.add_done_callback(connections.discard)
+
+        servers = []
+        for listener in self.sockets:
+            servers.append(await self._start_server(on_connection, listener))
+        try:
+            while not self._shutdown_request.is_set():
+                await wakeup.wait()
+                wakeup.clear()
+        finally:
+            for server in servers:
+                server.close()
+            self._closing = True
+
+            # Connections that are waiting for a new request can be closed
+            # immediately.  Requests that are in progress are allowed to run
+            # to completion, or until the drain deadline.
+            for task in idle:
+                task.cancel()
+            if connections:
+                timeout = None
+                if self._drain_deadline is not None:
+                    timeout = max(self._drain_deadline - time.monotonic(), 0)
+                done, pending = await asyncio.wait(
+                    connections, timeout=timeout,
+                )
+                if pending:
+                    self.logger.warning(
+                        "closing %d connections that did not finish in time",
+                        len(pending),
+                    )
+                    self._cut_off = True
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.wait(pending)
+
+    def serve_forever(self):
+        self._shutdown_request.clear()
+        self._is_shut_down.clear()
+        self._cut_off = False
+
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._loop = asyncio.new_event_loop()
+        interrupted = False
+        try:
+            self._loop.run_until_complete(self._serve())
+        except KeyboardInterrupt:
+            interrupted = True
+        finally:
+            self._loop.close()
+            # If interrupted, or if requests were cut off, workers may be
+            # blocked waiting on the now closed loop and will never finish.
+            self._executor.shutdown(wait=not (interrupted or self._cut_off))
+            self.server_close()
+            self._flush_access_log()
+            self._is_shut_down.set()
+
+    def _drain(self, deadline):
+        self._drain_deadline = deadline
+        self.shutdown()
+
+    def shutdown(self):
+        """Stops the event loop and waits for any requests that are in
+        progress to finish.
+        """
+        self._shutdown_request.set()
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup)
+        except (AttributeError, RuntimeError):
+            # The loop hasn't been started yet, or has already finished.
+            pass
+        self._is_shut_down.wait()
@@ -0,0 +1,463 @@
+"""
+    verktyg_server.cache
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import time
+import threading
+import collections
+from email.utils import parsedate_tz, mktime_tz
+
+from verktyg_server.parser import environ_key
+from verktyg_server.streams import FileWrapper
+
+
+#: Status codes of responses that can be stored, provided that they are
+#: explicitly marked as cacheable.
+CACHEABLE_STATUSES = frozenset({
+    200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501,
+})
+
+# Headers that only apply to the connection that the response was first sent
+# on.
+_HOP_BY_HOP_HEADERS = frozenset({
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'content-length',
+})
+
+# Headers copied from a stored response to a `304 Not Modified`.
+_NOT_MODIFIED_HEADERS = frozenset({
+    'cache-control', 'content-location', 'date', 'etag', 'expires', 'vary',
+})
+
+
+def parse_cache_control(value):
+    """Parses the value of a ``Cache-Control`` header into a dictionary
+    mapping lowercase directive names to their arguments, or to ``None`` for
+    directives without one.
+    """
+    directives = {}
+    for item in value.split(','):
+        name, equals, argument = item.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"') if equals else None
+    return directives
+
+
+def _parse_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    try:
+        parsed = parsedate_tz(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def _weak(etag):
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
+
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match.strip() == '*':
+        return True
+    etag = _weak(etag)
+    return any(_weak(tag) == etag for tag in if_none_match.split(','))
+
+
+class _Entry(object):
+    __slots__ = (
+        'status', 'headers', 'body', 'vary', 'vary_values', 'stored',
+        'expires', 'etag', 'last_modified', 'size',
+    )
+
+
+class _Resource(object):
+    # All stored variants of the response for a single url, which must have
+    # agreed on the request headers that they vary by.
+    __slots__ = ('vary', 'variants', 'size')
+
+    def __init__(self, vary):
+        self.vary = vary
+        self.variants = {}
+        self.size = 0
+
+
+class _Resumed(object):
+    # Iterates over the chunks that were read while deciding whether or not
+    # to store a response, followed by the rest of the response.
+    def __init__(self, chunks, iterator, application_iter):
+        self._chunks = chunks
+        self._iterator = iterator
+        self._application_iter = application_iter
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield chunk
+        for chunk in self._iterator:
+            yield chunk
+
+    def close(self):
+        if hasattr(self._application_iter, 'close'):
+            self._application_iter.close()
+
+
+class ResponseCache(object):
+    """Stores complete responses in memory, so that repeated requests for
+    them can be answered without calling the application.
+
+    Only responses to ``GET`` requests that the application explicitly marks
+    as fresh for some time, using ``Cache-Control: max-age``, ``s-maxage`` or
+    an ``Expires`` header, are stored.  Responses that set cookies, are
+    marked ``private``, ``no-cache`` or ``no-store``, or vary by every
+    request header are not.  Requests with an ``Authorization`` header
+    bypass the cache entirely.
+
+    Responses are stored by url and by the values of the request headers
+    listed in their ``Vary`` header, and are served until they expire.
+    ``HEAD`` requests are answered from stored ``GET`` responses, and
+    ``If-None-Match`` and ``If-Modified-Since`` are answered with
+    ``304 Not Modified`` where the stored response allows.  Clients can ask
+    for a response from the application using ``Cache-Control: no-cache``.
+
+    Once the total size of stored responses exceeds `max_size` bytes, the
+    least recently used urls are evicted.  The cache is per process, so each
+    pre-forked worker will have its own.
+
+    :param max_size:
+        Approximate maximum number of bytes of responses to store.
+    :param max_entry_size:
+        Responses with bodies larger than this many bytes are streamed to the
+        client as normal, and not stored.
+    """
+    def __init__(
+                self, *, max_size=64 * 1024 * 1024,
+                max_entry_size=1024 * 1024
+            ):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+
+        self._lock = threading.Lock()
+        self._resources = collections.OrderedDict()
+        self._size = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def stats(self):
+        """Returns a dictionary of counters giving the number of ``hits``,
+        ``misses`` and ``evictions``, along with the number of ``entries``
+        stored and their total ``size`` in bytes.
+        """
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': sum(
+                    len(resource.variants)
+                    for resource in self._resources.values()
+                ),
+                'size': self._size,
+            }
+
+    def clear(self):
+        """Removes every stored response."""
+        with self._lock:
+            self._resources.clear()
+            self._size = 0
+
+    def _url(self, environ):
+        host = environ.get('HTTP_HOST')
+        if not host:
+            host = '%s:%s' % (environ['SERVER_NAME'], environ['SERVER_PORT'])
+        return (
+            environ['wsgi.url_scheme'], host.lower(),
+            environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', ''),
+        )
+
+    def _vary_values(self, environ, vary):
+        return tuple(environ.get(environ_key(name)) for name in vary)
+
+    def _lookup(self, url, environ, now, max_age):
+        with self._lock:
+            resource = self._resources.get(url)
+            entry = None
+            if resource is not None:
+                vary_values = self._vary_values(environ, resource.vary)
+                entry = resource.variants.get(vary_values)
+
+            if entry is not None and entry.expires <= now:
+                self._remove(url, resource, entry)
+                entry = None
+
+            if entry is None or (
+                        max_age is not None and now - entry.stored > max_age
+                    ):
+                self._misses += 1
+                return None
+
+            self._resources.move_to_end(url)
+            self._hits += 1
+            return entry
+
+    def _remove(self, url, resource, entry):
+        del resource.variants[entry.vary_values]
+        resource.size -= entry.size
+        self._size -= entry.size
+        if not resource.variants:
+            del self._resources[url]
+
+    def _store(self, url, entry):
+        if entry.size > self.max_size:
+            return
+        with self._lock:
+            resource = self._resources.get(url)
+            if resource is None or resource.vary != entry.vary:
+                if resource is not None:
+                    self._size -= resource.size
+                resource = self._resources[url] = _Resource(entry.vary)
+
+            previous = resource.variants.get(entry.vary_values)
+            if previous is not None:
+                self._remove(url, resource, previous)
+                self._resources[url] = resource
+
+            resource.variants[entry.vary_values] = entry
+            resource.size += entry.size
+            self._size += entry.size
+            self._resources.move_to_end(url)
+
+            while self._size > self.max_size:
+                evicted_url, evicted = self._resources.popitem(last=False)
+                self._size -= evicted.size
+                self._evictions += len(evicted.variants)
+
+    def _make_entry(self, environ, status, headers, now):
+        # Returns an entry, without a body, if the response can be stored.
+        try:
+            code = int(status.split(None, 1)[0])
+        except ValueError:
+            return None
+        if code not in CACHEABLE_STATUSES:
+            return None
+
+        cache_control = []
+        vary = []
+        stored_headers = []
+        expires = date = etag = last_modified = None
+        age = 0
+        for name, value in headers:
+            key = name.lower()
+            if key == 'set-cookie':
+                return None
+            elif key in _HOP_BY_HOP_HEADERS:
+                continue
+            elif key == 'cache-control':
+                cache_control.append(value)
+            elif key == 'vary':
+                vary.extend(
+                    field.strip().lower() for field in value.split(',')
+                    if field.strip()
+                )
+            elif key == 'expires':
+                expires = value
+            elif key == 'date':
+                date = _parse_date(value)
+            elif key == 'age':
+                age = _parse_seconds(value) or 0
+            elif key == 'etag':
+                etag = value
+            elif key == 'last-modified':
+                last_modified = _parse_date(value)
+            stored_headers.append((name, value))
+
+        if '*' in vary:
+            return None
+
+        directives = parse_cache_control(','.join(cache_control))
+        if (
+                    'no-store' in directives or 'no-cache' in directives or
+                    'private' in directives
+                ):
+            return None
+
+        lifetime = _parse_seconds(directives.get('s-maxage'))
+        if lifetime is None:
+            lifetime = _parse_seconds(directives.get('max-age'))
+        if lifetime is None and expires is not None:
+            # Invalid dates, such as "0", mean that the response has already
+            # expired.
+            expires = _parse_date(expires)
+            if expires is not None:
+                lifetime = expires - (date or now)
+        if lifetime is None or lifetime - age <= 0:
+            return None
+
+        entry = _Entry()
+        entry.status = status
+        entry.headers = stored_headers
+        entry.body = None
+        entry.vary = tuple(sorted(set(vary)))
+        entry.vary_values = self._vary_values(environ, entry.vary)
+        entry.stored = now - age
+        entry.expires = now + lifetime - age
+        entry.etag = etag
+        entry.last_modified = last_modified
+        entry.size = 0
+        return entry
+
+    def _not_modified(self, entry, environ):
+        if not entry.status.startswith('200'):
+            return False
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            return (
+                entry.etag is not None and
+                _etag_matches(if_none_match, entry.etag)
+            )
+        if_modified_since = _parse_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+        if if_modified_since is not None and entry.last_modified is not None:
+            return entry.last_modified <= if_modified_since
+        return False
+
+    def _respond(self, entry, environ, start_response, now, hit):
+        headers = entry.headers
+        if hit:
+            headers = headers + [('Age', str(int(now - entry.stored)))]
+
+        if self._not_modified(entry, environ):
+            start_response('304 Not Modified', [
+                (name, value) for name, value in headers
+                if name.lower() in _NOT_MODIFIED_HEADERS or name == 'Age'
+            ])
+            return []
+
+        start_response(entry.status, headers + [
+            ('Content-Length', str(len(entry.body))),
+        ])
+        return [entry.body]
+
+    def _fetch(self, url, app, environ, start_response, now):
+        # The response is held back until it is known whether it can be
+        # stored, and, if it can, until it has been read in full.
+        pending = []
+        started = []
+        decided = []
+        chunks = []
+
+        def write(data):
+            # Responses written using the legacy `write` callable are sent
+            # straight away, and not stored.
+            if not started:
+                started.append(start_response(pending[0], pending[1]))
+                del pending[:]
+                for chunk in chunks:
+                    started[0](chunk)
+                del chunks[:]
+            return started[0](data)
+
+        def cache_start_response(status, headers, exc_info=None):
+            del pending[:]
+            if exc_info is None and not decided:
+                entry = self._make_entry(environ, status, headers, now)
+                if entry is not None:
+                    pending[:] = [status, headers, entry]
+                    return write
+            started[:] = [start_response(status, headers, exc_info)]
+            return started[0]
+
+        def release():
+            status, headers, entry = pending
+            del pending[:]
+            started.append(start_response(status, headers))
+
+        application_iter = app(environ, cache_start_response)
+        # Applications that return a generator may not call
+        # `start_response` until they are iterated over, by which time it
+        # is too late to hold the response back.
+        decided.append(True)
+        if not pending or isinstance(application_iter, FileWrapper):
+            if pending:
+                release()
+            return application_iter
+
+        size = 0
+        iterator = iter(application_iter)
+        try:
+            for chunk in iterator:
+                chunks.append(chunk)
+                size += len(chunk)
+                if not pending:
+                    # The application has called `write`.
+                    return _Resumed(chunks, iterator, application_iter)
+                if size > self.max_entry_size:
+                    release()
+                    return _Resumed(chunks, iterator, application_iter)
+        except BaseException:
+            if hasattr(application_iter, 'close'):
+                application_iter.close()
+            raise
+
+        if hasattr(application_iter, 'close'):
+            application_iter.close()
+        if not pending:
+            return chunks
+
+        status, headers, entry = pending
+        entry.body = b''.join(chunks)
+        entry.size = len(entry.body) + sum(
+            len(name) + len(value) for name, value in entry.headers
+        )
+        self._store(url, entry)
+        return self._respond(entry, environ, start_response, now, False)
+
+    def serve(self, app, environ, start_response):
+        """Handles a request, answering it from the cache if possible, and
+        otherwise passing it on to the WSGI application `app` and storing
+        the response if it is cacheable.
+        """
+        method = environ['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD') or 'HTTP_AUTHORIZATION' in environ:
+            return app(environ, start_response)
+
+        directives = parse_cache_control(
+            environ.get('HTTP_CACHE_CONTROL', '')
+        )
+        if 'no-store' in directives:
+            return app(environ, start_response)
+
+        url = self._url(environ)
+        now = time.time()
+        if (
+                    'no-cache' not in directives and
+                    environ.get('HTTP_PRAGMA', '').lower() != 'no-cache'
+                ):
+            entry = self._lookup(
+                url, environ, now, _parse_seconds(directives.get('max-age')),
+            )
+            if entry is not None:
+                return self._respond(entry, environ, start_response, now, True)
+
+        if method != 'GET':
+            return app(environ, start_response)
+        return self._fetch(url, app, environ, start_response, now)
@@ -0,0 +1,429 @@
+"""
+    verktyg_server.compression
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import zlib
+import hashlib
+import functools
+import threading
+import collections
+
+from verktyg_server.streams import FileWrapper
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+#: Prefixes of the content types of responses that are worth compressing.
+#: Types ending in ``+json`` or ``+xml`` are also compressed.
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript',
+    'application/xml', 'application/x-javascript', 'image/svg+xml',
+)
+
+
+class _ZlibEncoder(object):
+    def __init__(self, level, wbits):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        # Everything passed in is flushed straight away, so that streamed
+        # responses are not held up waiting for the compressor's window to
+        # fill.
+        return (
+            self._compressor.compress(data) +
+            self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        )
+
+    def compress_all(self, data):
+        return self._compressor.compress(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliEncoder(object):
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def compress_all(self, data):
+        return self._compressor.process(data) + self._compressor.finish()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_accept_encoding(value):
+    qualities = {}
+    for item in value.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, param_value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def negotiate(accept_encoding, encodings):
+    """Picks the content coding to use for a response given the value of the
+    request's ``Accept-Encoding`` header.
+
+    :param encodings:
+        The codings that the server supports, in order of preference.
+
+    :returns:
+        The name of the chosen coding, or ``None`` if the response should
+        not be compressed.
+    """
+    if not accept_encoding:
+        return None
+    qualities = _parse_accept_encoding(accept_encoding)
+    default = qualities.get('*', 0.0)
+    best = None
+    best_quality = 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, default)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class _CompressedIter(object):
+    # Compresses a streamed response chunk by chunk.
+    def __init__(self, application_iter, response):
+        self._application_iter = application_iter
+        self._response = response
+
+    def __iter__(self):
+        response = self._response
+        for chunk in self._application_iter:
+            if response.pending is not None:
+                response.start_compressed()
+            if response.encoder is not None:
+                chunk = response.encoder.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+        if response.pending is not None:
+            response.start_compressed()
+        if response.encoder is not None:
+            yield response.encoder.finish()
+
+    def close(self):
+        if hasattr(self._application_iter, 'close'):
+            self._application_iter.close()
+
+
+class _Response(object):
+    # Holds back the headers of a response until it is known how the body
+    # will be compressed.
+    def __init__(self, compression, encoding, start_response):
+        self._compression = compression
+        self._encoding = encoding
+        self._start_response = start_response
+        self._write = None
+
+        #: The status and headers of a response that could be compressed,
+        #: and that has not been started yet.
+        self.pending = None
+        self.encoder = None
+
+    def start_response(self, status, headers, exc_info=None):
+        headers, compressible = self._compression._filter(status, headers)
+        self.pending = None
+        self.encoder = None
+        if compressible and self._encoding is not None and exc_info is None:
+            self.pending = (status, headers)
+            return self.write
+        self._write = self._start_response(status, headers, exc_info)
+        return self._write
+
+    def start(self, headers=None):
+        """Starts the response without compressing it."""
+        status, pending_headers = self.pending
+        self.pending = None
+        self._write = self._start_response(status, headers or pending_headers)
+
+    def start_compressed(self, body=None):
+        """Starts the response with compressed headers.  If `body` is given,
+        it is compressed in one go and returned.
+        """
+        status, headers = self.pending
+        self.pending = None
+        headers = _compressed_headers(headers, self._encoding)
+        if body is not None:
+            body = self._compression._compress(body, self._encoding)
+            headers.append(('Content-Length', str(len(body))))
+        else:
+            self.encoder = self._compression._encoder(self._encoding)
+        self._write = self._start_response(status, headers)
+        return body
+
+    def write(self, data):
+        if self.pending is not None:
+            self.start_compressed()
+        if self.encoder is not None:
+            data = self.encoder.compress(data)
+        return self._write(data)
+
+
+def _compressed_headers(headers, encoding):
+    compressed = [('Content-Encoding', encoding)]
+    for name, value in headers:
+        key = name.lower()
+        if key == 'content-length':
+            continue
+        if key == 'etag' and not value.startswith('W/'):
+            # The compressed body is no longer byte for byte identical to
+            # the one that the application tagged.
+            value = 'W/' + value
+        compressed.append((name, value))
+    return compressed
+
+
+class ResponseCompression(object):
+    """Compresses response bodies for clients that accept it, using gzip,
+    deflate, or brotli if the :mod:`brotli` package is installed.
+
+    A response is compressed if its content type is listed in
+    `content_types`, it is not already encoded, it is not a partial
+    response, and it is not known to be smaller than `min_size`.
+    ``Vary: Accept-Encoding`` is added to every response that could be
+    compressed.
+
+    Bodies returned as a list are compressed in one go, and sent with a
+    ``Content-Length``.  Other responses are compressed as they are
+    streamed, with each chunk flushed as soon as it is written, and will be
+    sent using chunked transfer encoding.  Files returned using
+    ``wsgi.file_wrapper`` are sent as they are, so that they can be sent
+    using ``sendfile``.
+
+    Compression happens on the thread that is handling the request.  Both
+    :mod:`zlib` and :mod:`brotli` release the GIL while compressing, so on
+    threaded servers compression runs alongside other requests rather than
+    holding them up.
+
+    To avoid compressing the same popular response again and again, bodies
+    that were compressed in one go are stored, up to `cache_size` bytes in
+    total, by a hash of the uncompressed body.
+
+    :param min_size:
+        Bodies smaller than this many bytes are sent uncompressed.
+    :param content_types:
+        Prefixes of the content types that should be compressed.
+    :param encodings:
+        The content codings to offer, in order of preference.  Defaults to
+        brotli, if available, followed by gzip and deflate.
+    :param level:
+        The zlib compression level to use for gzip and deflate.
+    :param brotli_quality:
+        The quality setting to use for brotli.
+    :param cache_size:
+        Maximum number of bytes of compressed bodies to keep.  ``0`` to
+        disable the cache.
+    :param max_cache_entry_size:
+        Bodies larger than this many bytes are not cached.
+    """
+    def __init__(
+                self, *, min_size=1024, content_types=COMPRESSIBLE_TYPES,
+                encodings=None, level=6, brotli_quality=4,
+                cache_size=16 * 1024 * 1024,
+                max_cache_entry_size=1024 * 1024
+            ):
+        if encodings is None:
+            encodings = ('gzip', 'deflate')
+            if brotli is not None:
+                encodings = ('br',) + encodings
+        for encoding in encodings:
+            if encoding not in ('br', 'gzip', 'deflate'):
+                raise ValueError("unsupported encoding: %r" % encoding)
+            if encoding == 'br' and brotli is None:
+                raise ValueError("brotli support requires the brotli package")
+
+        self.min_size = min_size
+        self.content_types = tuple(content_types)
+        self.encodings = tuple(encodings)
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.cache_size = cache_size
+        self.max_cache_entry_size = max_cache_entry_size
+
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._cache_used = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def stats(self):
+        """Returns a dictionary giving the number of ``hits``, ``misses``
+        and ``evictions`` of the compressed body cache, along with the
+        number of ``entries`` stored and their total ``size`` in bytes.
+        """
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': len(self._cache),
+                'size': self._cache_used,
+            }
+
+    def _compressible_type(self, content_type):
+        mime = content_type.split(';', 1)[0].strip().lower()
+        return (
+            mime.startswith(self.content_types) or
+            mime.endswith(('+json', '+xml'))
+        )
+
+    def _filter(self, status, headers):
+        # Returns the headers to send, and whether or not the response can
+        # be compressed.
+        code = status[:3]
+        if code[:1] == '1' or code in ('204', '206', '304'):
+            return headers, False
+
+        content_type = None
+        vary = None
+        for index, (name, value) in enumerate(headers):
+            key = name.lower()
+            if key == 'content-type':
+                content_type = value
+            elif key in ('content-encoding', 'content-range'):
+                return headers, False
+            elif key == 'content-length':
+                try:
+                    if int(value) < self.min_size:
+                        return headers, False
+                except ValueError:
+                    return headers, False
+            elif key == 'cache-control':
+                if 'no-transform' in value.lower():
+                    return headers, False
+            elif key == 'vary':
+                vary = index
+
+        if content_type is None or not self._compressible_type(content_type):
+            return headers, False
+
+        headers = list(headers)
+        if vary is None:
+            headers.append(('Vary', 'Accept-Encoding'))
+        else:
+            name, value = headers[vary]
+            fields = [field.strip().lower() for field in value.split(',')]
+            if 'accept-encoding' not in fields and '*' not in fields:
+                headers[vary] = (name, value + ', Accept-Encoding')
+        return headers, True
+
+    def _encoder(self, encoding):
+        if encoding == 'br':
+            return _BrotliEncoder(self.brotli_quality)
+        if encoding == 'gzip':
+            return _ZlibEncoder(self.level, 16 + zlib.MAX_WBITS)
+        return _ZlibEncoder(self.level, zlib.MAX_WBITS)
+
+    def _compress(self, body, encoding):
+        cacheable = self.cache_size and len(body) <= self.max_cache_entry_size
+        if not cacheable:
+            return self._encoder(encoding).compress_all(body)
+
+        # Hashing is many times faster than compressing.
+        key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+        with self._lock:
+            compressed = self._cache.get(key)
+            if compressed is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return compressed
+            self._misses += 1
+
+        compressed = self._encoder(encoding).compress_all(body)
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = compressed
+                self._cache_used += len(compressed)
+            while self._cache_used > self.cache_size:
+                evicted_key, evicted = self._cache.popitem(last=False)
+                self._cache_used -= len(evicted)
+                self._evictions += 1
+        return compressed
+
+    def _start_head(self, response):
+        # The body of a response to a ``HEAD`` request is left out, so its
+        # size can't be used to decide whether to compress it.  If the
+        # application gave the length of the body that it would have sent,
+        # `_filter` has already checked that it is worth compressing, and
+        # the same headers as for a ``GET`` are sent, less the length of the
+        # compressed body, which isn't known.  Otherwise the application's
+        # headers are sent as they are.
+        status, headers = response.pending
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                headers = _compressed_headers(headers, response._encoding)
+                break
+        response.start(headers)
+        return b''
+
+    def serve(self, app, environ, start_response):
+        """Handles a request by passing it on to the WSGI application `app`,
+        compressing the response if the client accepts it.
+        """
+        encoding = negotiate(
+            environ.get('HTTP_ACCEPT_ENCODING'), self.encodings,
+        )
+        response = _Response(self, encoding, start_response)
+        application_iter = app(environ, response.start_response)
+
+        if response.pending is None:
+            if response.encoder is None and response._write is not None:
+                # Already started, without compression.
+                return application_iter
+            # Either the application has already written part of the
+            # compressed body, or it will only start the response once
+            # iterated over.
+            return _CompressedIter(application_iter, response)
+
+        if isinstance(application_iter, FileWrapper):
+            response.start()
+            return application_iter
+
+        if isinstance(application_iter, (list, tuple)):
+            body = b''.join(application_iter)
+            if hasattr(application_iter, 'close'):
+                application_iter.close()
+            if not body and environ.get('REQUEST_METHOD') == 'HEAD':
+                return [self._start_head(response)]
+            if len(body) < self.min_size:
+                status, headers = response.pending
+                headers = [
+                    (name, value) for name, value in headers
+                    if name.lower() != 'content-length'
+                ]
+                headers.append(('Content-Length', str(len(body))))
+                response.start(headers)
+                return [body]
+            return [response.start_compressed(body)]
+
+        return _CompressedIter(application_iter, response)
@@ -0,0 +1,427 @@
+"""
+    verktyg_server.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import bisect
+import threading
+import weakref
+
+
+#: Upper bounds, in seconds, of the buckets used for latency histograms.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0,
+)
+
+_TIMINGS = ('first_byte', 'application', 'total')
+
+
+class _Histogram(object):
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.sum += other.sum
+        self.count += other.count
+
+
+class _Counters(object):
+    """Counters updated by a single thread."""
+    def __init__(self):
+        self.connections = 0
+        self.active_connections = 0
+        self.requests = 0
+        self.in_flight_requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.accept_queue_overflows = 0
+        self.requests_shed = {}
+        self.responses = {}
+        self.timings = {name: _Histogram() for name in _TIMINGS}
+
+    def merge(self, other):
+        self.connections += other.connections
+        self.active_connections += other.active_connections
+        self.requests += other.requests
+        self.in_flight_requests += other.in_flight_requests
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.accept_queue_overflows += other.accept_queue_overflows
+        for reason, count in list(other.requests_shed.items()):
+            self.requests_shed[reason] = (
+                self.requests_shed.get(reason, 0) + count
+            )
+        for status, count in list(other.responses.items()):
+            self.responses[status] = self.responses.get(status, 0) + count
+        for name in _TIMINGS:
+            self.timings[name].merge(other.timings[name])
+
+
+class _Handle(object):
+    __slots__ = ('counters', '__weakref__')
+
+    def __init__(self, counters):
+        self.counters = counters
+
+
+class ServerMetrics(object):
+    """Collects statistics about the connections and requests handled by a
+    server.
+
+    To avoid contention on the request path, each thread updates its own set
+    of counters without locking.  The counters are only combined when
+    :meth:`snapshot` is called, so a snapshot taken while requests are in
+    progress may be very slightly out of date.
+
+    Metrics are collected per process.  When using pre-forked workers, each
+    worker will have its own.
+
+    :param ssl_context:
+        If given, the session resumption counters of this
+        :class:`ssl.SSLContext` will be included in snapshots.
+    :param response_cache:
+        If given, the counters of this
+        :class:`~verktyg_server.cache.ResponseCache` will be included in
+        snapshots.
+    :param compression:
+        If given, the counters of the compressed body cache of this
+        :class:`~verktyg_server.compression.ResponseCompression` will be
+        included in snapshots.
+    """
+    def __init__(
+                self, ssl_context=None, response_cache=None, compression=None
+            ):
+        self.ssl_context = ssl_context
+        self.response_cache = response_cache
+        self.compression = compression
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        # Counters belonging to threads that are still running.
+        self._live = set()
+
+        # Totals from threads that have exited.
+        self._retired = _Counters()
+
+    def _retire(self, counters):
+        with self._lock:
+            self._live.discard(counters)
+            self._retired.merge(counters)
+
+    def _counters(self):
+        try:
+            return self._local.handle.counters
+        except AttributeError:
+            pass
+
+        counters = _Counters()
+        handle = _Handle(counters)
+        with self._lock:
+            self._live.add(counters)
+        # Fold the thread's counters into the totals when the thread exits
+        # and its thread local storage is released.
+        weakref.finalize(handle, self._retire, counters)
+        self._local.handle = handle
+        return counters
+
+    def connection_opened(self):
+        counters = self._counters()
+        counters.connections += 1
+        counters.active_connections += 1
+
+    def connection_closed(self):
+        self._counters().active_connections -= 1
+
+    def accept_queue_overflowed(self):
+        """Records that a listening socket's accept queue was found to be
+        full, meaning that the kernel was dropping new connections.
+        """
+        self._counters().accept_queue_overflows += 1
+
+    def request_shed(self, reason):
+        """Records that a request was turned away with a ``503`` because the
+        server was overloaded.  `reason` is either ``'in_flight'`` or
+        ``'queue_wait'``, depending on which limit was exceeded.
+        """
+        requests_shed = self._counters().requests_shed
+        requests_shed[reason] = requests_shed.get(reason, 0) + 1
+
+    def request_started(self):
+        self._counters().in_flight_requests += 1
+
+    def request_finished(
+                self, status, *, bytes_in, bytes_out,
+                first_byte, application, total
+            ):
+        """Records a completed request.
+
+        :param status:
+            The integer status code of the response, or ``None`` if no
+            response was sent.
+        :param first_byte:
+            Seconds between the request starting and the first byte of the
+            response being sent, or ``None`` if nothing was sent.
+        :param application:
+            Seconds spent in application code.
+        :param total:
+            Seconds between the request starting and the response finishing.
+        """
+        counters = self._counters()
+        counters.in_flight_requests -= 1
+        counters.requests += 1
+        counters.bytes_in += bytes_in
+        counters.bytes_out += bytes_out
+        if status is not None:
+            counters.responses[status] = counters.responses.get(status, 0) + 1
+        if first_byte is not None:
+            counters.timings['first_byte'].observe(first_byte)
+        counters.timings['application'].observe(application)
+        counters.timings['total'].observe(total)
+
+    def snapshot(self):
+        """Returns a dictionary containing the current totals.
+
+        Timings are returned as dictionaries with keys ``count``, ``sum`` and
+        ``buckets``, the last being a list of ``(upper_bound, count)`` pairs
+        with cumulative counts.
+        """
+        total = _Counters()
+        with self._lock:
+            total.merge(self._retired)
+            for counters in list(self._live):
+                total.merge(counters)
+
+        snapshot = {
+            'connections': total.connections,
+            'active_connections': total.active_connections,
+            'requests': total.requests,
+            'in_flight_requests': total.in_flight_requests,
+            'bytes_in': total.bytes_in,
+            'bytes_out': total.bytes_out,
+            'accept_queue_overflows': total.accept_queue_overflows,
+            'requests_shed': dict(total.requests_shed),
+            'responses': dict(total.responses),
+        }
+        if self.ssl_context is not None:
+            snapshot['tls_sessions'] = self.ssl_context.session_stats()
+        if self.response_cache is not None:
+            snapshot['response_cache'] = self.response_cache.stats()
+        if self.compression is not None:
+            snapshot['compression_cache'] = self.compression.stats()
+        for name in _TIMINGS:
+            histogram = total.timings[name]
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(
+                        LATENCY_BUCKETS + (float('inf'),), histogram.buckets
+                    ):
+                cumulative += count
+                buckets.append((bound, cumulative))
+            snapshot[name + '_seconds'] = {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'buckets': buckets,
+            }
+        return snapshot
+
+    def prometheus(self):
+        """Returns a snapshot formatted using the Prometheus text exposition
+        format.
+        """
+        return format_prometheus(self.snapshot())
+
+    def application(self, environ, start_response):
+        """WSGI application that serves the current metrics in the Prometheus
+        text exposition format.
+        """
+        body = self.prometheus().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+        ])
+        return [body]
+
+
+def _format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(bound)
+
+
+def format_prometheus(snapshot, *, prefix='verktyg_server'):
+    """Formats a snapshot returned by :meth:`ServerMetrics.snapshot` using the
+    Prometheus text exposition format.
+    """
+    lines = []
+
+    def metric(name, kind, help, value):
+        lines.append('# HELP %s_%s %s' % (prefix, name, help))
+        lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+        if isinstance(value, dict):
+            for labels, labelled_value in sorted(value.items()):
+                lines.append('%s_%s{%s} %s' % (
+                    prefix, name, labels, labelled_value,
+                ))
+        else:
+            lines.append('%s_%s %s' % (prefix, name, value))
+
+    metric(
+        'connections_total', 'counter',
+        "Connections accepted.", snapshot['connections'],
+    )
+    metric(
+        'active_connections', 'gauge',
+        "Connections currently open.", snapshot['active_connections'],
+    )
+    metric(
+        'requests_total', 'counter',
+        "Requests completed.", snapshot['requests'],
+    )
+    metric(
+        'in_flight_requests', 'gauge',
+        "Requests currently being handled.", snapshot['in_flight_requests'],
+    )
+    metric(
+        'request_bytes_total', 'counter',
+        "Bytes of request body read by the application.", snapshot['bytes_in'],
+    )
+    metric(
+        'response_bytes_total', 'counter',
+        "Bytes of response sent, including headers.", snapshot['bytes_out'],
+    )
+    metric(
+        'accept_queue_overflows_total', 'counter',
+        "Times a listening socket's accept queue was found to be full.",
+        snapshot['accept_queue_overflows'],
+    )
+    metric(
+        'requests_shed_total', 'counter',
+        "Requests turned away because the server was overloaded, by reason.",
+        {
+            'reason="%s"' % reason: count
+            for reason, count in snapshot['requests_shed'].items()
+        },
+    )
+    metric(
+        'responses_total', 'counter', "Responses sent, by status code.", {
+            'code="%d"' % status: count
+            for status, count in snapshot['responses'].items()
+        },
+    )
+
+    tls_sessions = snapshot.get('tls_sessions')
+    if tls_sessions is not None:
+        metric(
+            'tls_handshakes_total', 'counter',
+            "TLS handshakes completed.", tls_sessions['accept_good'],
+        )
+        metric(
+            'tls_session_hits_total', 'counter',
+            "TLS sessions resumed.", tls_sessions['hits'],
+        )
+        metric(
+            'tls_session_misses_total', 'counter',
+            "TLS session resumptions that failed.", tls_sessions['misses'],
+        )
+        metric(
+            'tls_session_timeouts_total', 'counter',
+            "TLS session resumptions with expired sessions.",
+            tls_sessions['timeouts'],
+        )
+        metric(
+            'tls_sessions_cached', 'gauge',
+            "TLS sessions currently in the session cache.",
+            tls_sessions['number'],
+        )
+
+    response_cache = snapshot.get('response_cache')
+    if response_cache is not None:
+        metric(
+            'response_cache_hits_total', 'counter',
+            "Requests answered from the response cache.",
+            response_cache['hits'],
+        )
+        metric(
+            'response_cache_misses_total', 'counter',
+            "Cacheable requests that had to be passed to the application.",
+            response_cache['misses'],
+        )
+        metric(
+            'response_cache_evictions_total', 'counter',
+            "Responses evicted from the response cache to make space.",
+            response_cache['evictions'],
+        )
+        metric(
+            'response_cache_entries', 'gauge',
+            "Responses currently stored in the response cache.",
+            response_cache['entries'],
+        )
+        metric(
+            'response_cache_bytes', 'gauge',
+            "Approximate size of the responses in the response cache.",
+            response_cache['size'],
+        )
+
+    compression_cache = snapshot.get('compression_cache')
+    if compression_cache is not None:
+        metric(
+            'compression_cache_hits_total', 'counter',
+            "Response bodies that did not need to be compressed again.",
+            compression_cache['hits'],
+        )
+        metric(
+            'compression_cache_misses_total', 'counter',
+            "Cacheable response bodies that had to be compressed.",
+            compression_cache['misses'],
+        )
+        metric(
+            'compression_cache_evictions_total', 'counter',
+            "Compressed bodies evicted from the cache to make space.",
+            compression_cache['evictions'],
+        )
+        metric(
+            'compression_cache_entries', 'gauge',
+            "Compressed bodies currently stored in the cache.",
+            compression_cache['entries'],
+        )
+        metric(
+            'compression_cache_bytes', 'gauge',
+            "Size of the compressed bodies in the cache.",
+            compression_cache['size'],
+        )
+
+    for name, help in [
+                ('first_byte', "Time from request start to first byte sent."),
+                ('application', "Time spent in the application."),
+                ('total', "Time from request start to response finished."),
+            ]:
+        timing = snapshot[name + '_seconds']
+        full_name = '%s_%s_seconds' % (prefix, name)
+        lines.append('# HELP %s %s' % (full_name, help))
+        lines.append('# TYPE %s histogram' % full_name)
+        for bound, count in timing['buckets']:
+            lines.append('%s_bucket{le="%s"} %d' % (
+                full_name, _format_bound(bound), count,
+            ))
+        lines.append('%s_sum %r' % (full_name, timing['sum']))
+        lines.append('%s_count %d' % (full_name, timing['count']))
+
+    return '\n'.join(lines) + '\n'
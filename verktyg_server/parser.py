@@ -0,0 +1,185 @@
+"""
+    verktyg_server.parser
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import re
+import functools
+
+
+# RFC 7230 `token`, which header names must match.
+_TOKEN = re.compile(rb"[!#$%&'*+\-.^_`|~0-9A-Za-z]+")
+
+# RFC 7230 `Content-Length`.  Stricter than `int`, which also accepts signs,
+# underscores and surrounding whitespace.
+_CONTENT_LENGTH = re.compile(r"[0-9]+")
+
+
+class RequestHeadError(Exception):
+    """Raised if the head of a request is malformed or too large.
+
+    :param status:
+        The status code of the error response that should be sent.
+    :param message:
+        A short explanation, sent as the reason phrase.
+    """
+    def __init__(self, status, message):
+        super(RequestHeadError, self).__init__(status, message)
+        self.status = status
+        self.message = message
+
+
+@functools.lru_cache(maxsize=512)
+def environ_key(header_name):
+    """Returns the key under which a request header should be stored in the
+    WSGI environ.
+    """
+    key = header_name.upper().replace('-', '_')
+    if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        return key
+    return 'HTTP_' + key
+
+
+def parse_request_line(line):
+    """Splits a raw request line into its method, target and protocol
+    version.
+
+    Returns ``None`` if the line is blank.  Requests with no version are
+    treated as HTTP/0.9, which only supports ``GET``.
+    """
+    words = line.split()
+    if not words:
+        return None
+
+    if len(words) == 3:
+        method, target, version = words
+        if not version.startswith(b'HTTP/'):
+            raise RequestHeadError(400, "Bad request version")
+        major, dot, minor = version[5:].partition(b'.')
+        if not (dot and major.isdigit() and minor.isdigit()):
+            raise RequestHeadError(400, "Bad request version")
+        major, minor = int(major), int(minor)
+        if major >= 2:
+            raise RequestHeadError(505, "Invalid HTTP version")
+        version = 'HTTP/%d.%d' % (major, minor)
+    elif len(words) == 2:
+        method, target = words
+        version = 'HTTP/0.9'
+        if method != b'GET':
+            raise RequestHeadError(400, "Bad HTTP/0.9 request type")
+    else:
+        raise RequestHeadError(400, "Bad request syntax")
+
+    return method.decode('iso-8859-1'), target.decode('iso-8859-1'), version
+
+
+class RequestHeaders(object):
+    """Read only, case insensitive view of the headers of a request.
+
+    Stands in for the :class:`email.message.Message` that
+    :class:`http.server.BaseHTTPRequestHandler` would create.  Where a header
+    is repeated, :meth:`get` returns the last value, so that the server
+    always agrees with the application about what the request contained.
+    """
+    def __init__(self, items, environ):
+        self._items = items
+        self._values = {key.lower(): value for key, value in items}
+
+        #: The WSGI environ entries for the headers.
+        self.environ = environ
+
+    def get(self, name, default=None):
+        return self._values.get(name.lower(), default)
+
+    def get_all(self, name, default=None):
+        name = name.lower()
+        values = [value for key, value in self._items if key.lower() == name]
+        return values or default
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return name.lower() in self._values
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        return [key for key, value in self._items]
+
+    def values(self):
+        return [value for key, value in self._items]
+
+    def items(self):
+        return list(self._items)
+
+
+def parse_headers(data, *, max_headers=100):
+    """Parses a block of raw header lines, up to and including the empty line
+    that ends it, in a single pass.
+
+    Obsolete line folding, whitespace between a header name and the colon,
+    and names that are not valid tokens are rejected, as they can be used to
+    smuggle headers past proxies that interpret them differently, as are
+    carriage returns and NUL characters outside of a line ending.  Headers
+    with an underscore in their name are dropped, as they would otherwise
+    share an environ key with the hyphenated header of the same name, for
+    example ``Transfer_Encoding`` with ``Transfer-Encoding``.
+    ``Content-Length`` must be a plain decimal number.
+
+    :param data:
+        The header block, as returned by
+        :meth:`verktyg_server.streams.SocketReader.readhead`.
+    :param max_headers:
+        The maximum number of headers to accept.
+
+    :returns:
+        A :class:`RequestHeaders` instance.
+    """
+    items = []
+    environ = {}
+
+    # Only a newline, optionally preceded by a carriage return, ends a line.
+    # Other line breaks recognised by `bytes.splitlines`, a bare carriage
+    # return in particular, are rejected below instead of being used to
+    # split a single header in two.
+    for line in data.split(b'\n'):
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        if not line:
+            break
+        if line[:1] in (b' ', b'\t'):
+            raise RequestHeadError(400, "Obsolete line folding")
+
+        name, colon, value = line.partition(b':')
+        if not colon or not _TOKEN.fullmatch(name):
+            raise RequestHeadError(400, "Bad header")
+        if b'\r' in value or b'\x00' in value:
+            raise RequestHeadError(400, "Bad header")
+        if b'_' in name:
+            continue
+
+        name = name.decode('iso-8859-1')
+        value = value.strip(b' \t').decode('iso-8859-1')
+
+        key = environ_key(name)
+        if key == 'CONTENT_LENGTH':
+            if not _CONTENT_LENGTH.fullmatch(value):
+                raise RequestHeadError(400, "Bad Content-Length")
+            if environ.get(key, value) != value:
+                raise RequestHeadError(400, "Conflicting Content-Length")
+
+        items.append((name, value))
+        if len(items) > max_headers:
+            raise RequestHeadError(431, "Too many headers")
+        environ[key] = value
+
+    return RequestHeaders(items, environ)
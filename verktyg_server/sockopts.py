@@ -0,0 +1,186 @@
+"""
+    verktyg_server.sockopts
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import sys
+import socket
+import struct
+
+import logging
+log = logging.getLogger('verktyg_server')
+
+
+_INET_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+
+def _is_inet(sock):
+    return sock.family in _INET_FAMILIES
+
+
+# The start of Linux's `struct tcp_info`: eight single byte fields, followed
+# by `tcpi_rto`, `tcpi_ato`, `tcpi_snd_mss`, `tcpi_rcv_mss`, `tcpi_unacked`
+# and `tcpi_sacked`.  For listening sockets, the last two are reused to hold
+# the length of the accept queue and its limit.
+_TCP_INFO = struct.Struct('8x6I')
+_HAS_ACCEPT_QUEUE_INFO = (
+    sys.platform.startswith('linux') and hasattr(socket, 'TCP_INFO')
+)
+
+
+def accept_queue(sock):
+    """Returns a ``(length, limit)`` tuple giving the number of connections
+    waiting to be accepted from the listening socket `sock`, and the number
+    that can wait before the kernel starts dropping new ones.
+
+    Only supported for TCP sockets on Linux.  Returns ``None`` elsewhere.
+    """
+    if not _HAS_ACCEPT_QUEUE_INFO or not _is_inet(sock):
+        return None
+    try:
+        info = sock.getsockopt(
+            socket.IPPROTO_TCP, socket.TCP_INFO, _TCP_INFO.size,
+        )
+    except OSError:
+        return None
+    if len(info) < _TCP_INFO.size:
+        return None
+    fields = _TCP_INFO.unpack(info)
+    return fields[4], fields[5]
+
+
+class SocketOptions(object):
+    """Options applied to listening sockets and to each connection accepted
+    from them.
+
+    The defaults are chosen to keep latency low: ``TCP_NODELAY`` is set on
+    accepted connections, so that small responses are not held back by
+    Nagle's algorithm waiting for an acknowledgement, and everything else is
+    left to the operating system.  Options that only make sense for TCP are
+    skipped for unix sockets, and options that the platform does not support
+    are skipped with a warning.
+
+    :param nodelay:
+        Set ``TCP_NODELAY`` on accepted connections.
+    :param defer_accept:
+        Number of seconds for which the kernel should hold on to a new
+        connection until the client sends some data, rather than waking the
+        server up to accept a connection that it can do nothing with.  Uses
+        ``TCP_DEFER_ACCEPT``, and so is only supported on Linux.
+    :param fastopen:
+        Length of the queue of pending ``TCP_FASTOPEN`` connections.  Allows
+        clients that have connected before to send their request with the
+        ``SYN`` packet.  Disabled if ``None``.
+    :param reuse_port:
+        Set ``SO_REUSEPORT`` on listening sockets.
+    :param recv_buffer:
+        Size in bytes of the kernel receive buffer, ``SO_RCVBUF``.
+    :param send_buffer:
+        Size in bytes of the kernel send buffer, ``SO_SNDBUF``.
+    :param keepalive:
+        Enable TCP keepalive probes on accepted connections, so that
+        connections to clients that have gone away are eventually closed.
+    :param keepalive_idle:
+        Seconds a connection must be idle before the first probe is sent.
+    :param keepalive_interval:
+        Seconds between probes.
+    :param keepalive_count:
+        Number of unanswered probes after which the connection is closed.
+    """
+    def __init__(
+                self, *, nodelay=True, defer_accept=None, fastopen=None,
+                reuse_port=False, recv_buffer=None, send_buffer=None,
+                keepalive=False, keepalive_idle=None, keepalive_interval=None,
+                keepalive_count=None
+            ):
+        self.nodelay = nodelay
+        self.defer_accept = defer_accept
+        self.fastopen = fastopen
+        self.reuse_port = reuse_port
+        self.recv_buffer = recv_buffer
+        self.send_buffer = send_buffer
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+
+        # Worked out once so that each accept only costs the system calls
+        # that are actually needed.
+        self._connection_options = self._resolve(
+            self._connection_settings()
+        )
+
+    def _listener_settings(self):
+        # Buffer sizes need to be set on the listening socket before it
+        # starts listening for the TCP window scale to take them into
+        # account.  Accepted connections inherit them.
+        if self.recv_buffer is not None:
+            yield 'SOL_SOCKET', 'SO_RCVBUF', self.recv_buffer
+        if self.send_buffer is not None:
+            yield 'SOL_SOCKET', 'SO_SNDBUF', self.send_buffer
+
+    def _inet_listener_settings(self):
+        if self.reuse_port:
+            yield 'SOL_SOCKET', 'SO_REUSEPORT', 1
+        if self.defer_accept is not None:
+            yield 'IPPROTO_TCP', 'TCP_DEFER_ACCEPT', int(self.defer_accept)
+        if self.fastopen is not None:
+            yield 'IPPROTO_TCP', 'TCP_FASTOPEN', self.fastopen
+
+    def _connection_settings(self):
+        if self.nodelay:
+            yield 'IPPROTO_TCP', 'TCP_NODELAY', 1
+        if self.keepalive:
+            yield 'SOL_SOCKET', 'SO_KEEPALIVE', 1
+            if self.keepalive_idle is not None:
+                # macOS calls this `TCP_KEEPALIVE`.
+                name = 'TCP_KEEPIDLE'
+                if not hasattr(socket, name):
+                    name = 'TCP_KEEPALIVE'
+                yield 'IPPROTO_TCP', name, int(self.keepalive_idle)
+            if self.keepalive_interval is not None:
+                yield (
+                    'IPPROTO_TCP', 'TCP_KEEPINTVL',
+                    int(self.keepalive_interval),
+                )
+            if self.keepalive_count is not None:
+                yield 'IPPROTO_TCP', 'TCP_KEEPCNT', self.keepalive_count
+
+    def _resolve(self, settings):
+        options = []
+        for level, name, value in settings:
+            if not hasattr(socket, name):
+                log.warning(
+                    "socket option %s is not supported on this platform",
+                    name,
+                )
+                continue
+            options.append(
+                (getattr(socket, level), getattr(socket, name), value)
+            )
+        return options
+
+    def configure_listener(self, sock):
+        """Applies the options for listening sockets to `sock`.  Should be
+        called before the socket is bound, though most options will still be
+        applied to sockets, such as those inherited from a parent process,
+        that are already listening.
+        """
+        settings = list(self._listener_settings())
+        if _is_inet(sock):
+            settings.extend(self._inet_listener_settings())
+        for level, option, value in self._resolve(settings):
+            sock.setsockopt(level, option, value)
+
+    def configure_connection(self, sock):
+        """Applies the options for accepted connections to `sock`.  All of
+        them are TCP options, so unix socket connections are left alone.
+        """
+        if not _is_inet(sock):
+            return
+        for level, option, value in self._connection_options:
+            sock.setsockopt(level, option, value)
@@ -12,8 +12,21 @@ from uuid import uuid4
 from datetime import datetime, timedelta
 import os
 import tempfile
+import time
+import threading
 import ssl
 
+import logging
+log = logging.getLogger('verktyg_server')
+
+
+#: Adhoc certificates are valid for this long after being generated.
+ADHOC_VALIDITY = timedelta(days=16)
+
+#: Cached adhoc certificates will not be used once they are this close to
+#: expiring.
+ADHOC_EXPIRY_MARGIN = timedelta(days=1)
+
 
 def _serialize_private_key(key):
     from cryptography.hazmat.primitives import serialization
@@ -68,15 +81,38 @@ def _key_usage_extension(
     )
 
 
-def generate_adhoc_ssl_pair(*, cn=None, host=None):
+def _generate_private_key(key_type):
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec
+    from cryptography.hazmat.backends import default_backend
+
+    if key_type == 'rsa':
+        return rsa.generate_private_key(
+            65537, 2048, backend=default_backend()
+        )
+    if key_type == 'ec':
+        return ec.generate_private_key(
+            ec.SECP256R1(), backend=default_backend()
+        )
+    raise ValueError("unsupported key type %r" % key_type)
+
+
+def generate_adhoc_ssl_pair(*, cn=None, host=None, key_type='rsa'):
+    """Generates a new self-signed certificate and private key.
+
+    :param key_type:
+        Either ``'rsa'`` for a 2048 bit RSA key, or ``'ec'`` for an elliptic
+        curve key, which is much faster to generate.
+
+    :returns:
+        A tuple containing the PEM encoded certificate and private key.
+    """
     from cryptography import x509
-    from cryptography.hazmat.primitives.asymmetric import rsa
     from cryptography.hazmat.primitives.hashes import SHA256
     from cryptography.hazmat.backends import default_backend
 
     now = datetime.utcnow()
     not_valid_before = now
-    not_valid_after = now + timedelta(days=16)
+    not_valid_after = now + ADHOC_VALIDITY
 
     if cn and host or not (cn or host):
         raise ValueError("Please specify one of common name or host")
@@ -90,7 +126,7 @@ def generate_adhoc_ssl_pair(*, cn=None, host=None):
         ),
     ])
 
-    key = rsa.generate_private_key(65537, 2048, backend=default_backend())
+    key = _generate_private_key(key_type)
 
     bldr = x509.CertificateBuilder()\
         .serial_number(uuid4().int)\
@@ -99,7 +135,10 @@ def generate_adhoc_ssl_pair(*, cn=None, host=None):
         .not_valid_before(not_valid_before)\
         .not_valid_after(not_valid_after)\
         .add_extension(
-            _key_usage_extension(key_agreement=True), critical=True
+            _key_usage_extension(
+                digital_signature=(key_type == 'ec'), key_agreement=True,
+            ),
+            critical=True
         )\
         .public_key(key.public_key())
 
@@ -108,40 +147,336 @@ def generate_adhoc_ssl_pair(*, cn=None, host=None):
     return _serialize_certificate(cert), _serialize_private_key(key)
 
 
-def make_adhoc_ssl_context():
-    """Generates an adhoc SSL context for the development server."""
-    cert, key = generate_adhoc_ssl_pair(host='example.com')
+def _adhoc_pair_expiry(cert):
+    cert = _deserialize_certificate(cert)
+    try:
+        not_valid_after = cert.not_valid_after_utc.replace(tzinfo=None)
+    except AttributeError:  # cryptography < 42
+        not_valid_after = cert.not_valid_after
+    return not_valid_after - ADHOC_EXPIRY_MARGIN
+
+
+_adhoc_pairs = {}
+_adhoc_pairs_lock = threading.Lock()
+
+
+def _adhoc_pair_files(cache_dir, host, key_type):
+    prefix = os.path.join(cache_dir, 'adhoc-%s-%s' % (host, key_type))
+    return prefix + '.cert.pem', prefix + '.key.pem'
+
+
+def _read_cached_adhoc_pair(cert_file, key_file):
+    try:
+        with open(cert_file, 'rb') as f:
+            cert = f.read()
+        with open(key_file, 'rb') as f:
+            key = f.read()
+        expires = _adhoc_pair_expiry(cert)
+    except (OSError, ValueError):
+        return None
+    return cert, key, expires
+
+
+def _write_cached_adhoc_pair(cert_file, key_file, cert, key):
+    # Each file is written under a temporary name and then moved into place
+    # so that concurrent processes never see a partially written file.
+    for filename, data, mode in [
+                (key_file, key, 0o600),
+                (cert_file, cert, 0o644),
+            ]:
+        partial = '%s.%d.tmp' % (filename, os.getpid())
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with open(fd, 'wb') as f:
+            f.write(data)
+        os.replace(partial, filename)
+
+
+def get_adhoc_ssl_pair(*, host='example.com', key_type='rsa', cache_dir=None):
+    """Returns a self-signed certificate and private key for `host`,
+    reusing an earlier pair if one is available and not about to expire.
+
+    Pairs are cached in memory for the lifetime of the process, and, if
+    `cache_dir` is given, in files in that directory so that they can be
+    reused by later processes.
+
+    :returns:
+        A tuple containing the PEM encoded certificate and private key.
+    """
+    cache_key = (host, key_type, cache_dir)
+    if cache_dir is not None:
+        cert_file, key_file = _adhoc_pair_files(cache_dir, host, key_type)
+
+    with _adhoc_pairs_lock:
+        cached = _adhoc_pairs.get(cache_key)
+
+        if cached is None and cache_dir is not None:
+            cached = _read_cached_adhoc_pair(cert_file, key_file)
+
+        if cached is None or cached[2] <= datetime.utcnow():
+            cert, key = generate_adhoc_ssl_pair(host=host, key_type=key_type)
+            cached = cert, key, _adhoc_pair_expiry(cert)
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                _write_cached_adhoc_pair(cert_file, key_file, cert, key)
+
+        _adhoc_pairs[cache_key] = cached
+
+    cert, key, expires = cached
+    return cert, key
+
+
+def _load_cert_chain_from_memory(context, cert, key):
+    if hasattr(os, 'memfd_create'):
+        # Expose an anonymous in-memory file through procfs, so that nothing
+        # is ever written to disk.
+        fd = os.memfd_create('verktyg-adhoc', os.MFD_CLOEXEC)
+        try:
+            os.write(fd, cert + key)
+            context.load_cert_chain('/proc/self/fd/%d' % fd)
+            return
+        except FileNotFoundError:
+            # No procfs.
+            pass
+        finally:
+            os.close(fd)
 
     with contextlib.ExitStack() as clean_stack:
-        with contextlib.ExitStack() as close_stack:
-            cert_handle, cert_file = tempfile.mkstemp(
-                prefix='verktyg-adhoc-', suffix='.cert.pem'
-            )
-            close_stack.callback(os.close, cert_handle)
-            clean_stack.callback(os.remove, cert_file)
+        handle, filename = tempfile.mkstemp(
+            prefix='verktyg-adhoc-', suffix='.pem'
+        )
+        clean_stack.callback(os.remove, filename)
+        with open(handle, 'wb') as f:
+            f.write(cert + key)
+
+        context.load_cert_chain(filename)
+
+
+def make_adhoc_ssl_context(
+            *, host='example.com', key_type='rsa', cache_dir=None
+        ):
+    """Generates an adhoc SSL context for the development server.
+
+    Certificates are reused for as long as they remain valid.  See
+    :func:`get_adhoc_ssl_pair`.
+    """
+    cert, key = get_adhoc_ssl_pair(
+        host=host, key_type=key_type, cache_dir=cache_dir,
+    )
 
-            key_handle, key_file = tempfile.mkstemp(
-                prefix='verktyg-adhoc-', suffix='.key.pem'
-            )
-            close_stack.callback(os.close, key_handle)
-            clean_stack.callback(os.remove, key_file)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    _load_cert_chain_from_memory(context, cert, key)
+    configure_session_resumption(context)
 
-            os.write(cert_handle, cert)
-            os.write(key_handle, key)
+    return context
 
-        return load_ssl_context(cert_file, key_file)
 
+def configure_session_resumption(
+            context, *, session_tickets=True, num_tickets=None
+        ):
+    """Configures how a server side SSL context allows clients to resume
+    earlier sessions, skipping the expensive part of the handshake.
+
+    Sessions are cached by OpenSSL in memory, and can be resumed by clients
+    that present the session ID.  If `session_tickets` is set, clients can
+    instead be given an encrypted ticket containing the session state, which
+    any process holding the same ticket keys can decrypt.  OpenSSL generates
+    the ticket keys when the context is created, so pre-forked workers that
+    inherit a context created by the parent will all accept each other's
+    tickets, whereas a session ID can only be resumed by the worker that
+    issued it.
+
+    The size of the session cache and the lifetime of sessions are left at
+    OpenSSL's defaults, as the :mod:`ssl` module does not expose them.
+
+    :param context:
+        The :class:`ssl.SSLContext` to modify.
+    :param session_tickets:
+        Whether to issue session tickets.
+    :param num_tickets:
+        Number of TLS 1.3 session tickets to issue after each full handshake.
+        Clients use each ticket only once, so should be at least the number
+        of connections that a client is expected to open in parallel.
+    """
+    if session_tickets:
+        context.options &= ~ssl.OP_NO_TICKET
+    else:
+        context.options |= ssl.OP_NO_TICKET
 
-def load_ssl_context(cert_file, key_file=None):
+    if num_tickets is not None:
+        context.num_tickets = num_tickets
+
+    return context
+
+
+def load_ssl_context(
+            cert_file, key_file=None, *, session_tickets=True,
+            num_tickets=None
+        ):
     """Creates an SSL context from a certificate and private key file.
 
+    The context should be created before forking any worker processes, so
+    that they share session ticket keys.  See
+    :func:`configure_session_resumption`.
+
     :param cert_file:
         Path of the certificate to use.
     :param key_file:
         Path of the private key to use. If not given, the key will be obtained
         from the certificate file.
+    :param session_tickets:
+        Whether to issue session tickets to clients.
+    :param num_tickets:
+        Number of TLS 1.3 session tickets to issue after each full handshake.
     """
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     context.load_cert_chain(cert_file, key_file)
 
+    configure_session_resumption(
+        context, session_tickets=session_tickets, num_tickets=num_tickets,
+    )
+
     return context
+
+
+def _file_signature(filename):
+    st = os.stat(filename)
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class _WatchedCertificate(object):
+    def __init__(self, cert_file, key_file, load):
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self._load = load
+
+        self._lock = threading.Lock()
+        self._signature = self._stat()
+        self._last_checked = time.monotonic()
+        self.context = load(cert_file, key_file)
+
+    def _stat(self):
+        return tuple(
+            _file_signature(filename)
+            for filename in (self.cert_file, self.key_file)
+            if filename is not None
+        )
+
+    def check(self, interval):
+        """Replaces :attr:`context` if the files have changed since they were
+        last loaded.  Files are checked at most once every `interval` seconds,
+        or never if `interval` is ``None``.
+        """
+        if interval is None:
+            return
+        now = time.monotonic()
+        if now - self._last_checked < interval:
+            return
+        # Only one thread needs to do the checking.  The others can carry on
+        # using the current context in the meantime.
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._last_checked = now
+            try:
+                signature = self._stat()
+                if signature == self._signature:
+                    return
+                context = self._load(self.cert_file, self.key_file)
+            except (OSError, ssl.SSLError):
+                # Most likely the certificate and key are in the process of
+                # being replaced and don't match.  Keep using the old ones
+                # and try again next time.
+                log.warning(
+                    "could not reload certificate %r", self.cert_file,
+                    exc_info=True,
+                )
+                return
+            self._signature = signature
+            self.context = context
+            log.info("reloaded certificate %r", self.cert_file)
+        finally:
+            self._lock.release()
+
+
+class CertificateStore(object):
+    """Serves certificates for one or more hostnames from a single listening
+    socket, reloading them whenever the files they were loaded from change.
+
+    The certificate for each new connection is chosen by a
+    :attr:`ssl.SSLContext.sni_callback`, based on the hostname requested by
+    the client.  Clients that don't request a hostname, or request one that
+    isn't known, get the default certificate.  Rotating certificates doesn't
+    require a restart, and doesn't affect connections that are already open.
+
+    Contexts for each certificate are created with :func:`load_ssl_context`.
+    Session caching and tickets are handled by the context returned by
+    :meth:`make_context`, so sessions can be resumed across certificate
+    reloads.
+
+    :param check_interval:
+        Minimum number of seconds between checks for changes to each
+        certificate's files, or ``None`` to never reload them.
+    """
+    def __init__(
+                self, *, check_interval=1.0, session_tickets=True,
+                num_tickets=None
+            ):
+        self.check_interval = check_interval
+        self._session_tickets = session_tickets
+        self._num_tickets = num_tickets
+
+        self._default = None
+        self._hostnames = {}
+
+    def _load(self, cert_file, key_file):
+        return load_ssl_context(
+            cert_file, key_file, session_tickets=self._session_tickets,
+            num_tickets=self._num_tickets,
+        )
+
+    def add(self, cert_file, key_file=None, *, hostnames=None):
+        """Loads a certificate and private key.
+
+        :param hostnames:
+            A list of hostnames to use the certificate for.  Names can start
+            with a ``*.`` wildcard.  If not given, the certificate will be
+            used as the default.
+        """
+        certificate = _WatchedCertificate(cert_file, key_file, self._load)
+        if not hostnames:
+            self._default = certificate
+        for hostname in hostnames or ():
+            self._hostnames[hostname.lower()] = certificate
+
+    def _lookup(self, server_name):
+        if server_name is None:
+            return self._default
+
+        server_name = server_name.lower()
+        certificate = self._hostnames.get(server_name)
+        if certificate is None:
+            _, _, parent = server_name.partition('.')
+            certificate = self._hostnames.get('*.' + parent)
+        if certificate is None:
+            certificate = self._default
+        return certificate
+
+    def _sni_callback(self, ssl_object, server_name, context):
+        certificate = self._lookup(server_name)
+        if certificate is None:
+            return None
+        certificate.check(self.check_interval)
+        if certificate.context is not context:
+            ssl_object.context = certificate.context
+        return None
+
+    def make_context(self):
+        """Returns a new context that can be used to wrap the listening
+        socket.
+        """
+        if self._default is None:
+            raise ValueError("no default certificate")
+
+        context = self._load(self._default.cert_file, self._default.key_file)
+        context.sni_callback = self._sni_callback
+        return context
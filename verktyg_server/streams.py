@@ -0,0 +1,454 @@
+"""
+    verktyg_server.streams
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import re
+
+
+_CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]+")
+
+
+class MalformedBodyError(IOError):
+    """Raised when reading a request body that was not correctly framed.
+    If the response has not yet been started, the server will answer with a
+    ``400 Bad Request``.
+    """
+
+
+def _readinto(rfile, buffer):
+    if hasattr(rfile, 'readinto'):
+        return rfile.readinto(buffer)
+    data = rfile.read(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+
+class _Input(object):
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def close(self):
+        pass
+
+
+def _head_length(buffer, start, searched):
+    # Returns the length of the header block starting at `start`, including
+    # the empty line that ends it, or `None` if the end hasn't been received
+    # yet.
+    if buffer.startswith(b'\r\n', start):
+        return 2
+    if buffer.startswith(b'\n', start):
+        return 1
+    end = buffer.find(b'\n\r\n', start + searched)
+    if end >= 0:
+        # Lines ending in a bare newline are tolerated, but only need to be
+        # looked for up to the first properly terminated block.
+        bare = buffer.find(b'\n\n', start + searched, end + 2)
+        if bare >= 0:
+            return bare + 2 - start
+        return end + 3 - start
+    end = buffer.find(b'\n\n', start + searched)
+    if end >= 0:
+        return end + 2 - start
+    return None
+
+
+class SocketReader(_Input):
+    """Buffered, read only file-like object wrapping a socket.
+
+    Behaves like the reader returned by :meth:`socket.socket.makefile`, but
+    can also report how much data it is holding on to.  A request handler
+    can use this to tell if the next request on a keep-alive connection has
+    already been received, for example because the client is pipelining
+    requests, without making any system calls.
+
+    :param sock:
+        The connected socket to read from.
+    :param buffer_size:
+        The maximum number of bytes to ask the socket for at once.
+    """
+    def __init__(self, sock, buffer_size=65536):
+        self._sock = sock
+        self._buffer_size = buffer_size
+        self._buffer = b''
+        self._pos = 0
+        self.closed = False
+
+    @property
+    def buffered(self):
+        """The number of bytes that have been received from the socket but
+        not yet read.
+        """
+        return len(self._buffer) - self._pos
+
+    def _take(self, size):
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def _fill(self):
+        """Receives more data from the socket, keeping anything that has not
+        been read yet.  Returns ``False`` if the client has stopped sending.
+        """
+        data = self._sock.recv(self._buffer_size)
+        if not data:
+            return False
+        if self._pos < len(self._buffer):
+            data = self._buffer[self._pos:] + data
+        self._buffer = data
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._take(self.buffered)]
+            while self._fill():
+                chunks.append(self._take(self.buffered))
+            return b''.join(chunks)
+
+        if self.buffered >= size:
+            return self._take(size)
+
+        buffer = bytearray(size)
+        count = self.readinto(buffer)
+        del buffer[count:]
+        return bytes(buffer)
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = None
+
+        searched = 0
+        while True:
+            end = self._buffer.find(b'\n', self._pos + searched)
+            if end >= 0:
+                length = end + 1 - self._pos
+                break
+
+            length = self.buffered
+            if size is not None and length >= size:
+                break
+            searched = length
+            if not self._fill():
+                break
+
+        if size is not None:
+            length = min(length, size)
+        return self._take(length)
+
+    def readhead(self, size=-1):
+        """Reads a block of header lines, up to and including the empty line
+        that ends it, with a single search of the buffer rather than one per
+        line.  Stops early after `size` bytes, or if the stream ends.
+        """
+        if size is None or size < 0:
+            size = None
+
+        searched = 0
+        while True:
+            length = _head_length(self._buffer, self._pos, searched)
+            if length is not None:
+                break
+
+            length = self.buffered
+            if size is not None and length >= size:
+                break
+            # The end of the block could straddle the new data.
+            searched = max(0, length - 2)
+            if not self._fill():
+                break
+
+        if size is not None:
+            length = min(length, size)
+        return self._take(length)
+
+    def readinto(self, buffer):
+        """Reads directly into a writable buffer.  Large reads are received
+        straight into it once anything already buffered has been used up.
+        Only returns less than the length of the buffer if the stream ends.
+        """
+        view = memoryview(buffer).cast('B')
+        count = 0
+        while count < len(view):
+            if not self.buffered and len(view) - count >= self._buffer_size:
+                received = self._sock.recv_into(view[count:])
+                if not received:
+                    break
+                count += received
+                continue
+
+            if not self.buffered and not self._fill():
+                break
+            size = min(self.buffered, len(view) - count)
+            view[count:count + size] = (
+                self._buffer[self._pos:self._pos + size]
+            )
+            self._pos += size
+            count += size
+        return count
+
+    def close(self):
+        self.closed = True
+        self._buffer = b''
+        self._pos = 0
+
+
+class LimitedInput(_Input):
+    """Read only file-like object that stops at the end of a request body of
+    known length, so that applications can't read past it into the next
+    request, or block waiting for data that the client will never send.
+
+    :param rfile:
+        The buffered stream that the request was read from.
+    :param length:
+        The length of the request body in bytes.
+    """
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self._length = length
+        self._remaining = length
+
+    @property
+    def eof(self):
+        """``True`` once the whole body has been read."""
+        return not self._remaining
+
+    @property
+    def bytes_read(self):
+        """The number of bytes of the body that have been read so far."""
+        return self._length - self._remaining
+
+    def _check(self, data, expected):
+        if len(data) < expected:
+            raise IOError("client disconnected during request body")
+        self._remaining -= len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        if not size:
+            return b''
+        return self._check(self._rfile.read(size), size)
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        if not size:
+            return b''
+        line = self._rfile.readline(size)
+        return self._check(line, 1)
+
+    def readinto(self, buffer):
+        """Reads directly into a writable buffer, avoiding the creation of a
+        new bytes object.  Returns the number of bytes read.
+        """
+        view = memoryview(buffer).cast('B')
+        size = min(len(view), self._remaining)
+        if not size:
+            return 0
+        count = _readinto(self._rfile, view[:size])
+        if count < size:
+            raise IOError("client disconnected during request body")
+        self._remaining -= count
+        return count
+
+    def discard(self, limit):
+        """Reads and throws away the rest of the body, so that the next
+        request can be read from the stream.
+
+        Returns ``False``, without reading anything, if there are more than
+        `limit` bytes left.
+        """
+        if self._remaining > limit:
+            return False
+
+        buffer = bytearray(min(self._remaining, 65536))
+        while self._remaining:
+            self.readinto(buffer)
+        return True
+
+
+class ChunkedInput(_Input):
+    """Read only file-like object that decodes a request body sent using
+    chunked transfer encoding.
+
+    :param rfile:
+        The buffered stream that the request was read from.
+    :param max_line_length:
+        The maximum permitted length of a chunk header or trailer line.
+    """
+    def __init__(self, rfile, *, max_line_length=65536):
+        self._rfile = rfile
+        self._max_line_length = max_line_length
+
+        # Number of bytes of data left in the current chunk.
+        self._remaining = 0
+
+        #: The number of bytes of decoded body data read so far.
+        self.bytes_read = 0
+
+        #: Set to ``True`` once the final chunk and any trailers have been
+        #: read.
+        self.eof = False
+
+    def _readline(self):
+        line = self._rfile.readline(self._max_line_length + 1)
+        if not line.endswith(b'\n'):
+            if len(line) > self._max_line_length:
+                raise MalformedBodyError("chunk header too long")
+            raise IOError("client disconnected during chunked request body")
+        return line
+
+    def _read(self, size):
+        data = self._rfile.read(size)
+        if len(data) < size:
+            raise IOError("client disconnected during chunked request body")
+        return data
+
+    def _start_chunk(self):
+        line = self._readline()
+
+        # Chunk extensions are permitted, but we don't understand any.
+        # Anything else that `int` would accept, such as signs, underscores
+        # or a `0x` prefix, could be framed differently by a proxy.
+        size = line.split(b';', 1)[0].rstrip(b'\r\n')
+        if not _CHUNK_SIZE.fullmatch(size):
+            raise MalformedBodyError("invalid chunk size %r" % size)
+        size = int(size, 16)
+
+        if size == 0:
+            # Last chunk.  Discard any trailers.
+            while self._readline() not in (b'\r\n', b'\n'):
+                pass
+            self.eof = True
+
+        self._remaining = size
+
+    def _end_chunk(self):
+        if self._read(2) != b'\r\n':
+            raise MalformedBodyError("chunk data not terminated by CRLF")
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(65536), b''))
+
+        result = []
+        while size > 0 and not self.eof:
+            if not self._remaining:
+                self._start_chunk()
+                continue
+
+            data = self._read(min(size, self._remaining))
+            self._remaining -= len(data)
+            self.bytes_read += len(data)
+            size -= len(data)
+            result.append(data)
+
+            if not self._remaining:
+                self._end_chunk()
+
+        return b''.join(result)
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = float('inf')
+
+        result = []
+        while size > 0 and not self.eof:
+            if not self._remaining:
+                self._start_chunk()
+                continue
+
+            data = self._rfile.readline(min(size, self._remaining))
+            if not data:
+                raise IOError(
+                    "client disconnected during chunked request body"
+                )
+            self._remaining -= len(data)
+            self.bytes_read += len(data)
+            size -= len(data)
+            result.append(data)
+
+            if not self._remaining:
+                self._end_chunk()
+
+            if data.endswith(b'\n'):
+                break
+
+        return b''.join(result)
+
+    def readinto(self, buffer):
+        """Reads directly into a writable buffer, avoiding the creation of a
+        new bytes object.  Returns the number of bytes read.
+        """
+        view = memoryview(buffer).cast('B')
+        count = 0
+        while count < len(view) and not self.eof:
+            if not self._remaining:
+                self._start_chunk()
+                continue
+
+            size = min(len(view) - count, self._remaining)
+            read = _readinto(self._rfile, view[count:count + size])
+            if read < size:
+                raise IOError(
+                    "client disconnected during chunked request body"
+                )
+            self._remaining -= read
+            self.bytes_read += read
+            count += read
+
+            if not self._remaining:
+                self._end_chunk()
+
+        return count
+
+    def discard(self, limit):
+        """Reads and throws away the rest of the body, so that the next
+        request can be read from the stream.
+
+        Returns ``False`` if the end of the body was not reached after
+        reading `limit` bytes.
+        """
+        buffer = bytearray(65536)
+        while not self.eof and limit > 0:
+            limit -= self.readinto(memoryview(buffer)[:limit])
+        return self.eof
+
+
+class FileWrapper(object):
+    """Implementation of ``wsgi.file_wrapper``.
+
+    Iterating over the wrapper reads the file in blocks of `blksize` bytes,
+    but if an application returns a wrapper around a regular file, the server
+    can instead send the contents of the file directly from the page cache.
+
+    :param filelike:
+        A file-like object opened in binary mode.  The response will start at
+        the object's current position.
+    :param blksize:
+        Size of the blocks to read when iterating.
+    """
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
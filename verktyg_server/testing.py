@@ -7,29 +7,63 @@
     :license:
         BSD, see LICENSE for more details.
 """
+import os
+import shutil
+import tempfile
 from threading import Thread
 
-from verktyg_server import make_server, make_inet_socket
+from verktyg_server import make_server, make_inet_socket, make_unix_socket
 
 
 class TestServer(object):
+    """Runs a server for `app` in a background thread until closed.
+
+    By default the server listens on a random port on localhost.  If
+    `unix_socket` is set, it will instead listen on a unix socket in a new
+    temporary directory, which is removed when the server is closed.
+
+    `threaded`, `threads`, `processes`, `workers` and `event_loop` are
+    passed on to :func:`verktyg_server.make_server` to choose which kind of
+    server to run.
+    """
     def __init__(
-                self, app, *, threaded=False,
-                request_handler=None, ssl_context=None
+                self, app, *, threaded=False, threads=None, processes=1,
+                workers=None, event_loop=False, request_handler=None,
+                ssl_context=None, unix_socket=False
             ):
         self._app = app
         self._threaded = threaded
+        self._threads = threads
+        self._processes = processes
+        self._workers = workers
+        self._event_loop = event_loop
         self._request_handler = request_handler
         self._ssl_context = ssl_context
 
         self._host = 'localhost'
-
-        socket = make_inet_socket(self.host, 0, ssl_context=self._ssl_context)
-        self._port = socket.getsockname()[1]
+        self._port = None
+        self._directory = None
+        self._socket_path = None
+
+        if unix_socket:
+            self._directory = tempfile.mkdtemp()
+            self._socket_path = os.path.join(self._directory, 'socket')
+            socket = make_unix_socket(
+                self._socket_path, ssl_context=self._ssl_context,
+            )
+        else:
+            socket = make_inet_socket(
+                self.host, 0, ssl_context=self._ssl_context,
+            )
+            self._port = socket.getsockname()[1]
 
         self._server = make_server(
             socket, self._app,
             threaded=self._threaded,
+            threads=self._threads,
+            processes=self._processes,
+            workers=self._workers,
+            event_loop=self._event_loop,
             request_handler=self._request_handler,
         )
 
@@ -42,6 +76,8 @@ class TestServer(object):
         self.closed = True
         self._server.shutdown()
         self._thread.join()
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
 
     @property
     def protocol(self):
@@ -55,8 +91,22 @@ class TestServer(object):
     def port(self):
         return self._port
 
+    @property
+    def socket_path(self):
+        """The path of the unix socket that the server is listening on, or
+        ``None`` if it is listening on a TCP port.
+        """
+        return self._socket_path
+
+    @property
+    def server(self):
+        """The underlying server instance."""
+        return self._server
+
     @property
     def address(self):
+        if self._socket_path is not None:
+            return 'unix://%s' % self._socket_path
         return '%s://%s:%s/' % (self.protocol, self.host, self.port)
 
     def __enter__(self):
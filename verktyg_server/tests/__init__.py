@@ -11,6 +11,8 @@ import unittest
 
 from verktyg_server.tests import (
     test_ssl, test_sockets, test_serving, test_testing, test_argparse,
+    test_asyncio, test_streams, test_metrics, test_accesslog, test_parser,
+    test_cache, test_compression,
 )
 
 
@@ -21,4 +23,11 @@ suite = unittest.TestSuite((
     loader.loadTestsFromModule(test_serving),
     loader.loadTestsFromModule(test_testing),
     loader.loadTestsFromModule(test_argparse),
+    loader.loadTestsFromModule(test_asyncio),
+    loader.loadTestsFromModule(test_streams),
+    loader.loadTestsFromModule(test_metrics),
+    loader.loadTestsFromModule(test_accesslog),
+    loader.loadTestsFromModule(test_parser),
+    loader.loadTestsFromModule(test_cache),
+    loader.loadTestsFromModule(test_compression),
 ))
@@ -0,0 +1,126 @@
+"""
+    verktyg_server.tests.test_accesslog
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import io
+import json
+import unittest
+
+from http.client import HTTPConnection
+from threading import Thread, Event
+
+from verktyg_server.accesslog import (
+    AccessLog, AccessLogRecord, format_common, format_json,
+)
+from verktyg_server import make_inet_socket, make_server
+
+import logging
+logging.disable(logging.CRITICAL)
+
+
+def _make_record(**kwargs):
+    fields = {
+        'time': 0, 'remote_addr': '127.0.0.1', 'method': 'GET',
+        'path': '/', 'protocol': 'HTTP/1.1', 'status': 200, 'size': 12,
+        'duration': 0.25,
+    }
+    fields.update(kwargs)
+    return AccessLogRecord(**fields)
+
+
+class _BlockingOutput(io.StringIO):
+    def __init__(self):
+        super(_BlockingOutput, self).__init__()
+        self.unblock = Event()
+
+    def write(self, data):
+        self.unblock.wait()
+        return super(_BlockingOutput, self).write(data)
+
+
+class AccessLogTestCase(unittest.TestCase):
+    def test_format_common(self):
+        self.assertEqual(
+            format_common(_make_record()),
+            '127.0.0.1 - - [01/Jan/1970:00:00:00 +0000] '
+            '"GET / HTTP/1.1" 200 12 0.250000\n',
+        )
+        self.assertEqual(
+            format_common(_make_record(method=None, path=None, size=None)),
+            '127.0.0.1 - - [01/Jan/1970:00:00:00 +0000] '
+            '"- - HTTP/1.1" 200 - 0.250000\n',
+        )
+
+    def test_format_json(self):
+        line = format_json(_make_record())
+        self.assertTrue(line.endswith('\n'))
+        self.assertEqual(json.loads(line)['path'], '/')
+        self.assertEqual(json.loads(line)['status'], 200)
+
+    def test_log(self):
+        output = io.StringIO()
+        access_log = AccessLog(output, format='json')
+        for n in range(10):
+            access_log.log(_make_record(size=n))
+        access_log.close()
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(
+            [json.loads(line)['size'] for line in lines], list(range(10)),
+        )
+
+    def test_overflow(self):
+        output = _BlockingOutput()
+        access_log = AccessLog(output, queue_size=2)
+        try:
+            for n in range(10):
+                access_log.log(_make_record())
+
+            # One record may already have been taken by the writer.
+            self.assertIn(access_log.dropped, (7, 8))
+        finally:
+            output.unblock.set()
+            access_log.close()
+
+        self.assertEqual(
+            len(output.getvalue().splitlines()), 10 - access_log.dropped,
+        )
+
+
+class AccessLogServingTestCase(unittest.TestCase):
+    def test_serving(self):
+        def application(environ, start_response):
+            start_response('404 Not Found', [])
+            return [b"not found"]
+
+        output = io.StringIO()
+        access_log = AccessLog(output, format='json')
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, access_log=access_log)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            conn = HTTPConnection('localhost', port)
+            conn.request('GET', '/missing?a=b')
+            self.assertEqual(conn.getresponse().read(), b"not found")
+        finally:
+            server.shutdown()
+            thread.join()
+
+        record = json.loads(output.getvalue())
+        self.assertEqual(record['remote_addr'], '127.0.0.1')
+        self.assertEqual(record['method'], 'GET')
+        self.assertEqual(record['path'], '/missing?a=b')
+        self.assertEqual(record['protocol'], 'HTTP/1.1')
+        self.assertEqual(record['status'], 404)
+        self.assertGreater(record['size'], len(b"not found"))
+        self.assertGreaterEqual(record['duration'], 0)
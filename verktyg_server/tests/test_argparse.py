@@ -7,10 +7,15 @@
     :license:
         BSD, see LICENSE for more details.
 """
+import os
 import unittest
 import argparse
 
-from verktyg_server.argparse import add_arguments
+import verktyg_server
+from verktyg_server import make_inet_socket
+from verktyg_server.argparse import (
+    add_arguments, make_socket_options, make_socket, make_sockets,
+)
 
 import logging
 logging.disable(logging.CRITICAL)
@@ -59,6 +64,26 @@ class ArgParseTestCase(unittest.TestCase):
         self.assertEqual(options.address.hostname, 'example.com')
         self.assertEqual(options.address.port, 8000)
 
+    def test_threads(self):
+        parser = SilentArgumentParser()
+        add_arguments(parser)
+
+        options = parser.parse_args('--socket socket'.split())
+        self.assertIsNone(options.threads)
+
+        options = parser.parse_args('--socket socket --threads 8'.split())
+        self.assertEqual(options.threads, 8)
+
+    def test_workers(self):
+        parser = SilentArgumentParser()
+        add_arguments(parser)
+
+        options = parser.parse_args(
+            '--address localhost --workers 4 --reuse-port'.split()
+        )
+        self.assertEqual(options.workers, 4)
+        self.assertTrue(options.reuse_port)
+
     def test_private_key_only(self):
         parser = SilentArgumentParser()
         add_arguments(parser)
@@ -67,3 +92,165 @@ class ArgParseTestCase(unittest.TestCase):
             parser.parse_args(
                 '--address address --private-key path/to/key_file.pem'
             )
+
+    def test_access_log(self):
+        parser = SilentArgumentParser()
+        add_arguments(parser)
+
+        options = parser.parse_args('--socket socket'.split())
+        self.assertIsNone(options.access_log)
+        self.assertEqual(options.access_log_format, 'common')
+
+        options = parser.parse_args(
+            '--socket socket --access-log - --access-log-format json'.split()
+        )
+        self.assertEqual(options.access_log, '-')
+        self.assertEqual(options.access_log_format, 'json')
+
+        with self.assertRaises(ParseError):
+            parser.parse_args(
+                '--socket socket --access-log-format xml'.split()
+            )
+
+    def test_response_cache_size(self):
+        parser = SilentArgumentParser()
+        add_arguments(parser)
+
+        options = parser.parse_args('--socket socket'.split())
+        self.assertIsNone(options.response_cache_size)
+
+        options = parser.parse_args(
+            '--socket socket --response-cache-size 1048576'.split()
+        )
+        self.assertEqual(options.response_cache_size, 1048576)
+
+    def test_admission_control(self):
+        parser = SilentArgumentParser()
+        add_arguments(parser)
+
+        options = parser.parse_args('--socket socket'.split())
+        self.assertIsNone(options.max_in_flight)
+        self.assertIsNone(options.max_queue_wait)
+        self.assertEqual(options.retry_after, 1)
+
+        options = parser.parse_args((
+            '--socket socket --max-in-flight 64 --max-queue-wait 0.5 '
+            '--retry-after 5'
+        ).split())
+        self.assertEqual(options.max_in_flight, 64)
+        self.assertEqual(options.max_queue_wait, 0.5)
+        self.assertEqual(options.retry_after, 5)
+
+    def test_compress(self):
+        parser = SilentArgumentParser()
+        add_arguments(parser)
+
+        options = parser.parse_args('--socket socket'.split())
+        self.assertFalse(options.compress)
+        self.assertEqual(options.compress_min_size, 1024)
+
+        options = parser.parse_args(
+            '--socket socket --compress --compress-min-size 256'.split()
+        )
+        self.assertTrue(options.compress)
+        self.assertEqual(options.compress_min_size, 256)
+
+    def test_sni_certificate(self):
+        parser = SilentArgumentParser()
+        add_arguments(parser)
+
+        options = parser.parse_args([
+            '--socket', 'socket', '--certificate', 'default.pem',
+            '--sni-certificate', 'a.example.com:a.pem',
+            '--sni-certificate', 'b.example.com:b.pem:b.key',
+            '--reload-certificates',
+        ])
+        self.assertTrue(options.reload_certificates)
+        self.assertEqual(
+            [tuple(certificate) for certificate in options.sni_certificate],
+            [
+                ('a.example.com', 'a.pem', None),
+                ('b.example.com', 'b.pem', 'b.key'),
+            ],
+        )
+
+        with self.assertRaises(ParseError):
+            parser.parse_args('--socket socket --sni-certificate a'.split())
+
+    def test_socket_options(self):
+        parser = SilentArgumentParser()
+        add_arguments(parser)
+
+        options = make_socket_options(
+            parser.parse_args('--socket socket'.split())
+        )
+        self.assertTrue(options.nodelay)
+        self.assertIsNone(options.defer_accept)
+        self.assertFalse(options.keepalive)
+
+        options = make_socket_options(parser.parse_args([
+            '--socket', 'socket', '--no-tcp-nodelay',
+            '--tcp-defer-accept', '5', '--reuse-port',
+            '--tcp-keepalive', '--tcp-keepalive-idle', '60',
+        ]))
+        self.assertFalse(options.nodelay)
+        self.assertEqual(options.defer_accept, 5)
+        self.assertTrue(options.reuse_port)
+        self.assertTrue(options.keepalive)
+        self.assertEqual(options.keepalive_idle, 60)
+
+
+class SystemdSocketTestCase(unittest.TestCase):
+    def _pass_sockets(self, count):
+        # Descriptors well clear of any the test runner might be using, in
+        # place of the ones starting at 3 that systemd would pass.
+        start = 900
+        self.addCleanup(
+            setattr, verktyg_server, 'SD_LISTEN_FDS_START',
+            verktyg_server.SD_LISTEN_FDS_START,
+        )
+        verktyg_server.SD_LISTEN_FDS_START = start
+
+        ports = []
+        for index in range(count):
+            sock = make_inet_socket('localhost')
+            ports.append(sock.getsockname()[1])
+            fd = sock.detach()
+            os.dup2(fd, start + index)
+            os.close(fd)
+
+        os.environ.update({
+            'LISTEN_PID': str(os.getpid()),
+            'LISTEN_FDS': str(count),
+        })
+        self.addCleanup(os.environ.pop, 'LISTEN_PID', None)
+        self.addCleanup(os.environ.pop, 'LISTEN_FDS', None)
+        return ports
+
+    def _parse_args(self, argv):
+        parser = SilentArgumentParser()
+        add_arguments(parser)
+        return parser.parse_args(argv)
+
+    def test_make_socket(self):
+        ports = self._pass_sockets(1)
+        sock = make_socket(self._parse_args(['--systemd']))
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.getsockname()[1], ports[0])
+
+    def test_make_socket_no_sockets(self):
+        os.environ.pop('LISTEN_FDS', None)
+        with self.assertRaises(ValueError):
+            make_socket(self._parse_args(['--systemd']))
+
+    def test_make_socket_many_sockets(self):
+        self._pass_sockets(2)
+        with self.assertRaises(ValueError):
+            make_socket(self._parse_args(['--systemd']))
+
+    def test_make_sockets(self):
+        ports = self._pass_sockets(2)
+        sockets = make_sockets(self._parse_args(['--systemd']))
+        for sock in sockets:
+            self.addCleanup(sock.close)
+        self.assertEqual([sock.getsockname()[1] for sock in sockets], ports)
@@ -0,0 +1,211 @@
+"""
+    verktyg_server.tests.test_asyncio
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import time
+import socket
+import unittest
+
+from http.client import HTTPConnection
+from socket import create_connection
+from threading import Thread
+
+from verktyg_server import make_inet_socket, make_server
+from verktyg_server.asyncio import AsyncWSGIServer
+
+import logging
+logging.disable(logging.CRITICAL)
+
+
+def _echo_application(environ, start_response):
+    if environ.get('wsgi.input_terminated'):
+        body = environ['wsgi.input'].read()
+    else:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length)
+    body = environ['REQUEST_METHOD'].encode('ascii') + b' ' + body
+
+    status = '200 OK'
+    headers = [
+        ('Content-Type', 'text/plain; charset=utf-8'),
+        ('Content-Length', str(len(body))),
+    ]
+    start_response(status, headers)
+    return [body]
+
+
+class _Writer(object):
+    def __init__(self, extra_info):
+        self._extra_info = extra_info
+
+    def get_extra_info(self, name):
+        return self._extra_info.get(name)
+
+
+class AsyncHandlerTestCase(unittest.TestCase):
+    def test_handler_does_not_own_socket(self):
+        server = AsyncWSGIServer(
+            make_inet_socket('localhost'), _echo_application,
+        )
+        self.addCleanup(server.server_close)
+
+        # Before Python 3.8, transports hand out their actual socket, which
+        # handlers must not write to or change the timeout of directly.
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        handler = server._make_handler(_Writer({
+            'socket': sock, 'peername': ('127.0.0.1', 1234),
+        }))
+        self.assertIs(handler.request, sock)
+        self.assertIsNone(handler._plain_socket())
+
+        handler.write_timeout = 5
+        handler._set_write_timeout(5)
+        self.assertIsNone(sock.gettimeout())
+
+
+class AsyncServingTestCase(unittest.TestCase):
+    def setUp(self):
+        socket = make_inet_socket('localhost')
+        self.port = socket.getsockname()[1]
+
+        self.server = make_server(
+            socket, _echo_application, event_loop=True, threads=2,
+        )
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+
+    def test_make_server(self):
+        self.assertIsInstance(self.server, AsyncWSGIServer)
+
+    def test_keep_alive(self):
+        conn = HTTPConnection('localhost', self.port)
+        self.addCleanup(conn.close)
+
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        self.assertEqual(resp.read(), b"GET ")
+        sock = conn.sock
+
+        conn.request('POST', '/', body=b"hello")
+        resp = conn.getresponse()
+        self.assertEqual(resp.read(), b"POST hello")
+
+        # Both requests should have been sent over the same connection.
+        self.assertIs(conn.sock, sock)
+
+    def test_chunked_request(self):
+        conn = HTTPConnection('localhost', self.port)
+        self.addCleanup(conn.close)
+
+        conn.request('POST', '/', body=iter([b"hello", b" ", b"world"]))
+        resp = conn.getresponse()
+        self.assertEqual(resp.read(), b"POST hello world")
+        sock = conn.sock
+
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        self.assertEqual(resp.read(), b"GET ")
+        self.assertIs(conn.sock, sock)
+
+    def test_shutdown_with_idle_connection(self):
+        conn = HTTPConnection('localhost', self.port)
+        self.addCleanup(conn.close)
+
+        conn.request('GET', '/')
+        conn.getresponse().read()
+
+        start = time.monotonic()
+        self.server.shutdown()
+        self.assertLess(time.monotonic() - start, 1)
+
+    def _raw_request(self, request):
+        conn = create_connection(('localhost', self.port), timeout=5)
+        self.addCleanup(conn.close)
+        conn.sendall(request)
+        return conn.makefile('rb').read()
+
+    def test_bare_lf(self):
+        response = self._raw_request(
+            b"POST / HTTP/1.0\nContent-Length: 5\n\nhello"
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(response.endswith(b"\r\n\r\nPOST hello"))
+
+    def test_head_too_large(self):
+        # Both a single line that is too long, and too many lines that are
+        # each within the limit, should get a response.
+        for head in [
+                    b"Cookie: " + b"a" * 70000 + b"\r\n",
+                    (b"Cookie: " + b"a" * 1000 + b"\r\n") * 70,
+                ]:
+            response = self._raw_request(b"GET / HTTP/1.0\r\n" + head)
+            self.assertTrue(response.startswith(b"HTTP/1.1 431 "))
+
+    def test_request_line_too_long(self):
+        response = self._raw_request(
+            b"GET /" + b"a" * 70000 + b" HTTP/1.0\r\n\r\n"
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.1 414 "))
+
+    def test_long_body_lines(self):
+        def application(environ, start_response):
+            # Lines longer than the limit on request heads.
+            body = b",".join(
+                str(len(line)).encode('ascii')
+                for line in environ['wsgi.input']
+            )
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        self.server.app = application
+
+        conn = HTTPConnection('localhost', self.port, timeout=5)
+        self.addCleanup(conn.close)
+
+        conn.request('POST', '/', body=b"a" * 100000 + b"\nb\n" + b"c" * 70000)
+        self.assertEqual(conn.getresponse().read(), b"100001,2,70000")
+
+        # The whole body was read, so the connection can be reused.
+        self.server.app = _echo_application
+        conn.request('POST', '/', body=b"hello")
+        self.assertEqual(conn.getresponse().read(), b"POST hello")
+
+        start = time.monotonic()
+        self.server.shutdown()
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_drain(self):
+        conn = create_connection(('localhost', self.port))
+        self.addCleanup(conn.close)
+
+        # The application will be left waiting for the rest of the body.
+        conn.sendall(b"POST / HTTP/1.1\r\nContent-Length: 5\r\n\r\nab")
+        time.sleep(0.1)
+
+        drained = []
+        drainer = Thread(target=lambda: drained.append(self.server.drain(5)))
+        drainer.start()
+        time.sleep(0.1)
+
+        conn.sendall(b"cde")
+        response = b""
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            response += data
+
+        drainer.join()
+        self.assertTrue(response.endswith(b"\r\n\r\nPOST abcde"))
+        self.assertIn(b"Connection: close\r\n", response)
+        self.assertEqual(drained, [1])
@@ -0,0 +1,237 @@
+"""
+    verktyg_server.tests.test_cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import unittest
+from http.client import HTTPConnection
+from threading import Thread
+
+from verktyg_server.cache import ResponseCache, parse_cache_control
+from verktyg_server import make_inet_socket, make_server
+
+import logging
+logging.disable(logging.CRITICAL)
+
+
+def _environ(path='/', method='GET', **headers):
+    environ = {
+        'REQUEST_METHOD': method,
+        'wsgi.url_scheme': 'http',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'HTTP_HOST': 'example.com',
+    }
+    environ.update(headers)
+    return environ
+
+
+class _Application(object):
+    def __init__(self, headers=(), body=b"hello"):
+        self.headers = list(headers)
+        self.body = body
+        self.calls = 0
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        start_response('200 OK', list(self.headers))
+        return [self.body]
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def _request(self, cache, app, environ):
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        body = b''.join(cache.serve(app, environ, start_response))
+        status, headers = response
+        return status, dict(headers), body
+
+    def test_parse_cache_control(self):
+        self.assertEqual(
+            parse_cache_control('public, Max-Age=60, s-maxage="30"'),
+            {'public': None, 'max-age': '60', 's-maxage': '30'},
+        )
+
+    def test_hit(self):
+        cache = ResponseCache()
+        app = _Application([('Cache-Control', 'max-age=60')])
+
+        status, headers, body = self._request(cache, app, _environ())
+        self.assertEqual(body, b"hello")
+        self.assertEqual(headers['Content-Length'], '5')
+        self.assertNotIn('Age', headers)
+
+        status, headers, body = self._request(cache, app, _environ())
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, b"hello")
+        self.assertEqual(headers['Age'], '0')
+        self.assertEqual(app.calls, 1)
+
+        # Served from the stored `GET` response.
+        self._request(cache, app, _environ(method='HEAD'))
+        self.assertEqual(app.calls, 1)
+
+        # Different urls and hosts are stored separately.
+        self._request(cache, app, _environ('/other'))
+        self._request(cache, app, _environ(HTTP_HOST='example.org'))
+        self.assertEqual(app.calls, 3)
+
+        # Clients can ask to bypass the cache.
+        self._request(cache, app, _environ(HTTP_CACHE_CONTROL='no-cache'))
+        self.assertEqual(app.calls, 4)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['entries'], 3)
+
+    def test_not_cacheable(self):
+        cache = ResponseCache()
+        for headers in [
+                    [],
+                    [('Cache-Control', 'no-store, max-age=60')],
+                    [('Cache-Control', 'private, max-age=60')],
+                    [('Cache-Control', 'max-age=60'), ('Set-Cookie', 'a=b')],
+                    [('Cache-Control', 'max-age=60'), ('Vary', '*')],
+                    [('Expires', 'Thu, 01 Jan 1970 00:00:00 GMT')],
+                ]:
+            app = _Application(headers)
+            self._request(cache, app, _environ())
+            self._request(cache, app, _environ())
+            self.assertEqual(app.calls, 2, headers)
+
+        app = _Application([('Cache-Control', 'max-age=60')])
+        self._request(cache, app, _environ(method='POST'))
+        self._request(cache, app, _environ(HTTP_AUTHORIZATION='Basic eA=='))
+        self._request(cache, app, _environ())
+        self.assertEqual(app.calls, 3)
+
+    def test_vary(self):
+        cache = ResponseCache()
+        app = _Application([
+            ('Cache-Control', 'max-age=60'), ('Vary', 'Accept-Encoding'),
+        ])
+
+        self._request(cache, app, _environ(HTTP_ACCEPT_ENCODING='gzip'))
+        self._request(cache, app, _environ(HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual(app.calls, 1)
+
+        self._request(cache, app, _environ())
+        self._request(cache, app, _environ(HTTP_ACCEPT_ENCODING='br'))
+        self.assertEqual(app.calls, 3)
+        self.assertEqual(cache.stats()['entries'], 3)
+
+    def test_conditional(self):
+        cache = ResponseCache()
+        app = _Application([
+            ('Cache-Control', 'max-age=60'), ('ETag', '"v1"'),
+            ('Last-Modified', 'Mon, 01 Jan 2018 00:00:00 GMT'),
+        ])
+
+        status, headers, body = self._request(
+            cache, app, _environ(HTTP_IF_NONE_MATCH='"v0", W/"v1"'),
+        )
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(body, b"")
+        self.assertEqual(headers['ETag'], '"v1"')
+        self.assertNotIn('Last-Modified', headers)
+
+        status, headers, body = self._request(
+            cache, app, _environ(HTTP_IF_NONE_MATCH='"v2"'),
+        )
+        self.assertEqual(status, '200 OK')
+
+        status, headers, body = self._request(cache, app, _environ(
+            HTTP_IF_MODIFIED_SINCE='Tue, 02 Jan 2018 00:00:00 GMT',
+        ))
+        self.assertEqual(status, '304 Not Modified')
+
+        status, headers, body = self._request(cache, app, _environ(
+            HTTP_IF_MODIFIED_SINCE='Sun, 31 Dec 2017 00:00:00 GMT',
+        ))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(app.calls, 1)
+
+    def test_eviction(self):
+        cache = ResponseCache(max_size=300)
+        app = _Application([('Cache-Control', 'max-age=60')], b"x" * 100)
+
+        for path in ['/a', '/b', '/a', '/c']:
+            self._request(cache, app, _environ(path))
+        self.assertEqual(app.calls, 3)
+
+        # `/b` was least recently used.
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['entries'], 2)
+        self.assertLessEqual(stats['size'], 300)
+
+        self._request(cache, app, _environ('/a'))
+        self._request(cache, app, _environ('/c'))
+        self.assertEqual(app.calls, 3)
+        self._request(cache, app, _environ('/b'))
+        self.assertEqual(app.calls, 4)
+
+    def test_large_response(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Cache-Control', 'max-age=60')])
+            yield b"a" * 10
+            yield b"b" * 10
+
+        cache = ResponseCache(max_entry_size=15)
+        status, headers, body = self._request(cache, application, _environ())
+        self.assertEqual(body, b"a" * 10 + b"b" * 10)
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class ResponseCacheServingTestCase(unittest.TestCase):
+    def test_serving(self):
+        calls = []
+
+        def application(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain'),
+                ('Cache-Control', 'max-age=60'),
+            ])
+            return [b"cached"]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        cache = ResponseCache()
+        server = make_server(
+            socket, application, threads=2, response_cache=cache,
+        )
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            conn = HTTPConnection('localhost', port)
+            for n in range(3):
+                conn.request('GET', '/')
+                self.assertEqual(conn.getresponse().read(), b"cached")
+
+            self.assertEqual(calls, ['/'])
+            self.assertEqual(server.metrics.snapshot()['response_cache'], {
+                'hits': 2, 'misses': 1, 'evictions': 0, 'entries': 1,
+                'size': cache.stats()['size'],
+            })
+            self.assertIn(
+                'verktyg_server_response_cache_hits_total 2\n',
+                server.metrics.prometheus(),
+            )
+        finally:
+            server.shutdown()
+            thread.join()
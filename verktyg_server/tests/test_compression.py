@@ -0,0 +1,392 @@
+"""
+    verktyg_server.tests.test_compression
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import zlib
+import gzip
+import unittest
+from http.client import HTTPConnection
+from threading import Thread
+
+from verktyg_server.cache import ResponseCache
+from verktyg_server.compression import ResponseCompression, negotiate
+from verktyg_server import make_inet_socket, make_server
+
+import logging
+logging.disable(logging.CRITICAL)
+
+
+_TEXT = b"All work and no play makes Jack a dull boy.\n" * 100
+
+
+def _environ(accept_encoding='gzip', method='GET'):
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': '/',
+    }
+    if accept_encoding is not None:
+        environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+    return environ
+
+
+def _application(headers=(('Content-Type', 'text/plain'),), body=_TEXT):
+    def application(environ, start_response):
+        start_response('200 OK', list(headers))
+        return [body]
+    return application
+
+
+class ResponseCompressionTestCase(unittest.TestCase):
+    def _request(self, compression, app, environ):
+        response = []
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return written.append
+
+        body = b''.join(compression.serve(app, environ, start_response))
+        status, headers = response
+        return status, dict(headers), b''.join(written) + body
+
+    def test_negotiate(self):
+        encodings = ('br', 'gzip', 'deflate')
+        self.assertIsNone(negotiate(None, encodings))
+        self.assertIsNone(negotiate('', encodings))
+        self.assertIsNone(negotiate('identity', encodings))
+        self.assertEqual(negotiate('gzip, deflate', encodings), 'gzip')
+        self.assertEqual(negotiate('gzip, deflate, br', encodings), 'br')
+        self.assertEqual(negotiate('GZIP', encodings), 'gzip')
+        self.assertEqual(
+            negotiate('gzip;q=0.5, deflate;q=0.8', encodings), 'deflate',
+        )
+        self.assertEqual(negotiate('*', encodings), 'br')
+        self.assertEqual(negotiate('*, br;q=0', encodings), 'gzip')
+        self.assertIsNone(negotiate('gzip;q=0', encodings))
+        self.assertIsNone(negotiate('gzip;q=bad', encodings))
+
+    def test_gzip(self):
+        compression = ResponseCompression()
+        status, headers, body = self._request(
+            compression, _application(), _environ('gzip'),
+        )
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertEqual(gzip.decompress(body), _TEXT)
+
+    def test_deflate(self):
+        compression = ResponseCompression()
+        status, headers, body = self._request(
+            compression, _application(), _environ('deflate'),
+        )
+        self.assertEqual(headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(body), _TEXT)
+
+    def test_unsupported_encoding(self):
+        with self.assertRaises(ValueError):
+            ResponseCompression(encodings=('compress',))
+
+    def test_not_accepted(self):
+        compression = ResponseCompression()
+        status, headers, body = self._request(
+            compression, _application(), _environ(None),
+        )
+        self.assertNotIn('Content-Encoding', headers)
+        # Caches still need to know that the response could have been
+        # compressed.
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(body, _TEXT)
+
+    def test_min_size(self):
+        compression = ResponseCompression(min_size=1024)
+
+        status, headers, body = self._request(
+            compression, _application(body=b"small"), _environ(),
+        )
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(headers['Content-Length'], '5')
+        self.assertEqual(body, b"small")
+
+        status, headers, body = self._request(
+            compression, _application(headers=[
+                ('Content-Type', 'text/plain'), ('Content-Length', '5'),
+            ], body=b"small"), _environ(),
+        )
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertNotIn('Vary', headers)
+
+    def test_head(self):
+        compression = ResponseCompression(min_size=1024)
+
+        def application(environ, start_response):
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(_TEXT))),
+                ('ETag', '"abc"'),
+            ])
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                return []
+            return [_TEXT]
+
+        status, get_headers, body = self._request(
+            compression, application, _environ(method='GET'),
+        )
+        status, head_headers, body = self._request(
+            compression, application, _environ(method='HEAD'),
+        )
+        self.assertEqual(body, b"")
+        # The length of the compressed body can't be known without
+        # generating it.
+        del get_headers['Content-Length']
+        self.assertEqual(head_headers, get_headers)
+
+        # Without a length, the application's headers are left as they are.
+        status, headers, body = self._request(
+            compression, _application(body=b""), _environ(method='HEAD'),
+        )
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertNotIn('Content-Length', headers)
+
+    def test_content_types(self):
+        compression = ResponseCompression()
+        for content_type, compressed in [
+                    ('text/html; charset=utf-8', True),
+                    ('application/json', True),
+                    ('application/vnd.api+json', True),
+                    ('image/svg+xml', True),
+                    ('image/png', False),
+                    ('application/octet-stream', False),
+                ]:
+            status, headers, body = self._request(
+                compression,
+                _application(headers=[('Content-Type', content_type)]),
+                _environ(),
+            )
+            self.assertEqual('Content-Encoding' in headers, compressed)
+
+        status, headers, body = self._request(
+            compression, _application(headers=[]), _environ(),
+        )
+        self.assertNotIn('Content-Encoding', headers)
+
+    def test_not_transformed(self):
+        compression = ResponseCompression()
+        for extra in [
+                    ('Content-Encoding', 'gzip'),
+                    ('Content-Range', 'bytes 0-4399/4400'),
+                    ('Cache-Control', 'public, no-transform'),
+                ]:
+            status, headers, body = self._request(
+                compression, _application(headers=[
+                    ('Content-Type', 'text/plain'), extra,
+                ]), _environ(),
+            )
+            self.assertEqual(body, _TEXT)
+
+    def test_vary_and_etag(self):
+        compression = ResponseCompression()
+        status, headers, body = self._request(
+            compression, _application(headers=[
+                ('Content-Type', 'text/plain'),
+                ('Vary', 'Cookie'),
+                ('ETag', '"abc"'),
+                ('Content-Length', str(len(_TEXT))),
+            ]), _environ(),
+        )
+        self.assertEqual(headers['Vary'], 'Cookie, Accept-Encoding')
+        self.assertEqual(headers['ETag'], 'W/"abc"')
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertEqual(gzip.decompress(body), _TEXT)
+
+    def test_streamed(self):
+        closed = []
+
+        class Body(object):
+            def __iter__(self):
+                yield _TEXT
+                yield b""
+                yield _TEXT
+
+            def close(self):
+                closed.append(True)
+
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return Body()
+
+        compression = ResponseCompression()
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        application_iter = compression.serve(
+            application, _environ(), start_response,
+        )
+        chunks = iter(application_iter)
+
+        # Each chunk should be decodable as soon as it is received.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(next(chunks)), _TEXT)
+        headers = dict(response[1])
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', headers)
+
+        for chunk in chunks:
+            decompressor.decompress(chunk)
+        self.assertTrue(decompressor.eof)
+
+        application_iter.close()
+        self.assertEqual(closed, [True])
+
+    def test_write(self):
+        def application(environ, start_response):
+            write = start_response('200 OK', [('Content-Type', 'text/plain')])
+            write(_TEXT)
+            return [_TEXT]
+
+        compression = ResponseCompression()
+        status, headers, body = self._request(
+            compression, application, _environ(),
+        )
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), _TEXT + _TEXT)
+
+    def test_error_after_start(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            try:
+                raise ValueError()
+            except ValueError as e:
+                start_response('500 Internal Server Error', [
+                    ('Content-Type', 'text/plain'),
+                ], (type(e), e, e.__traceback__))
+            return [_TEXT]
+
+        compression = ResponseCompression()
+        status, headers, body = self._request(
+            compression, application, _environ(),
+        )
+        self.assertEqual(status, '500 Internal Server Error')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(body, _TEXT)
+
+    def test_cache(self):
+        compression = ResponseCompression(cache_size=1024 * 1024)
+
+        first = self._request(compression, _application(), _environ())
+        second = self._request(compression, _application(), _environ())
+        self.assertEqual(first, second)
+        self.assertEqual(compression.stats(), {
+            'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1,
+            'size': len(first[2]),
+        })
+
+        # Each encoding is cached separately.
+        self._request(compression, _application(), _environ('deflate'))
+        self.assertEqual(compression.stats()['entries'], 2)
+
+    def test_cache_eviction(self):
+        size = len(self._request(
+            ResponseCompression(), _application(), _environ(),
+        )[2])
+        compression = ResponseCompression(cache_size=size)
+
+        self._request(compression, _application(), _environ())
+        self._request(
+            compression, _application(body=_TEXT.upper()), _environ(),
+        )
+        stats = compression.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+    def test_cache_disabled(self):
+        compression = ResponseCompression(cache_size=0)
+        self._request(compression, _application(), _environ())
+        self.assertEqual(compression.stats()['misses'], 0)
+
+        compression = ResponseCompression(max_cache_entry_size=1024)
+        self._request(compression, _application(), _environ())
+        self.assertEqual(compression.stats()['entries'], 0)
+
+
+class ServerCompressionTestCase(unittest.TestCase):
+    def _serve(self, application, **kwargs):
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+        server = make_server(socket, application, threads=2, **kwargs)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        return server, thread, port
+
+    def test_streamed(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return iter([_TEXT, _TEXT])
+
+        server, thread, port = self._serve(
+            application, compression=ResponseCompression(),
+        )
+        try:
+            conn = HTTPConnection('localhost', port)
+            conn.request('GET', '/', headers={'Accept-Encoding': 'gzip'})
+            response = conn.getresponse()
+            self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+            self.assertEqual(
+                response.getheader('Transfer-Encoding'), 'chunked',
+            )
+            self.assertEqual(gzip.decompress(response.read()), _TEXT * 2)
+
+            # The connection can be reused afterwards.
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            self.assertIsNone(response.getheader('Content-Encoding'))
+            self.assertEqual(response.read(), _TEXT * 2)
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_with_response_cache(self):
+        calls = []
+
+        def application(environ, start_response):
+            calls.append(environ.get('HTTP_ACCEPT_ENCODING'))
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain'),
+                ('Cache-Control', 'max-age=60'),
+            ])
+            return [_TEXT]
+
+        compression = ResponseCompression()
+        server, thread, port = self._serve(
+            application, compression=compression,
+            response_cache=ResponseCache(),
+        )
+        try:
+            conn = HTTPConnection('localhost', port)
+            for accept_encoding in ['gzip', 'identity', 'gzip', 'identity']:
+                conn.request('GET', '/', headers={
+                    'Accept-Encoding': accept_encoding,
+                })
+                response = conn.getresponse()
+                body = response.read()
+                if accept_encoding == 'gzip':
+                    body = gzip.decompress(body)
+                self.assertEqual(body, _TEXT)
+
+            # Each variant is only generated once.
+            self.assertEqual(calls, ['gzip', 'identity'])
+            self.assertIn(
+                'verktyg_server_compression_cache_misses_total 1\n',
+                server.metrics.prometheus(),
+            )
+        finally:
+            server.shutdown()
+            thread.join()
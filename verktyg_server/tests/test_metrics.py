@@ -0,0 +1,189 @@
+"""
+    verktyg_server.tests.test_metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import time
+import unittest
+
+from http.client import HTTPConnection
+from threading import Event, Thread
+
+from verktyg_server.metrics import ServerMetrics
+from verktyg_server import make_inet_socket, make_server
+
+import logging
+logging.disable(logging.CRITICAL)
+
+
+class ServerMetricsTestCase(unittest.TestCase):
+    def test_threads(self):
+        metrics = ServerMetrics()
+
+        def record():
+            metrics.connection_opened()
+            metrics.request_started()
+            metrics.request_finished(
+                200, bytes_in=1, bytes_out=2,
+                first_byte=0.002, application=0.001, total=0.003,
+            )
+            metrics.connection_closed()
+
+        threads = [Thread(target=record) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Counters from threads that have exited should not be lost.
+        record()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['connections'], 5)
+        self.assertEqual(snapshot['active_connections'], 0)
+        self.assertEqual(snapshot['requests'], 5)
+        self.assertEqual(snapshot['in_flight_requests'], 0)
+        self.assertEqual(snapshot['bytes_in'], 5)
+        self.assertEqual(snapshot['bytes_out'], 10)
+        self.assertEqual(snapshot['responses'], {200: 5})
+
+        total = snapshot['total_seconds']
+        self.assertEqual(total['count'], 5)
+        self.assertAlmostEqual(total['sum'], 0.015)
+        self.assertEqual(dict(total['buckets'])[0.0025], 0)
+        self.assertEqual(dict(total['buckets'])[0.005], 5)
+        self.assertEqual(dict(total['buckets'])[float('inf')], 5)
+
+    def test_prometheus(self):
+        metrics = ServerMetrics()
+        metrics.request_started()
+        metrics.request_finished(
+            404, bytes_in=0, bytes_out=100,
+            first_byte=None, application=0.5, total=0.5,
+        )
+
+        text = metrics.prometheus()
+        self.assertIn('verktyg_server_requests_total 1\n', text)
+        self.assertIn('verktyg_server_responses_total{code="404"} 1\n', text)
+        self.assertIn(
+            'verktyg_server_total_seconds_bucket{le="0.25"} 0\n', text,
+        )
+        self.assertIn(
+            'verktyg_server_total_seconds_bucket{le="0.5"} 1\n', text,
+        )
+        self.assertIn(
+            'verktyg_server_total_seconds_bucket{le="+Inf"} 1\n', text,
+        )
+        self.assertIn('verktyg_server_first_byte_seconds_count 0\n', text)
+
+
+def _wait_for_requests(metrics, count, timeout=1):
+    # Requests are recorded just after the response has been sent, so the
+    # client can get there first.
+    deadline = time.monotonic() + timeout
+    while True:
+        snapshot = metrics.snapshot()
+        if snapshot['requests'] >= count or time.monotonic() > deadline:
+            return snapshot
+        time.sleep(0.01)
+
+
+class MetricsServingTestCase(unittest.TestCase):
+    def test_requests(self):
+        def application(environ, start_response):
+            environ['wsgi.input'].read()
+            time.sleep(0.05)
+            start_response('201 Created', [('Content-Length', '5')])
+            yield b"hello"
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(
+            socket, application, threads=2, metrics_path='/metrics',
+        )
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            conn = HTTPConnection('localhost', port)
+            for n in range(2):
+                conn.request('POST', '/', body=b'abc')
+                self.assertEqual(conn.getresponse().read(), b"hello")
+
+            snapshot = _wait_for_requests(server.metrics, 2)
+            self.assertEqual(snapshot['connections'], 1)
+            self.assertEqual(snapshot['active_connections'], 1)
+            self.assertEqual(snapshot['requests'], 2)
+            self.assertEqual(snapshot['in_flight_requests'], 0)
+            self.assertEqual(snapshot['responses'], {201: 2})
+            self.assertEqual(snapshot['bytes_in'], 6)
+            self.assertGreater(snapshot['bytes_out'], 10)
+
+            application_time = snapshot['application_seconds']
+            self.assertEqual(application_time['count'], 2)
+            self.assertGreaterEqual(application_time['sum'], 0.1)
+            self.assertGreaterEqual(
+                snapshot['total_seconds']['sum'], application_time['sum'],
+            )
+            self.assertEqual(snapshot['first_byte_seconds']['count'], 2)
+
+            conn.request('GET', '/metrics')
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 200)
+            text = resp.read().decode('utf-8')
+            self.assertIn('verktyg_server_requests_total 2\n', text)
+            self.assertIn('verktyg_server_in_flight_requests 1\n', text)
+            conn.close()
+        finally:
+            server.shutdown()
+            thread.join()
+
+        snapshot = server.metrics.snapshot()
+        self.assertEqual(snapshot['active_connections'], 0)
+        self.assertEqual(snapshot['requests'], 3)
+
+    def test_queue_wait_included(self):
+        started = Event()
+
+        def application(environ, start_response):
+            if environ['PATH_INFO'] == '/slow':
+                started.set()
+                time.sleep(0.3)
+            start_response('200 OK', [('Content-Length', '2')])
+            return [b"ok"]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, threads=1)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            def request(path):
+                conn = HTTPConnection('localhost', port, timeout=5)
+                conn.request('GET', path)
+                conn.getresponse().read()
+                conn.close()
+
+            slow = Thread(target=request, args=('/slow',))
+            slow.start()
+            self.assertTrue(started.wait(5))
+
+            # Has to wait for the only worker to finish the slow request.
+            request('/fast')
+            slow.join()
+
+            snapshot = _wait_for_requests(server.metrics, 2)
+            self.assertGreaterEqual(
+                snapshot['first_byte_seconds']['sum'], 0.5,
+            )
+            self.assertGreaterEqual(snapshot['total_seconds']['sum'], 0.5)
+        finally:
+            server.shutdown()
+            thread.join()
@@ -0,0 +1,253 @@
+"""
+    verktyg_server.tests.test_parser
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import socket
+import unittest
+
+from verktyg_server.parser import (
+    RequestHeadError, parse_request_line, parse_headers,
+)
+from verktyg_server import make_inet_socket, make_server
+
+import logging
+logging.disable(logging.CRITICAL)
+
+
+class ParseRequestLineTestCase(unittest.TestCase):
+    def test_request_line(self):
+        self.assertEqual(
+            parse_request_line(b"GET /path?query HTTP/1.1\r\n"),
+            ('GET', '/path?query', 'HTTP/1.1'),
+        )
+        self.assertEqual(
+            parse_request_line(b"GET /\r\n"), ('GET', '/', 'HTTP/0.9'),
+        )
+        self.assertIsNone(parse_request_line(b"\r\n"))
+
+    def test_bad_request_line(self):
+        for line, status in [
+                    (b"GET / HTTP/1.1 extra\r\n", 400),
+                    (b"GET / FTP/1.1\r\n", 400),
+                    (b"GET / HTTP/1\r\n", 400),
+                    (b"POST /\r\n", 400),
+                    (b"GET / HTTP/2.0\r\n", 505),
+                ]:
+            with self.assertRaises(RequestHeadError) as context:
+                parse_request_line(line)
+            self.assertEqual(context.exception.status, status)
+
+
+class ParseHeadersTestCase(unittest.TestCase):
+    def test_headers(self):
+        headers = parse_headers(
+            b"Host: example.com\r\n"
+            b"Content-Type: text/plain\r\n"
+            b"X-Forwarded-For:10.0.0.1 \r\n"
+            b"X-Forwarded-For: 10.0.0.2\r\n"
+            b"\r\n"
+        )
+        self.assertEqual(headers.environ, {
+            'HTTP_HOST': 'example.com',
+            'CONTENT_TYPE': 'text/plain',
+            'HTTP_X_FORWARDED_FOR': '10.0.0.2',
+        })
+        self.assertEqual(headers.get('content-type'), 'text/plain')
+        self.assertEqual(headers['Missing'], None)
+        self.assertIn('HOST', headers)
+        self.assertEqual(
+            headers.get_all('X-Forwarded-For'), ['10.0.0.1', '10.0.0.2'],
+        )
+        self.assertEqual(len(headers), 4)
+
+    def test_lookup_by_name(self):
+        headers = parse_headers(
+            b"Content-Type: text/plain\r\n"
+            b"X-Token: a\r\n"
+            b"\r\n"
+        )
+        # Lookups use the header name, not the environ key it maps to.
+        self.assertIsNone(headers.get('Content_Type'))
+        self.assertNotIn('X_Token', headers)
+        self.assertEqual(headers.get('x-token'), 'a')
+
+    def test_underscores_dropped(self):
+        headers = parse_headers(
+            b"Transfer_Encoding: chunked\r\n"
+            b"Content_Length: 5\r\n"
+            b"X_Forwarded_For: 10.0.0.1\r\n"
+            b"Host: example.com\r\n"
+            b"\r\n"
+        )
+        self.assertEqual(headers.environ, {'HTTP_HOST': 'example.com'})
+        self.assertIsNone(headers.get('Transfer-Encoding'))
+        self.assertIsNone(headers.get('Transfer_Encoding'))
+        self.assertEqual(len(headers), 1)
+
+    def test_bad_headers(self):
+        for head, status in [
+                    (b"Host: a\r\n folded\r\n\r\n", 400),
+                    (b"Host : a\r\n\r\n", 400),
+                    (b"Host\r\n\r\n", 400),
+                    (b": a\r\n\r\n", 400),
+                    (b"Bad Name: a\r\n\r\n", 400),
+                    (b"Bad\x00Name: a\r\n\r\n", 400),
+                    (b"Bad(Name): a\r\n\r\n", 400),
+                    (b"B\xe4d: a\r\n\r\n", 400),
+                    (b"X-Foo: a\rTransfer-Encoding: chunked\r\n\r\n", 400),
+                    (b"X-Foo: a\x00b\r\n\r\n", 400),
+                    (b"X-Foo\r: a\r\n\r\n", 400),
+                    (b"Content-Length: 1\r\nContent-Length: 2\r\n\r\n", 400),
+                    (b"Content-Length: +5\r\n\r\n", 400),
+                    (b"Content-Length: 0_5\r\n\r\n", 400),
+                    (b"Content-Length: -1\r\n\r\n", 400),
+                    (b"Content-Length: 5 5\r\n\r\n", 400),
+                    (b"Content-Length:\r\n\r\n", 400),
+                    (b"X: a\r\n" * 3 + b"\r\n", 431),
+                ]:
+            with self.assertRaises(RequestHeadError) as context:
+                parse_headers(head, max_headers=2)
+            self.assertEqual(context.exception.status, status)
+
+
+class ParseRequestTestCase(unittest.TestCase):
+    def _request(self, request, application=None):
+        def echo_cookie(environ, start_response):
+            body = environ.get('HTTP_COOKIE', '').encode('iso-8859-1')
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        if application is None:
+            application = echo_cookie
+
+        server = make_server(make_inet_socket('localhost'), application)
+        self.addCleanup(server.server_close)
+
+        client = socket.create_connection(server.server_address)
+        self.addCleanup(client.close)
+        client.sendall(request)
+        client.shutdown(socket.SHUT_WR)
+
+        server.handle_request()
+        return client.makefile('rb').read()
+
+    def test_request(self):
+        response = self._request(
+            b"GET / HTTP/1.0\r\nCookie: a=1; b=2\r\n\r\n"
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 OK\r\n"))
+        self.assertTrue(response.endswith(b"\r\n\r\na=1; b=2"))
+
+    def test_too_many_headers(self):
+        response = self._request(
+            b"GET / HTTP/1.0\r\n" + b"X: a\r\n" * 101 + b"\r\n"
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.0 431 "))
+
+    def test_head_too_large(self):
+        response = self._request(
+            b"GET / HTTP/1.0\r\nCookie: " + b"a" * 70000 + b"\r\n\r\n"
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.0 431 "))
+
+    def test_underscore_transfer_encoding(self):
+        def application(environ, start_response):
+            body = environ['wsgi.input'].read()
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        # Proxies ignore this header, so the body must not be framed by it.
+        response = self._request(
+            b"POST / HTTP/1.0\r\nTransfer_Encoding: chunked\r\n\r\n"
+            b"5\r\nhello\r\n0\r\n\r\n",
+            application,
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 OK\r\n"))
+        self.assertIn(b"\r\nContent-Length: 0\r\n", response)
+
+    def test_invalid_header_name(self):
+        response = self._request(
+            b"GET / HTTP/1.0\r\nBad Name: a\r\n\r\n"
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.0 400 "))
+
+    def test_bare_carriage_return(self):
+        # A bare carriage return must not end the header that contains it.
+        response = self._request(
+            b"GET / HTTP/1.0\r\nCookie: a=1\rTransfer-Encoding: chunked\r\n"
+            b"\r\n"
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.0 400 "))
+
+    def test_transfer_encoding(self):
+        def application(environ, start_response):
+            body = environ['wsgi.input'].read()
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        response = self._request(
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip, chunked\r\n"
+            b"Connection: close\r\n\r\n5\r\nhello\r\n0\r\n\r\n",
+            application,
+        )
+        self.assertTrue(response.endswith(b"\r\n\r\nhello"))
+
+        for transfer_encoding in [
+                    b"xchunked", b"chunked, gzip", b"gzip", b"chunkedx",
+                ]:
+            response = self._request(
+                b"POST / HTTP/1.1\r\nTransfer-Encoding: " +
+                transfer_encoding + b"\r\n\r\n5\r\nhello\r\n0\r\n\r\n",
+                application,
+            )
+            self.assertTrue(
+                response.startswith(b"HTTP/1.0 400 "), transfer_encoding,
+            )
+
+    def test_bad_content_length(self):
+        for content_length in [b"+5", b"0_5", b"-1", b"0x5"]:
+            response = self._request(
+                b"POST / HTTP/1.0\r\nContent-Length: " + content_length +
+                b"\r\n\r\nhello"
+            )
+            self.assertTrue(
+                response.startswith(b"HTTP/1.0 400 "), content_length,
+            )
+
+        # Whitespace around the value is not part of it.
+        response = self._request(
+            b"POST / HTTP/1.0\r\nContent-Length:  5 \r\n\r\nhello"
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 "))
+
+    def test_transfer_encoding_with_content_length(self):
+        def application(environ, start_response):
+            body = environ['wsgi.input'].read()
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        response = self._request(
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n"
+            b"Content-Length: 10\r\n\r\n5\r\nhello\r\n0\r\n\r\n",
+            application,
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.0 400 "))
+
+    def test_bad_chunk_size(self):
+        def application(environ, start_response):
+            body = environ['wsgi.input'].read()
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        response = self._request(
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"0x5\r\nhello\r\n0\r\n\r\n",
+            application,
+        )
+        self.assertTrue(response.startswith(b"HTTP/1.0 400 "))
+        self.assertIn(b"\r\nConnection: close\r\n", response)
@@ -7,17 +7,42 @@
     :license:
         BSD, see LICENSE for more details.
 """
+import os
+import sys
+import ssl
+import signal
+import time
+import tempfile
 import unittest
 
-from http.client import HTTPConnection
-from threading import Thread
+from socket import create_connection
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from threading import Thread, Barrier, Event
 
-from verktyg_server import make_inet_socket, make_server
+from verktyg_server.sslutils import make_adhoc_ssl_context
+from verktyg_server import (
+    make_inet_socket, make_server, WSGIRequestHandler, ThreadPoolWSGIServer,
+    PreforkWSGIServer,
+)
 
 import logging
 logging.disable(logging.CRITICAL)
 
 
+_REEXEC_SCRIPT = '''
+from verktyg_server import inherited_sockets, notify_ready, make_server
+
+def application(environ, start_response):
+    start_response('200 OK', [('Content-Length', '3')])
+    return [b"new"]
+
+server = make_server(inherited_sockets(), application)
+notify_ready()
+server.handle_request()
+server.server_close()
+'''
+
+
 class ServingTestCase(unittest.TestCase):
     def test_basic(self):
         def application(environ, start_response):
@@ -43,6 +68,263 @@ class ServingTestCase(unittest.TestCase):
             server.shutdown()
             thread.join()
 
+    def test_environ(self):
+        environs = []
+
+        def application(environ, start_response):
+            environs.append(environ)
+            start_response('200 OK', [('Content-Length', '0')])
+            return []
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            conn = HTTPConnection('localhost', port)
+            conn.request(
+                'POST', '/a%20b/c?d=e%20f', body=b'',
+                headers={'Content-Type': 'text/plain', 'X-Custom': 'x'},
+            )
+            conn.getresponse().read()
+
+            conn = HTTPConnection('localhost', port)
+            conn.request('GET', 'http://example.com/g?h')
+            conn.getresponse().read()
+        finally:
+            server.shutdown()
+            thread.join()
+
+        first, second = environs
+
+        self.assertEqual(first['REQUEST_METHOD'], 'POST')
+        self.assertEqual(first['PATH_INFO'], '/a b/c')
+        self.assertEqual(first['QUERY_STRING'], 'd=e%20f')
+        self.assertEqual(first['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(first['CONTENT_LENGTH'], '0')
+        self.assertEqual(first['HTTP_X_CUSTOM'], 'x')
+        self.assertNotIn('HTTP_CONTENT_TYPE', first)
+        self.assertEqual(first['wsgi.url_scheme'], 'http')
+        self.assertEqual(first['SERVER_PORT'], str(port))
+
+        self.assertEqual(second['PATH_INFO'], '/g')
+        self.assertEqual(second['QUERY_STRING'], 'h')
+        self.assertEqual(second['HTTP_HOST'], 'example.com')
+        self.assertEqual(second['CONTENT_TYPE'], '')
+        self.assertNotIn('HTTP_X_CUSTOM', second)
+
+    def test_many_chunks(self):
+        chunks = [str(i).encode('ascii') for i in range(10000)]
+
+        def application(environ, start_response):
+            status = '200 OK'
+            headers = [('Content-Length', str(sum(map(len, chunks))))]
+            start_response(status, headers)
+            return chunks
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            conn = HTTPConnection('localhost', port)
+            conn.request('GET', '/')
+
+            resp = conn.getresponse()
+            self.assertEqual(resp.read(), b"".join(chunks))
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_error_before_flush(self):
+        class Body(list):
+            def __iter__(self):
+                yield b"partial"
+                raise Exception("failed")
+
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Length', '100')])
+            return Body()
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            conn = HTTPConnection('localhost', port)
+            conn.request('GET', '/')
+
+            # Nothing had been sent when the application failed, so it should
+            # have been possible to replace the response with an error.
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 500)
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_chunked(self):
+        def application(environ, start_response):
+            if environ.get('wsgi.input_terminated'):
+                body = environ['wsgi.input'].read()
+            else:
+                length = int(environ['CONTENT_LENGTH'])
+                body = environ['wsgi.input'].read(length)
+
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            yield b"received: "
+            yield body
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, threaded=True)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            conn = HTTPConnection('localhost', port)
+            conn.request('POST', '/', body=iter([b"hello", b" world"]))
+            sock = conn.sock
+
+            resp = conn.getresponse()
+            self.assertEqual(resp.getheader('Transfer-Encoding'), 'chunked')
+            self.assertEqual(resp.read(), b"received: hello world")
+
+            # The connection should have been kept open.
+            conn.request('POST', '/', body=b"again")
+            resp = conn.getresponse()
+            self.assertEqual(resp.read(), b"received: again")
+            self.assertIs(conn.sock, sock)
+
+            # An idle keep-alive connection should not hold up shutdown.
+            start = time.monotonic()
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_chunked_http_1_0(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            yield b"hello"
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, threaded=True)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            conn = HTTPConnection('localhost', port)
+            conn._http_vsn_str = 'HTTP/1.0'
+            conn.request('GET', '/')
+
+            resp = conn.getresponse()
+            self.assertIsNone(resp.getheader('Transfer-Encoding'))
+            self.assertEqual(resp.getheader('Connection'), 'close')
+            self.assertEqual(resp.read(), b"hello")
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def _test_file_wrapper(self, *, ssl_context=None):
+        content = os.urandom(300000)
+
+        with tempfile.NamedTemporaryFile(delete=False) as file:
+            file.write(content)
+        self.addCleanup(os.remove, file.name)
+
+        def application(environ, start_response):
+            f = open(file.name, 'rb')
+            f.seek(100)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return environ['wsgi.file_wrapper'](f)
+
+        socket = make_inet_socket('localhost', ssl_context=ssl_context)
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, threaded=True)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            if ssl_context is None:
+                conn = HTTPConnection('localhost', port)
+            else:
+                conn = HTTPSConnection(
+                    'localhost', port,
+                    context=ssl._create_unverified_context(),
+                )
+            conn.request('GET', '/')
+
+            resp = conn.getresponse()
+            self.assertEqual(resp.getheader('Content-Length'), '299900')
+            self.assertEqual(resp.read(), content[100:])
+
+            conn.request('HEAD', '/')
+            resp = conn.getresponse()
+            self.assertEqual(resp.getheader('Content-Length'), '299900')
+            self.assertEqual(resp.read(), b"")
+
+            # Nothing should have been left in the stream.
+            conn.request('GET', '/')
+            self.assertEqual(conn.getresponse().read(), content[100:])
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_file_wrapper(self):
+        self._test_file_wrapper()
+
+    def test_file_wrapper_ssl(self):
+        self._test_file_wrapper(ssl_context=make_adhoc_ssl_context())
+
+    def test_unread_body(self):
+        def application(environ, start_response):
+            if environ['PATH_INFO'] == '/read':
+                # Should not block waiting for more data.
+                body = environ['wsgi.input'].read()
+            else:
+                body = b"ignored"
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, threaded=True)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            conn = HTTPConnection('localhost', port)
+            sock = None
+            for path in ['/ignore', '/read', '/ignore', '/read']:
+                conn.request('POST', path, body=b"request body")
+                resp = conn.getresponse()
+                self.assertEqual(resp.read(), (
+                    b"request body" if path == '/read' else b"ignored"
+                ))
+
+                # The unread body should not have been mistaken for the
+                # start of the next request, or caused the connection to be
+                # closed.
+                self.assertIs(conn.sock, sock or conn.sock)
+                sock = conn.sock
+        finally:
+            server.shutdown()
+            thread.join()
+
     def test_yield_no_set_headers(self):
         def application(environ, start_response):
             return [b"Who needs headers"]
@@ -63,3 +345,656 @@ class ServingTestCase(unittest.TestCase):
         finally:
             server.shutdown()
             thread.join()
+
+    def test_thread_pool(self):
+        barrier = Barrier(2, timeout=5)
+
+        def application(environ, start_response):
+            # Will only succeed if two requests are handled concurrently.
+            barrier.wait()
+            status = '200 OK'
+            headers = [('Content-type', 'text/plain; charset=utf-8')]
+            start_response(status, headers)
+            return [b"Hello pool!"]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, threads=2)
+        self.assertIsInstance(server, ThreadPoolWSGIServer)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            responses = []
+
+            def request():
+                conn = HTTPConnection('localhost', port)
+                conn.request('GET', '/')
+                responses.append(conn.getresponse().read())
+
+            clients = [Thread(target=request) for _ in range(2)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+
+            self.assertEqual(responses, [b"Hello pool!", b"Hello pool!"])
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_idle_new_connections(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return [b"ok"]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, threads=2)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            # Clients that connect without sending a request shouldn't tie
+            # up the workers.
+            for _ in range(2):
+                idle = create_connection(('localhost', port))
+                self.addCleanup(idle.close)
+
+            conn = HTTPConnection('localhost', port, timeout=2)
+            conn.request('GET', '/')
+            self.assertEqual(conn.getresponse().read(), b"ok")
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_slow_handshake(self):
+        class RequestHandler(WSGIRequestHandler):
+            handshake_timeout = 0.2
+
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return [b"ok"]
+
+        socket = make_inet_socket(
+            'localhost', ssl_context=make_adhoc_ssl_context(),
+        )
+        port = socket.getsockname()[1]
+
+        server = ThreadPoolWSGIServer(
+            socket, application, threads=1, handler=RequestHandler,
+        )
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            # A client that connects but never starts the handshake should
+            # hold up only the thread handling it, and only until the
+            # handshake times out.
+            stalled = create_connection(('localhost', port))
+            self.addCleanup(stalled.close)
+
+            started = time.monotonic()
+            conn = HTTPSConnection(
+                'localhost', port, timeout=5,
+                context=ssl._create_unverified_context(),
+            )
+            conn.request('GET', '/')
+            self.assertEqual(conn.getresponse().read(), b"ok")
+            self.assertLess(time.monotonic() - started, 2)
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def _start_slow_request(self, port, path='/slow'):
+        result = {}
+
+        def request():
+            conn = HTTPConnection('localhost', port, timeout=5)
+            conn.request('GET', path)
+            try:
+                resp = conn.getresponse()
+                result['connection'] = resp.getheader('Connection')
+                result['body'] = resp.read()
+            except (OSError, HTTPException) as e:
+                result['error'] = e
+
+        client = Thread(target=request)
+        client.start()
+        return client, result
+
+    def test_drain(self):
+        started = Event()
+        release = Event()
+
+        def application(environ, start_response):
+            if environ['PATH_INFO'] == '/slow':
+                started.set()
+                release.wait(5)
+            start_response('200 OK', [('Content-Length', '4')])
+            return [b"done"]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, threads=4)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            idle = HTTPConnection('localhost', port, timeout=5)
+            idle.request('GET', '/')
+            self.assertEqual(idle.getresponse().read(), b"done")
+
+            client, result = self._start_slow_request(port)
+            self.assertTrue(started.wait(5))
+
+            drained = []
+            drainer = Thread(target=lambda: drained.append(server.drain(5)))
+            drainer.start()
+
+            # Idle keep-alive connections should be closed straight away.
+            idle.sock.settimeout(5)
+            self.assertEqual(idle.sock.recv(1), b"")
+
+            release.set()
+            client.join()
+            drainer.join()
+
+            self.assertEqual(result['body'], b"done")
+            self.assertEqual(result['connection'], 'close')
+            self.assertEqual(drained, [1])
+        finally:
+            release.set()
+            server.shutdown()
+            thread.join()
+
+        with self.assertRaises(OSError):
+            create_connection(('localhost', port), timeout=1)
+
+    def test_drain_timeout(self):
+        release = Event()
+
+        def application(environ, start_response):
+            release.wait(5)
+            start_response('200 OK', [('Content-Length', '4')])
+            return [b"done"]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, threaded=True)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            client, result = self._start_slow_request(port)
+            time.sleep(0.1)
+
+            started = time.monotonic()
+            self.assertEqual(server.drain(0.2), 0)
+            self.assertLess(time.monotonic() - started, 2)
+
+            client.join()
+            self.assertIn('error', result)
+        finally:
+            release.set()
+            server.shutdown()
+            thread.join()
+
+    def test_drain_prefork(self):
+        def application(environ, start_response):
+            time.sleep(0.5)
+            start_response('200 OK', [('Content-Length', '4')])
+            return [b"done"]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, workers=1)
+        thread = Thread(target=server.serve_forever, kwargs={
+            'poll_interval': 0.01,
+        })
+        thread.start()
+
+        try:
+            deadline = time.monotonic() + 5
+            while not server.worker_pids:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+            client, result = self._start_slow_request(port)
+            time.sleep(0.2)
+
+            # The worker should finish the request before exiting.
+            server.drain(5)
+            client.join()
+            self.assertEqual(result.get('body'), b"done")
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def _test_prefork(self, *, reuse_port):
+        def application(environ, start_response):
+            status = '200 OK'
+            headers = [('Content-type', 'text/plain; charset=utf-8')]
+            start_response(status, headers)
+            return [str(os.getpid()).encode('ascii')]
+
+        socket = make_inet_socket('localhost', reuse_port=reuse_port)
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, workers=2)
+        self.assertIsInstance(server, PreforkWSGIServer)
+        thread = Thread(target=server.serve_forever, kwargs={
+            'poll_interval': 0.01,
+        })
+        thread.start()
+
+        def request():
+            conn = HTTPConnection('localhost', port)
+            conn.request('GET', '/')
+            return int(conn.getresponse().read())
+
+        try:
+            pid = request()
+            self.assertNotEqual(pid, os.getpid())
+            self.assertIn(pid, server.worker_pids)
+
+            # Killed workers should be replaced.
+            os.kill(pid, signal.SIGKILL)
+            deadline = time.monotonic() + 5
+            while pid in server.worker_pids or len(server.worker_pids) < 2:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+            self.assertIn(request(), server.worker_pids)
+        finally:
+            server.shutdown()
+            thread.join()
+
+        self.assertEqual(server.worker_pids, frozenset())
+
+    def test_prefork(self):
+        self._test_prefork(reuse_port=False)
+
+    def test_prefork_reuse_port(self):
+        self._test_prefork(reuse_port=True)
+
+    def test_reexec(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Length', '3')])
+            return [b"old"]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        def request():
+            conn = HTTPConnection('localhost', port)
+            conn.request('GET', '/')
+            return conn.getresponse().read()
+
+        try:
+            self.assertEqual(request(), b"old")
+
+            # A process that exits without reporting that it is ready should
+            # leave the old server running.
+            self.assertFalse(server.reexec([sys.executable, '-c', 'pass']))
+            self.assertEqual(request(), b"old")
+
+            self.assertTrue(
+                server.reexec([sys.executable, '-c', _REEXEC_SCRIPT])
+            )
+            server.drain()
+            thread.join()
+
+            # The listening socket should have been kept open by the new
+            # process.
+            self.assertEqual(request(), b"new")
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def _test_multiple_sockets(self, **kwargs):
+        def application(environ, start_response):
+            start_response('200 OK', [])
+            return [environ['wsgi.url_scheme'].encode('ascii')]
+
+        http_socket = make_inet_socket('localhost')
+        http_port = http_socket.getsockname()[1]
+
+        https_socket = make_inet_socket(
+            'localhost', ssl_context=make_adhoc_ssl_context(),
+        )
+        https_port = https_socket.getsockname()[1]
+
+        server = make_server(
+            [http_socket, https_socket], application, **kwargs
+        )
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            for n in range(2):
+                conn = HTTPConnection('localhost', http_port)
+                conn.request('GET', '/')
+                self.assertEqual(conn.getresponse().read(), b"http")
+                conn.close()
+
+                conn = HTTPSConnection(
+                    'localhost', https_port,
+                    context=ssl._create_unverified_context(),
+                )
+                conn.request('GET', '/')
+                self.assertEqual(conn.getresponse().read(), b"https")
+                conn.close()
+        finally:
+            server.shutdown()
+            thread.join()
+
+        self.assertEqual(http_socket.fileno(), -1)
+        self.assertEqual(https_socket.fileno(), -1)
+
+    def test_multiple_sockets(self):
+        self._test_multiple_sockets()
+
+    def test_multiple_sockets_threads(self):
+        self._test_multiple_sockets(threads=2)
+
+    def test_multiple_sockets_event_loop(self):
+        self._test_multiple_sockets(event_loop=True)
+
+    def test_batch_accept(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return [b"ok"]
+
+        socket = make_inet_socket('localhost')
+        server = make_server(socket, application)
+        self.addCleanup(server.server_close)
+
+        clients = []
+        for n in range(5):
+            client = create_connection(socket.getsockname())
+            self.addCleanup(client.close)
+            client.sendall(b"GET / HTTP/1.0\r\n\r\n")
+            clients.append(client)
+
+        # Every waiting connection should be accepted in one go.
+        server.accept_batch_size = 4
+        server.handle_request()
+        self.assertEqual(server.metrics.snapshot()['requests'], 4)
+        server.handle_request()
+        self.assertEqual(server.metrics.snapshot()['requests'], 5)
+
+        for client in clients:
+            self.assertTrue(client.makefile('rb').read().endswith(b"\r\nok"))
+
+    def test_shutdown_is_immediate(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return [b"ok"]
+
+        server = make_server(make_inet_socket('localhost'), application)
+        thread = Thread(target=server.serve_forever, args=(60,))
+        thread.start()
+
+        # Give the loop time to start waiting.
+        time.sleep(0.1)
+
+        start = time.monotonic()
+        server.shutdown()
+        thread.join()
+        self.assertLess(time.monotonic() - start, 1)
+
+
+class KeepAliveTestCase(unittest.TestCase):
+    def _start_server(self, handler=WSGIRequestHandler, **kwargs):
+        def application(environ, start_response):
+            body = environ['PATH_INFO'].encode('ascii')
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(
+            socket, application, request_handler=handler, **kwargs
+        )
+        thread = Thread(target=server.serve_forever, kwargs={
+            'poll_interval': 0.05,
+        })
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            thread.join()
+        self.addCleanup(stop)
+
+        return server, port
+
+    def test_pipelining(self):
+        server, port = self._start_server(threads=1)
+
+        conn = create_connection(('localhost', port), timeout=5)
+        self.addCleanup(conn.close)
+        conn.sendall(
+            b"GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            b"GET /b HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            b"GET /c HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+        )
+
+        response = b""
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            response += data
+
+        self.assertEqual(response.count(b"HTTP/1.1 200 OK\r\n"), 3)
+        self.assertTrue(response.endswith(b"/c"))
+        self.assertLess(response.index(b"\r\n\r\n/a"), response.index(b"/b"))
+
+    def test_max_keep_alive_requests(self):
+        class RequestHandler(WSGIRequestHandler):
+            max_keep_alive_requests = 4
+
+        # The thread pool parks idle connections between requests, which
+        # must not count towards the limit.
+        for kwargs in [{'threads': 2}, {'threaded': True}]:
+            server, port = self._start_server(RequestHandler, **kwargs)
+
+            conn = HTTPConnection('localhost', port, timeout=5)
+            for path in ['/a', '/b', '/c']:
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                self.assertEqual(resp.read(), path.encode('ascii'))
+                self.assertIsNone(resp.getheader('Connection'), kwargs)
+
+            conn.request('GET', '/d')
+            resp = conn.getresponse()
+            self.assertEqual(resp.read(), b"/d")
+            self.assertEqual(resp.getheader('Connection'), 'close')
+            self.assertIsNone(conn.sock)
+
+    def test_idle_connections_release_threads(self):
+        server, port = self._start_server(threads=1)
+
+        idle = HTTPConnection('localhost', port, timeout=5)
+        idle.request('GET', '/idle')
+        self.assertEqual(idle.getresponse().read(), b"/idle")
+
+        # The only worker should not be stuck waiting for the idle client.
+        other = HTTPConnection('localhost', port, timeout=2)
+        other.request('GET', '/other')
+        self.assertEqual(other.getresponse().read(), b"/other")
+
+        # The idle connection should still be usable.
+        sock = idle.sock
+        idle.request('GET', '/again')
+        self.assertEqual(idle.getresponse().read(), b"/again")
+        self.assertIs(idle.sock, sock)
+
+    def test_keep_alive_timeout(self):
+        class RequestHandler(WSGIRequestHandler):
+            keep_alive_timeout = 0.1
+
+        for kwargs in [{'threads': 1}, {'threaded': True}]:
+            server, port = self._start_server(RequestHandler, **kwargs)
+
+            conn = HTTPConnection('localhost', port, timeout=5)
+            conn.request('GET', '/')
+            self.assertEqual(conn.getresponse().read(), b"/")
+
+            # The server should close the connection once it has been idle
+            # for too long.
+            started = time.monotonic()
+            self.assertEqual(conn.sock.recv(1), b"")
+            self.assertLess(time.monotonic() - started, 2)
+
+            deadline = time.monotonic() + 2
+            while server.metrics.snapshot()['active_connections']:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+
+class AdmissionControlTestCase(unittest.TestCase):
+    def _start_server(self, **kwargs):
+        def application(environ, start_response):
+            # Blocks until the client sends the body, so that tests can
+            # control how long requests stay in flight.
+            body = environ['wsgi.input'].read()
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        socket = make_inet_socket('localhost')
+        port = socket.getsockname()[1]
+
+        server = make_server(socket, application, **kwargs)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            thread.join()
+        self.addCleanup(stop)
+
+        return server, port
+
+    def _wait_for_in_flight(self, server, count):
+        deadline = time.monotonic() + 5
+        while True:
+            if hasattr(server, 'active_children'):
+                # Reaped by the accept loop.
+                in_flight = len(server.active_children or ())
+            else:
+                in_flight = server._in_flight()
+            if in_flight == count:
+                return
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def _start_slow_request(self, port):
+        conn = create_connection(('localhost', port), timeout=5)
+        self.addCleanup(conn.close)
+        conn.sendall(
+            b"POST /slow HTTP/1.1\r\nHost: localhost\r\n"
+            b"Content-Length: 5\r\nConnection: close\r\n\r\n"
+        )
+        return conn
+
+    def _finish_slow_request(self, conn):
+        conn.sendall(b"hello")
+        response = conn.makefile('rb').read()
+        self.assertIn(b" 200 OK\r\n", response.split(b"\r\n\r\n")[0])
+        self.assertTrue(response.endswith(b"\r\n\r\nhello"))
+
+    def test_max_in_flight(self):
+        for kwargs in [
+                    {'threads': 1},
+                    {'threaded': True},
+                    {'processes': 2},
+                    {'event_loop': True, 'threads': 1},
+                ]:
+            server, port = self._start_server(
+                max_in_flight=1, retry_after=7, **kwargs
+            )
+
+            slow = self._start_slow_request(port)
+            self._wait_for_in_flight(server, 1)
+
+            conn = HTTPConnection('localhost', port, timeout=5)
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            self.assertEqual(response.status, 503, kwargs)
+            self.assertEqual(response.getheader('Retry-After'), '7')
+            self.assertEqual(response.getheader('Connection'), 'close')
+            response.read()
+            conn.close()
+
+            self._finish_slow_request(slow)
+            self._wait_for_in_flight(server, 0)
+
+            conn = HTTPConnection('localhost', port, timeout=5)
+            conn.request('GET', '/')
+            self.assertEqual(conn.getresponse().status, 200)
+            conn.close()
+
+            self.assertEqual(
+                server.metrics.snapshot()['requests_shed'], {'in_flight': 1},
+            )
+            self.assertIn(
+                'verktyg_server_requests_shed_total{reason="in_flight"} 1\n',
+                server.metrics.prometheus(),
+            )
+
+    def test_idle_connections_are_not_in_flight(self):
+        server, port = self._start_server(threaded=True, max_in_flight=1)
+
+        idle = HTTPConnection('localhost', port, timeout=5)
+        idle.request('GET', '/')
+        self.assertEqual(idle.getresponse().status, 200)
+        self._wait_for_in_flight(server, 0)
+
+        conn = HTTPConnection('localhost', port, timeout=5)
+        conn.request('GET', '/')
+        self.assertEqual(conn.getresponse().status, 200)
+
+        idle.close()
+        conn.close()
+
+    def test_max_queue_wait(self):
+        for kwargs in [
+                    {'threads': 1, 'queue_size': 4},
+                    {'event_loop': True, 'threads': 1},
+                ]:
+            server, port = self._start_server(max_queue_wait=0.05, **kwargs)
+
+            slow = self._start_slow_request(port)
+            self._wait_for_in_flight(server, 1)
+
+            queued = create_connection(('localhost', port), timeout=5)
+            self.addCleanup(queued.close)
+            queued.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            self._wait_for_in_flight(server, 2)
+            time.sleep(0.1)
+
+            self._finish_slow_request(slow)
+
+            response = queued.makefile('rb').read()
+            self.assertTrue(
+                response.startswith(b"HTTP/1.1 503 Service Unavailable\r\n"),
+                kwargs,
+            )
+            self.assertIn(b"\r\nRetry-After: 1\r\n", response)
+
+            self.assertEqual(
+                server.metrics.snapshot()['requests_shed'],
+                {'queue_wait': 1},
+            )
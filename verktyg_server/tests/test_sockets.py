@@ -7,12 +7,20 @@
     :license:
         BSD, see LICENSE for more details.
 """
+import os
+import sys
 import socket
 import ssl
+import shutil
+import tempfile
 import unittest
 import threading
 
-from verktyg_server import make_inet_socket
+import verktyg_server
+from verktyg_server import (
+    make_inet_socket, make_unix_socket, make_fd_socket, systemd_sockets,
+)
+from verktyg_server.sockopts import SocketOptions, accept_queue
 from verktyg_server import make_adhoc_ssl_context
 
 
@@ -165,3 +173,134 @@ class InetSocketsTestCase(unittest.TestCase):
         self.addCleanup(server_conn.close)
 
         self.assertEqual(server_conn.recv(6), b'hello!')
+
+
+class FdSocketsTestCase(unittest.TestCase):
+    def test_make_fd_socket_family(self):
+        inet_socket = make_inet_socket('localhost')
+        self.addCleanup(inet_socket.close)
+
+        sock = make_fd_socket(inet_socket.fileno())
+        self.addCleanup(sock.close)
+
+        self.assertEqual(sock.family, socket.AF_INET)
+        self.assertEqual(sock.getsockname(), inet_socket.getsockname())
+
+    def test_systemd_sockets(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        unix_socket = make_unix_socket(os.path.join(directory, 'socket'))
+        inet_socket = make_inet_socket('localhost')
+        port = inet_socket.getsockname()[1]
+
+        # Descriptors well clear of any the test runner might be using, in
+        # place of the ones starting at 3 that systemd would pass.
+        start = 900
+        self.addCleanup(
+            setattr, verktyg_server, 'SD_LISTEN_FDS_START',
+            verktyg_server.SD_LISTEN_FDS_START,
+        )
+        verktyg_server.SD_LISTEN_FDS_START = start
+        for index, sock in enumerate([unix_socket, inet_socket]):
+            fd = sock.detach()
+            os.dup2(fd, start + index)
+            os.close(fd)
+
+        os.environ.update({
+            'LISTEN_PID': str(os.getpid()),
+            'LISTEN_FDS': '2',
+            'LISTEN_FDNAMES': 'proxy:health',
+        })
+        sockets = systemd_sockets(names=['health'])
+
+        self.assertNotIn('LISTEN_FDS', os.environ)
+
+        # Sockets that were not asked for should be closed.
+        with self.assertRaises(OSError):
+            os.fstat(start)
+
+        self.assertEqual([name for name, sock in sockets], ['health'])
+        name, sock = sockets[0]
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.family, socket.AF_INET)
+        self.assertEqual(sock.getsockname()[1], port)
+        self.assertFalse(os.get_inheritable(sock.fileno()))
+
+
+class SocketOptionsTestCase(unittest.TestCase):
+    def test_listener(self):
+        options = SocketOptions(recv_buffer=65536, reuse_port=True)
+        if hasattr(socket, 'TCP_DEFER_ACCEPT'):
+            options.defer_accept = 5
+
+        sock = make_inet_socket('localhost', socket_options=options)
+        self.addCleanup(sock.close)
+
+        # Linux doubles the requested size to allow for bookkeeping.
+        self.assertGreaterEqual(
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 65536,
+        )
+        self.assertTrue(
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT)
+        )
+        if options.defer_accept is not None:
+            self.assertGreater(
+                sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT),
+                0,
+            )
+
+    def test_unix_listener(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # TCP options should not be applied to unix sockets.
+        options = SocketOptions(reuse_port=True, fastopen=16)
+        sock = make_unix_socket(
+            os.path.join(directory, 'socket'), socket_options=options,
+        )
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.family, socket.AF_UNIX)
+
+    def test_connection(self):
+        options = SocketOptions(keepalive=True, keepalive_count=3)
+
+        listener = make_inet_socket('localhost')
+        self.addCleanup(listener.close)
+
+        client = socket.create_connection(listener.getsockname())
+        self.addCleanup(client.close)
+
+        conn, addr = listener.accept()
+        self.addCleanup(conn.close)
+        options.configure_connection(conn)
+
+        self.assertTrue(
+            conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        )
+        self.assertTrue(
+            conn.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        )
+        self.assertEqual(
+            conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT), 3,
+        )
+
+    @unittest.skipUnless(
+        sys.platform.startswith('linux'), "accept queue length is linux only"
+    )
+    def test_accept_queue(self):
+        listener = make_inet_socket('localhost', backlog=16)
+        self.addCleanup(listener.close)
+
+        self.assertEqual(accept_queue(listener), (0, 16))
+
+        for n in range(3):
+            client = socket.create_connection(listener.getsockname())
+            self.addCleanup(client.close)
+        self.assertEqual(accept_queue(listener), (3, 16))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        unix_listener = make_unix_socket(os.path.join(directory, 'socket'))
+        self.addCleanup(unix_listener.close)
+        self.assertIsNone(accept_queue(unix_listener))
@@ -7,8 +7,206 @@
     :license:
         BSD, see LICENSE for more details.
 """
+import os
+import ssl
+import socket
+import shutil
+import tempfile
 import unittest
+from datetime import timedelta
+from threading import Thread
+
+import verktyg_server.sslutils
+from verktyg_server.sslutils import (
+    make_adhoc_ssl_context, get_adhoc_ssl_pair, generate_adhoc_ssl_pair,
+    configure_session_resumption, CertificateStore,
+)
+from verktyg_server import make_inet_socket, make_server
+
+import logging
+logging.disable(logging.CRITICAL)
+
+
+class AdhocTestCase(unittest.TestCase):
+    def test_cached(self):
+        pair = get_adhoc_ssl_pair(host='cached.example.com', key_type='ec')
+        self.assertEqual(
+            get_adhoc_ssl_pair(host='cached.example.com', key_type='ec'), pair
+        )
+        self.assertNotEqual(
+            get_adhoc_ssl_pair(host='other.example.com', key_type='ec'), pair
+        )
+
+    def test_expired(self):
+        margin = verktyg_server.sslutils.ADHOC_EXPIRY_MARGIN
+        self.addCleanup(
+            setattr, verktyg_server.sslutils, 'ADHOC_EXPIRY_MARGIN', margin,
+        )
+        verktyg_server.sslutils.ADHOC_EXPIRY_MARGIN = timedelta(days=365)
+
+        pair = get_adhoc_ssl_pair(host='expired.example.com', key_type='ec')
+        self.assertNotEqual(
+            get_adhoc_ssl_pair(host='expired.example.com', key_type='ec'), pair
+        )
+
+    def test_cache_dir(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, cache_dir)
+
+        pair = get_adhoc_ssl_pair(key_type='ec', cache_dir=cache_dir)
+
+        filenames = sorted(os.listdir(cache_dir))
+        for filename in filenames:
+            self.addCleanup(os.remove, os.path.join(cache_dir, filename))
+        self.assertEqual(filenames, [
+            'adhoc-example.com-ec.cert.pem', 'adhoc-example.com-ec.key.pem',
+        ])
+
+        # Simulate a new process.
+        verktyg_server.sslutils._adhoc_pairs.clear()
+        self.assertEqual(
+            get_adhoc_ssl_pair(key_type='ec', cache_dir=cache_dir), pair
+        )
+
+    def test_ec_context(self):
+        context = make_adhoc_ssl_context(key_type='ec')
+        self.assertIsInstance(context, ssl.SSLContext)
 
 
 class SSLTestCase(unittest.TestCase):
-    pass
+    def test_configure_session_resumption(self):
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+
+        configure_session_resumption(
+            context, session_tickets=False, num_tickets=1,
+        )
+        self.assertTrue(context.options & ssl.OP_NO_TICKET)
+        self.assertEqual(context.num_tickets, 1)
+
+        configure_session_resumption(context)
+        self.assertFalse(context.options & ssl.OP_NO_TICKET)
+
+    def test_session_resumption(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return [b"ok"]
+
+        server_context = make_adhoc_ssl_context()
+        sock = make_inet_socket('localhost', ssl_context=server_context)
+        port = sock.getsockname()[1]
+
+        server = make_server(sock, application)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        client_context.check_hostname = False
+        client_context.verify_mode = ssl.CERT_NONE
+
+        def request(session=None):
+            conn = client_context.wrap_socket(
+                socket.create_connection(('localhost', port)),
+                session=session,
+            )
+            try:
+                conn.sendall(b"GET / HTTP/1.0\r\n\r\n")
+                # Session tickets are only processed once the client reads
+                # from the connection.
+                while conn.recv(4096):
+                    pass
+                return conn.session, conn.session_reused
+            finally:
+                conn.close()
+
+        try:
+            session, reused = request()
+            self.assertFalse(reused)
+
+            session, reused = request(session)
+            self.assertTrue(reused)
+
+            snapshot = server.metrics.snapshot()
+            self.assertEqual(snapshot['tls_sessions']['hits'], 1)
+            self.assertIn(
+                'verktyg_server_tls_session_hits_total 1\n',
+                server.metrics.prometheus(),
+            )
+        finally:
+            server.shutdown()
+            thread.join()
+
+
+class CertificateStoreTestCase(unittest.TestCase):
+    def _write_pair(self, directory, name, host):
+        cert, key = generate_adhoc_ssl_pair(host=host, key_type='ec')
+        cert_file = os.path.join(directory, name + '.cert.pem')
+        key_file = os.path.join(directory, name + '.key.pem')
+        with open(cert_file, 'wb') as f:
+            f.write(cert)
+        with open(key_file, 'wb') as f:
+            f.write(key)
+        return cert_file, key_file, ssl.PEM_cert_to_DER_cert(cert.decode())
+
+    def test_certificate_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        default_cert, default_key, default_der = self._write_pair(
+            directory, 'default', 'example.com',
+        )
+        a_cert, a_key, a_der = self._write_pair(
+            directory, 'a', 'a.example.com',
+        )
+        b_cert, b_key, b_der = self._write_pair(
+            directory, 'b', 'b.example.org',
+        )
+
+        store = CertificateStore(check_interval=0)
+        store.add(default_cert, default_key)
+        store.add(a_cert, a_key, hostnames=['a.example.com'])
+        store.add(b_cert, b_key, hostnames=['*.example.org'])
+
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return [b"ok"]
+
+        sock = make_inet_socket('localhost', ssl_context=store.make_context())
+        port = sock.getsockname()[1]
+
+        server = make_server(sock, application)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        client_context.check_hostname = False
+        client_context.verify_mode = ssl.CERT_NONE
+
+        def get_certificate(server_hostname=None):
+            conn = client_context.wrap_socket(
+                socket.create_connection(('localhost', port)),
+                server_hostname=server_hostname,
+            )
+            try:
+                certificate = conn.getpeercert(binary_form=True)
+                conn.sendall(b"GET / HTTP/1.0\r\n\r\n")
+                while conn.recv(4096):
+                    pass
+                return certificate
+            finally:
+                conn.close()
+
+        try:
+            self.assertEqual(get_certificate(), default_der)
+            self.assertEqual(get_certificate('a.example.com'), a_der)
+            self.assertEqual(get_certificate('b.example.org'), b_der)
+            self.assertEqual(get_certificate('c.example.com'), default_der)
+
+            # Replace the default certificate.
+            _, _, new_der = self._write_pair(
+                directory, 'default', 'example.com',
+            )
+            self.assertEqual(get_certificate(), new_der)
+            self.assertEqual(get_certificate('a.example.com'), a_der)
+        finally:
+            server.shutdown()
+            thread.join()
@@ -0,0 +1,209 @@
+"""
+    verktyg_server.tests.test_streams
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright:
+        (c) 2015 by Ben Mather.
+    :license:
+        BSD, see LICENSE for more details.
+"""
+import io
+import socket
+import unittest
+
+from verktyg_server.streams import (
+    ChunkedInput, LimitedInput, FileWrapper, SocketReader, MalformedBodyError,
+)
+
+
+class SocketReaderTestCase(unittest.TestCase):
+    def _make_reader(self, data, buffer_size=8):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        client.sendall(data)
+        client.shutdown(socket.SHUT_WR)
+        return SocketReader(server, buffer_size)
+
+    def test_readline(self):
+        reader = self._make_reader(b"GET /a HTTP/1.1\r\n\r\nGET /b")
+
+        self.assertEqual(reader.readline(), b"GET /a HTTP/1.1\r\n")
+        self.assertEqual(reader.readline(), b"\r\n")
+        self.assertEqual(reader.readline(3), b"GET")
+        self.assertEqual(reader.readline(), b" /b")
+        self.assertEqual(reader.readline(), b"")
+
+    def test_readhead(self):
+        reader = self._make_reader(
+            b"Host: a\r\nAccept: */*\r\n\r\nbody"
+            b"\r\nHost: b\n\nbody"
+        )
+        self.assertEqual(
+            reader.readhead(), b"Host: a\r\nAccept: */*\r\n\r\n",
+        )
+        self.assertEqual(reader.read(4), b"body")
+        self.assertEqual(reader.readhead(), b"\r\n")
+        self.assertEqual(reader.readhead(), b"Host: b\n\n")
+        self.assertEqual(reader.readhead(), b"body")
+
+    def test_readhead_size(self):
+        reader = self._make_reader(b"Host: example.com\r\n\r\n")
+        self.assertEqual(reader.readhead(10), b"Host: exam")
+
+    def test_buffered(self):
+        reader = self._make_reader(b"ab\ncd\n", buffer_size=1024)
+        self.assertEqual(reader.buffered, 0)
+
+        self.assertEqual(reader.readline(), b"ab\n")
+        self.assertEqual(reader.buffered, 3)
+        self.assertEqual(reader.readline(), b"cd\n")
+        self.assertEqual(reader.buffered, 0)
+
+    def test_read(self):
+        reader = self._make_reader(b"hello world, hello again")
+
+        self.assertEqual(reader.read(2), b"he")
+        self.assertEqual(reader.read(15), b"llo world, hell")
+        self.assertEqual(reader.read(), b"o again")
+        self.assertEqual(reader.read(), b"")
+
+    def test_readinto(self):
+        reader = self._make_reader(b"hello world, hello again")
+        reader.readline(1)
+
+        buffer = bytearray(20)
+        self.assertEqual(reader.readinto(buffer), 20)
+        self.assertEqual(buffer, b"ello world, hello ag")
+        self.assertEqual(reader.readinto(buffer), 3)
+        self.assertEqual(buffer[:3], b"ain")
+
+
+class LimitedInputTestCase(unittest.TestCase):
+    def test_read(self):
+        rfile = io.BytesIO(b"hello world\nnext request")
+        body = LimitedInput(rfile, 12)
+
+        self.assertEqual(body.read(5), b"hello")
+        self.assertFalse(body.eof)
+        self.assertEqual(body.read(), b" world\n")
+        self.assertTrue(body.eof)
+        self.assertEqual(body.read(), b"")
+        self.assertEqual(rfile.read(), b"next request")
+
+    def test_readline(self):
+        body = LimitedInput(io.BytesIO(b"ab\ncd\nef"), 7)
+
+        self.assertEqual(body.readline(2), b"ab")
+        self.assertEqual(list(body), [b"\n", b"cd\n", b"e"])
+
+    def test_readinto(self):
+        body = LimitedInput(io.BytesIO(b"hello world"), 8)
+
+        buffer = bytearray(5)
+        self.assertEqual(body.readinto(buffer), 5)
+        self.assertEqual(buffer, b"hello")
+        self.assertEqual(body.readinto(buffer), 3)
+        self.assertEqual(buffer[:3], b" wo")
+        self.assertEqual(body.readinto(buffer), 0)
+
+    def test_discard(self):
+        rfile = io.BytesIO(b"hello world")
+        body = LimitedInput(rfile, 5)
+
+        self.assertFalse(body.discard(4))
+        self.assertTrue(body.discard(5))
+        self.assertTrue(body.eof)
+        self.assertEqual(rfile.read(), b" world")
+
+    def test_truncated(self):
+        body = LimitedInput(io.BytesIO(b"hello"), 10)
+        with self.assertRaises(IOError):
+            body.read()
+
+
+class ChunkedInputTestCase(unittest.TestCase):
+    def test_read(self):
+        rfile = io.BytesIO(
+            b"5\r\nhello\r\n"
+            b"7;ext=value\r\n world\n\r\n"
+            b"0\r\n"
+            b"Trailer: value\r\n"
+            b"\r\n"
+            b"next request"
+        )
+        body = ChunkedInput(rfile)
+
+        self.assertFalse(body.eof)
+        self.assertEqual(body.read(3), b"hel")
+        self.assertEqual(body.read(5), b"lo wo")
+        self.assertEqual(body.read(), b"rld\n")
+        self.assertTrue(body.eof)
+        self.assertEqual(body.read(), b"")
+
+        # Everything up to the end of the body should have been consumed.
+        self.assertEqual(rfile.read(), b"next request")
+
+    def test_readline(self):
+        rfile = io.BytesIO(
+            b"4\r\nab\nc\r\n"
+            b"3\r\nd\ne\r\n"
+            b"0\r\n\r\n"
+        )
+        body = ChunkedInput(rfile)
+
+        self.assertEqual(list(body), [b"ab\n", b"cd\n", b"e"])
+        self.assertTrue(body.eof)
+
+    def test_readline_size(self):
+        rfile = io.BytesIO(b"6\r\nabcdef\r\n0\r\n\r\n")
+        body = ChunkedInput(rfile)
+
+        self.assertEqual(body.readline(4), b"abcd")
+        self.assertEqual(body.readline(4), b"ef")
+
+    def test_readinto(self):
+        body = ChunkedInput(io.BytesIO(b"3\r\nabc\r\n3\r\ndef\r\n0\r\n\r\n"))
+
+        buffer = bytearray(4)
+        self.assertEqual(body.readinto(buffer), 4)
+        self.assertEqual(buffer, b"abcd")
+        self.assertEqual(body.readinto(buffer), 2)
+        self.assertEqual(buffer[:2], b"ef")
+        self.assertTrue(body.eof)
+
+    def test_discard(self):
+        rfile = io.BytesIO(b"3\r\nabc\r\n0\r\n\r\nnext")
+        body = ChunkedInput(rfile)
+
+        self.assertTrue(body.discard(1024))
+        self.assertEqual(rfile.read(), b"next")
+
+    def test_invalid_chunk_size(self):
+        for size in [
+                    b"zz", b"", b"-5", b"+5", b"0x5", b"1_0", b" 5", b"5 ",
+                    b"5\t", b"5 ;ext",
+                ]:
+            body = ChunkedInput(io.BytesIO(size + b"\r\nhello\r\n0\r\n\r\n"))
+            with self.assertRaises(MalformedBodyError, msg=size):
+                body.read()
+
+    def test_chunk_extension(self):
+        body = ChunkedInput(io.BytesIO(b"5;name=value\r\nhello\r\n0\r\n\r\n"))
+        self.assertEqual(body.read(), b"hello")
+
+    def test_truncated(self):
+        body = ChunkedInput(io.BytesIO(b"10\r\nhello"))
+        with self.assertRaises(IOError):
+            body.read()
+
+
+class FileWrapperTestCase(unittest.TestCase):
+    def test_iterate(self):
+        filelike = io.BytesIO(b"abcdefg")
+        wrapper = FileWrapper(filelike, 3)
+
+        self.assertEqual(list(wrapper), [b"abc", b"def", b"g"])
+
+        wrapper.close()
+        self.assertTrue(filelike.closed)
@@ -1,6 +1,8 @@
+import os
 import unittest
 
 import ssl
+import socket
 from http.client import HTTPConnection, HTTPSConnection
 
 from verktyg_server.sslutils import make_adhoc_ssl_context
@@ -48,3 +50,33 @@ class TestServerTestCase(unittest.TestCase):
             client.request('GET', '/')
             resp = client.getresponse()
             self.assertEqual(resp.status, 200)
+
+    def test_unix_socket(self):
+        def application(environ, start_response):
+            body = repr(environ['REMOTE_ADDR']).encode()
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        with TestServer(application, unix_socket=True) as server:
+            self.assertIsNone(server.port)
+            self.assertEqual(server.address, 'unix://' + server.socket_path)
+
+            client = socket.socket(socket.AF_UNIX)
+            try:
+                client.connect(server.socket_path)
+                client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+                response = b''
+                while True:
+                    data = client.recv(4096)
+                    if not data:
+                        break
+                    response += data
+            finally:
+                client.close()
+
+            self.assertTrue(response.startswith(b'HTTP/1.0 200 OK\r\n'))
+            self.assertTrue(response.endswith(b"\r\n\r\n''"))
+
+            path = server.socket_path
+
+        self.assertFalse(os.path.exists(path))